@@ -0,0 +1,80 @@
+# summarizes an access log written by simple_server.py --access-log: per-route latency percentiles, where the
+# time went, throughput, and how many were shed with a 503 or 429 under load.  lines that aren't json (a torn
+# last line) are skipped.
+#
+# python access_report.py access.log
+# python access_report.py access.log --since 3600 --route /api/status
+
+import sys
+import json
+import time
+import argparse
+
+PHASES = ['recv_ms', 'parse_ms', 'queue_ms', 'handler_ms', 'send_ms']
+
+def percentile(ordered, p: float) -> float:
+    # nearest rank, `ordered` is sorted and not empty
+    return ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))]
+
+def total_ms(record) -> float:
+    return sum(record.get(phase, 0) for phase in PHASES)
+
+def read_records(path: str, since: float = None):
+    with open(path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if since is not None and record.get('ts', 0) < since:
+                continue
+            yield record
+
+def summarize(records, route_filter: str = None):
+    routes = {}  # (method, route) -> [records]
+    handshakes = []
+    first = last = None
+    for record in records:
+        first = record['ts'] if first is None else min(first, record['ts'])
+        last = record['ts'] if last is None else max(last, record['ts'])
+        if 'tls_ms' in record:
+            handshakes.append(record)
+        elif route_filter is None or record['route'] == route_filter:
+            routes.setdefault((record['method'], record['route']), []).append(record)
+    return routes, handshakes, first, last
+
+def print_report(routes, handshakes, first, last, out=sys.stdout):
+    if first is None:
+        print("no records", file=out)
+        return
+    span = max(last - first, 1e-9)
+    requests = sum(len(group) for group in routes.values())
+    print(f"{requests} requests over {span:.1f}s, {requests / span:.2f} req/s", file=out)
+    print(file=out)
+    print(f"{'route':<32} {'count':>7} {'req/s':>8} {'p50':>8} {'p95':>8} {'p99':>8} {'max':>8}  {'recv/parse/queue/handler/send mean':<36} {'err':>5} {'shed':>5} {'MB out':>8}", file=out)
+    for (method, route), group in sorted(routes.items(), key=lambda item: -len(item[1])):
+        totals = sorted(total_ms(record) for record in group)
+        means = '/'.join(f"{sum(record.get(phase, 0) for record in group) / len(group):.1f}" for phase in PHASES)
+        errors = sum(1 for record in group if record.get('status', 0) >= 500 and 'shed' not in record)
+        shed = sum(1 for record in group if 'shed' in record)
+        mb_out = sum(record.get('out', 0) for record in group) / 1e6
+        name = f"{method} {route}"
+        print(f"{name:<32} {len(group):>7} {len(group) / span:>8.2f} {percentile(totals, 50):>8.1f} {percentile(totals, 95):>8.1f} {percentile(totals, 99):>8.1f} {totals[-1]:>8.1f}  {means:<36} {errors:>5} {shed:>5} {mb_out:>8.2f}", file=out)
+    if handshakes:
+        print(file=out)
+        for resumed in [False, True]:
+            times = sorted(record['tls_ms'] for record in handshakes if record['resumed'] == resumed)
+            if times:
+                print(f"tls {'resumed' if resumed else 'full':<8} {len(times):>7} handshakes  p50 {percentile(times, 50):.1f}ms  p95 {percentile(times, 95):.1f}ms  p99 {percentile(times, 99):.1f}ms", file=out)
+
+def main():
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument("access_log", type=str, help="File written by simple_server.py --access-log")
+    argparser.add_argument("--since", type=float, help="Only look at the last this many seconds")
+    argparser.add_argument("--route", type=str, help="Only look at this route, e.g. /api/status")
+    args = argparser.parse_args()
+    since = time.time() - args.since if args.since is not None else None
+    print_report(*summarize(read_records(args.access_log, since), args.route))
+
+if __name__ == "__main__":
+    main()
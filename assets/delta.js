@@ -0,0 +1,263 @@
+// rsync-style block deltas, the client half of delta.py.  the binary formats must match it.
+// signature: "KSIG" u32:block_size u32:length, then per block u32:weak 8 bytes:strong
+// delta:     "KDLT" u32:block_size, then ops
+//   COPY u8:1 u32:first_block u32:block_count
+//   DATA u8:2 u32:length bytes
+
+const SIGNATURE_MAGIC = 'KSIG';
+const DELTA_MAGIC = 'KDLT';
+const SIGNATURE_HEADER_SIZE = 12;
+const SIGNATURE_BLOCK_SIZE = 12;
+const DELTA_HEADER_SIZE = 8;
+const OP_COPY = 1;
+const OP_DATA = 2;
+const STRONG_SIZE = 8;
+const MOD = 1 << 16;
+
+// below this, a whole-note get/put is about as small as a signature plus a delta.
+export const DELTA_MIN_SIZE = 16 * 1024;
+
+function blockSizeFor(length) {
+  return Math.max(512, Math.min(65536, Math.floor(Math.sqrt(length * SIGNATURE_BLOCK_SIZE))));
+}
+
+function mod(x) {
+  return ((x % MOD) + MOD) % MOD;
+}
+
+function writeMagic(view, offset, magic) {
+  for (let i = 0; i < 4; ++i) {
+    view.setUint8(offset + i, magic.charCodeAt(i));
+  }
+}
+
+function readMagic(view, offset) {
+  let magic = '';
+  for (let i = 0; i < 4; ++i) {
+    magic += String.fromCharCode(view.getUint8(offset + i));
+  }
+  return magic;
+}
+
+function bytesToHex(bytes) {
+  return Array.from(bytes).map(b => b.toString(16).padStart(2, "0")).join("");
+}
+
+export async function sha256hex(bytes) {
+  return bytesToHex(new Uint8Array(await crypto.subtle.digest('SHA-256', bytes)));
+}
+
+async function strongHash(block) {
+  return new Uint8Array(await crypto.subtle.digest('SHA-256', block)).slice(0, STRONG_SIZE);
+}
+
+function weakHash(block) {
+  let a = 0;
+  let b = 0;
+  const n = block.length;
+  for (let i = 0; i < n; ++i) {
+    a += block[i];
+    b += (n - i) * block[i];
+  }
+  return (mod(a) | (mod(b) << 16)) >>> 0;
+}
+
+function concat(parts) {
+  const total = parts.reduce((sum, part) => sum + part.length, 0);
+  const result = new Uint8Array(total);
+  let offset = 0;
+  for (let part of parts) {
+    result.set(part, offset);
+    offset += part.length;
+  }
+  return result;
+}
+
+// @param content Uint8Array of the version we have
+// @returns Uint8Array signature to send to whoever has the newer version
+export async function signature(content) {
+  const block_size = blockSizeFor(content.length);
+  const block_count = Math.ceil(content.length / block_size);
+  const result = new Uint8Array(SIGNATURE_HEADER_SIZE + block_count * SIGNATURE_BLOCK_SIZE);
+  const view = new DataView(result.buffer);
+  writeMagic(view, 0, SIGNATURE_MAGIC);
+  view.setUint32(4, block_size);
+  view.setUint32(8, content.length);
+  for (let i = 0; i < block_count; ++i) {
+    const block = content.subarray(i * block_size, (i + 1) * block_size);
+    const offset = SIGNATURE_HEADER_SIZE + i * SIGNATURE_BLOCK_SIZE;
+    view.setUint32(offset, weakHash(block));
+    result.set(await strongHash(block), offset + 4);
+  }
+  return result;
+}
+
+function parseSignature(sig) {
+  const view = new DataView(sig.buffer, sig.byteOffset, sig.byteLength);
+  if (sig.length < SIGNATURE_HEADER_SIZE || readMagic(view, 0) !== SIGNATURE_MAGIC) {
+    throw new Error('bad signature header');
+  }
+  const block_size = view.getUint32(4);
+  const length = view.getUint32(8);
+  const block_count = Math.ceil(length / block_size);
+  if (sig.length !== SIGNATURE_HEADER_SIZE + block_count * SIGNATURE_BLOCK_SIZE) {
+    throw new Error('signature length does not match block count');
+  }
+  let blocks = [];
+  for (let i = 0; i < block_count; ++i) {
+    const offset = SIGNATURE_HEADER_SIZE + i * SIGNATURE_BLOCK_SIZE;
+    blocks.push({weak: view.getUint32(offset), strong: bytesToHex(sig.subarray(offset + 4, offset + 4 + STRONG_SIZE))});
+  }
+  return {block_size, length, blocks};
+}
+
+function copyOp(first, count) {
+  const op = new Uint8Array(9);
+  const view = new DataView(op.buffer);
+  view.setUint8(0, OP_COPY);
+  view.setUint32(1, first);
+  view.setUint32(5, count);
+  return op;
+}
+
+function dataOp(length) {
+  const op = new Uint8Array(5);
+  const view = new DataView(op.buffer);
+  view.setUint8(0, OP_DATA);
+  view.setUint32(1, length);
+  return op;
+}
+
+// @param sig Uint8Array signature of the version the other side has
+// @param content Uint8Array of our newer version
+// @returns Uint8Array delta that turns their version into ours
+export async function makeDelta(sig, content) {
+  const {block_size, length, blocks} = parseSignature(sig);
+  const header = new Uint8Array(DELTA_HEADER_SIZE);
+  const header_view = new DataView(header.buffer);
+  writeMagic(header_view, 0, DELTA_MAGIC);
+  header_view.setUint32(4, block_size);
+  let out = [header];
+
+  // only full-size blocks can match while rolling, a short tail block can only match the end of content.
+  let full_blocks = new Map();
+  blocks.forEach((block, index) => {
+    if ((index + 1) * block_size <= length) {
+      if (!full_blocks.has(block.weak)) {
+        full_blocks.set(block.weak, []);
+      }
+      full_blocks.get(block.weak).push({index, strong: block.strong});
+    }
+  });
+
+  let pending_copy = null;
+  let literal_start = 0;
+  const n = content.length;
+  let i = 0;
+
+  const flush = (upto) => {
+    if (pending_copy !== null) {
+      out.push(copyOp(pending_copy.first, pending_copy.count));
+      pending_copy = null;
+    }
+    if (upto > literal_start) {
+      out.push(dataOp(upto - literal_start));
+      out.push(content.subarray(literal_start, upto));
+    }
+  };
+
+  let a = 0;
+  let b = 0;
+  let fresh = true;
+  while (i + block_size <= n) {
+    if (fresh) {
+      a = 0;
+      b = 0;
+      for (let k = 0; k < block_size; ++k) {
+        a += content[i + k];
+        b += (block_size - k) * content[i + k];
+      }
+      a = mod(a);
+      b = mod(b);
+      fresh = false;
+    }
+    const weak = (a | (b << 16)) >>> 0;
+
+    let match = null;
+    const candidates = full_blocks.get(weak);
+    if (candidates) {
+      const strong = bytesToHex(await strongHash(content.subarray(i, i + block_size)));
+      const found = candidates.find(c => c.strong === strong);
+      match = found ? found.index : null;
+    }
+
+    if (match !== null) {
+      if (pending_copy !== null && literal_start === i && pending_copy.first + pending_copy.count === match) {
+        pending_copy.count += 1;
+      } else {
+        flush(i);
+        pending_copy = {first: match, count: 1};
+      }
+      i += block_size;
+      literal_start = i;
+      fresh = true;
+      continue;
+    }
+
+    if (i + block_size < n) {
+      const out_byte = content[i];
+      const in_byte = content[i + block_size];
+      a = mod(a - out_byte + in_byte);
+      b = mod(b - block_size * out_byte + a);
+    }
+    i += 1;
+  }
+
+  const tail_length = length % block_size;
+  if (tail_length !== 0 && n - literal_start >= tail_length) {
+    const strong = bytesToHex(await strongHash(content.subarray(n - tail_length)));
+    if (strong === blocks[blocks.length - 1].strong) {
+      flush(n - tail_length);
+      literal_start = n;
+      out.push(copyOp(blocks.length - 1, 1));
+    }
+  }
+  flush(n);
+  return concat(out);
+}
+
+// @param base Uint8Array of the version the signature was taken of
+// @param delta Uint8Array from makeDelta / POST /api/delta
+// @returns Uint8Array of the newer version
+export function applyDelta(base, delta) {
+  const view = new DataView(delta.buffer, delta.byteOffset, delta.byteLength);
+  if (delta.length < DELTA_HEADER_SIZE || readMagic(view, 0) !== DELTA_MAGIC) {
+    throw new Error('bad delta header');
+  }
+  const block_size = view.getUint32(4);
+  let parts = [];
+  let offset = DELTA_HEADER_SIZE;
+  while (offset < delta.length) {
+    const op = view.getUint8(offset);
+    if (op === OP_COPY) {
+      const start = view.getUint32(offset + 1) * block_size;
+      const count = view.getUint32(offset + 5);
+      if (start >= base.length && count > 0) {
+        throw new Error('copy is past the end of the base');
+      }
+      parts.push(base.subarray(start, start + count * block_size));
+      offset += 9;
+    } else if (op === OP_DATA) {
+      const length = view.getUint32(offset + 1);
+      offset += 5;
+      if (offset + length > delta.length) {
+        throw new Error('data op is past the end of the delta');
+      }
+      parts.push(delta.subarray(offset, offset + length));
+      offset += length;
+    } else {
+      throw new Error(`unknown delta op ${op}`);
+    }
+  }
+  return concat(parts);
+}
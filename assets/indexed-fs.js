@@ -5,7 +5,7 @@ import { readBooleanFile, toggleBooleanFile } from '/boolean-state.js';
 import { rewrite, Msg, Line, Tag, rewriteBlock } from '/rewrite.js';
 import { dateComp } from '/date-util.js';
 import { restoreRepo } from '/sync.js';
-import { attemptSync } from '/sync.js';
+import { attemptSync, startChangeFeed } from '/sync.js';
 import { getGlobal, initializeKazGlobal } from '/global.js';
 import { paintList } from '/calendar.js';
 import { lookupIcon, MenuButton, ToggleButton, TextField, TextAction } from '/components.js';
@@ -1158,5 +1158,7 @@ export async function run() {
   console.log('global is', getGlobal());  
 
   await handleRouting();
+
+  startChangeFeed(console.log);
 }
 
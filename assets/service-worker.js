@@ -14,6 +14,7 @@ const cacheable_assets = [
   "calendar.js",
   "components.js",
   "date-util.js",
+  "delta.js",
   "filedb.js",
   "flatdb.js",
   "global.js",
@@ -23,6 +24,7 @@ const cacheable_assets = [
   "render.js",
   "remote.js",
   "rewrite.js",
+  "socket.js",
   "state.js",
   "status.js",
   "sync.js",
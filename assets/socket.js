@@ -0,0 +1,200 @@
+import { getRemote } from '/remote.js';
+
+// one websocket to the server for the whole session (GET /api/ws, see websocket_session in simple_server.py).
+// api() sends a request over it when it's open and falls back to fetch when it isn't,
+// and returns a Response either way, so callers don't care which one answered.
+// requests carry an id, so many can be in flight at once and come back in any order.
+// a request the server sheds (429 or 503, see AdmissionControl in kazhttp.py) is sent again after its Retry-After.
+
+const RECONNECT_MIN_MILLIS = 1000;
+const RECONNECT_MAX_MILLIS = 30000;
+const SHED_RETRIES = 5;
+
+let socket = null;
+let opening = null;
+let next_id = 1;
+const pending = new Map();  // id -> {resolve, reject}
+
+// change notifications, kept across reconnects
+let change_handler = null;
+let last_seq = null;
+let reconnect_millis = RECONNECT_MIN_MILLIS;
+let failed_at = 0;  // requests don't wait on another attempt right after one failed, they use fetch
+
+function websocketUrl(remote) {
+  const base = remote === '' ? window.location.origin : remote;
+  return base.replace(/^http/, 'ws') + '/api/ws';
+}
+
+function toBase64(bytes) {
+  let binary = '';
+  for (let i = 0; i < bytes.length; i += 0x8000) {
+    binary += String.fromCharCode.apply(null, bytes.subarray(i, i + 0x8000));
+  }
+  return btoa(binary);
+}
+
+function fromBase64(text) {
+  const binary = atob(text);
+  const bytes = new Uint8Array(binary.length);
+  for (let i = 0; i < binary.length; i++) {
+    bytes[i] = binary.charCodeAt(i);
+  }
+  return bytes;
+}
+
+function handleMessage(message) {
+  if (message.event !== undefined) {
+    if (message.seq !== undefined) {
+      last_seq = message.seq;
+    }
+    if (change_handler !== null) {
+      change_handler(message);
+    }
+    return;
+  }
+  const waiter = pending.get(message.id);
+  if (waiter !== undefined) {
+    pending.delete(message.id);
+    waiter.resolve(message);
+  }
+}
+
+function handleClose() {
+  socket = null;
+  opening = null;
+  for (const [id, waiter] of pending) {
+    waiter.reject(new Error('websocket closed'));
+  }
+  pending.clear();
+  if (change_handler !== null) {
+    // the subscription went with the socket, pick it up again from the last seq we saw
+    setTimeout(() => resubscribe(), reconnect_millis);
+    reconnect_millis = Math.min(reconnect_millis * 2, RECONNECT_MAX_MILLIS);
+  }
+}
+
+async function openSocket() {
+  if (typeof WebSocket === 'undefined') {
+    return null;
+  }
+  if (socket !== null) {
+    return socket;
+  }
+  if (opening === null) {
+    opening = getRemote().then(remote => new Promise(resolve => {
+      const ws = new WebSocket(websocketUrl(remote));
+      let opened = false;
+      ws.onopen = () => {
+        opened = true;
+        socket = ws;
+        reconnect_millis = RECONNECT_MIN_MILLIS;
+        resolve(ws);
+      };
+      ws.onmessage = (event) => handleMessage(JSON.parse(event.data));
+      ws.onclose = () => {
+        if (!opened) {
+          failed_at = Date.now();
+          resolve(null);
+        }
+        handleClose();
+      };
+    }));
+  }
+  return opening;
+}
+
+function send(ws, message) {
+  return new Promise((resolve, reject) => {
+    pending.set(message.id, {resolve, reject});
+    ws.send(JSON.stringify(message));
+  });
+}
+
+export async function api(path, options = {}) {
+  for (let attempt = 1; ; attempt++) {
+    const response = await request(path, options);
+    if ((response.status !== 429 && response.status !== 503) || attempt > SHED_RETRIES) {
+      return response;
+    }
+    // a cross-origin fetch can't read Retry-After, back off by the attempt then
+    const retry_after = Number(response.headers.get('retry-after')) || attempt;
+    console.log(`socket: ${path} got ${response.status}, retrying in ${retry_after}s`);
+    await new Promise(resolve => setTimeout(resolve, retry_after * 1000));
+  }
+}
+
+async function request(path, options) {
+  const recently_failed = socket === null && Date.now() - failed_at < RECONNECT_MAX_MILLIS;
+  const ws = recently_failed ? null : await openSocket();
+  if (ws === null) {
+    return fetch((await getRemote()) + path, options);
+  }
+  const message = {id: next_id++, method: options.method || 'GET', path: path, headers: options.headers || {}};
+  if (typeof options.body === 'string') {
+    message.body = options.body;
+  } else if (options.body instanceof ArrayBuffer) {
+    message.body_base64 = toBase64(new Uint8Array(options.body));
+  } else if (ArrayBuffer.isView(options.body)) {
+    message.body_base64 = toBase64(new Uint8Array(options.body.buffer, options.body.byteOffset, options.body.byteLength));
+  }
+  let reply;
+  try {
+    reply = await send(ws, message);
+  } catch (e) {
+    console.log('socket: request failed, retrying with fetch', path, e);
+    return fetch((await getRemote()) + path, options);
+  }
+  const body = reply.body_base64 !== undefined ? fromBase64(reply.body_base64) : reply.body;
+  return new Response(body, {status: reply.status, headers: reply.headers || {}});
+}
+
+async function resubscribe() {
+  if (change_handler === null) {
+    return false;  // unsubscribed while a reconnect was scheduled
+  }
+  const ws = await openSocket();
+  if (ws === null) {
+    return false;  // onclose already scheduled the next attempt
+  }
+  try {
+    const reply = await send(ws, {id: next_id++, method: 'SUBSCRIBE', since: last_seq});
+    if (reply.status !== 200) {
+      return false;
+    }
+    last_seq = reply.seq;
+    return true;
+  } catch (e) {
+    return false;  // closed under us, onclose scheduled the next attempt
+  }
+}
+
+// calls handler with {event: 'change', path, sha, seq} or {event: 'resync', seq} as they're pushed.
+// @returns false if there's no websocket to subscribe on.
+export async function subscribe(handler) {
+  if ((await openSocket()) === null) {
+    return false;
+  }
+  change_handler = handler;
+  return resubscribe();
+}
+
+// stops handing pushed changes to the handler, and stops resubscribing when the socket reconnects.
+export function unsubscribe() {
+  change_handler = null;
+}
+
+// the server says where its time went in a Server-Timing header (parse, handler, disk, hash, encode, in ms).
+// logged next to our own timings, whatever's left over was the link and tls.
+export function logServerTiming(label, response) {
+  const header = response.headers.get('server-timing');
+  if (header === null) {
+    return;
+  }
+  const phases = header.split(',').map(entry => {
+    const [name, ...params] = entry.trim().split(';');
+    const duration = params.map(param => param.trim()).find(param => param.startsWith('dur='));
+    return `${name} ${duration === undefined ? '?' : duration.slice('dur='.length)}ms`;
+  });
+  console.log(`${label}: server`, phases.join(', '));
+}
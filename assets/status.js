@@ -1,4 +1,4 @@
-import { getRemote } from '/remote.js';
+import { api, logServerTiming } from '/socket.js';
 import { getGlobal } from '/global.js';
 
 async function sha256sum(input_string) {
@@ -41,8 +41,10 @@ export function statusDiff(left, right) {
 
 export async function getCombinedRemoteStatus() {
   console.time('combined remote status');
-  let result = await fetch((await getRemote()) + '/api/status').then(x => x.json());
+  const response = await api('/api/status');
+  let result = await response.json();
   console.timeEnd('combined remote status');
+  logServerTiming('combined remote status', response);
   return result;
 }
 
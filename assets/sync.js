@@ -5,6 +5,8 @@ import { getCombinedRemoteStatus, getLocalStatus, statusDiff, getRemotes, getCom
 import { LOCAL_REPO_NAME_FILE } from '/flatdb.js';
 import { hasRemote } from '/remote.js';
 import { getSupervisorStatusPromise } from '/indexed-fs.js';
+import { signature, makeDelta, applyDelta, sha256hex, DELTA_MIN_SIZE } from '/delta.js';
+import { api, subscribe, unsubscribe, logServerTiming } from '/socket.js';
 
 export async function restoreRepo(repo) {
   await initializeKazGlobal(false);
@@ -24,6 +26,62 @@ export async function attemptSync(displayState) {
   }
 }
 
+// the server pushes {path, sha, seq} for every note that changes on it, over the session's websocket
+// (see socket.js) or GET /api/events where there isn't one.
+// notes from other repos are pulled as soon as they land instead of on the next full sync.
+// both reconnect by themselves and the server replays what we missed from the last seq we saw.
+let change_feed = null;
+let pulling = Promise.resolve();
+
+export async function startChangeFeed(displayState) {
+  if (change_feed !== null || !(await hasRemote())) {
+    return;
+  }
+  const onChange = (change) => {
+    // one at a time, in the order the server logged them
+    pulling = pulling.then(() => pullChange(change)).catch(e => console.log('sync: pulling change failed', change, e));
+  };
+  const onResync = () => {
+    console.log('sync: change feed missed changes, syncing in full');
+    pulling = pulling.then(() => attemptSync(displayState));
+  };
+  change_feed = 'websocket';
+  if (await subscribe(message => message.event === 'resync' ? onResync() : onChange(message))) {
+    return;
+  }
+  // the socket may have opened and then refused or dropped the SUBSCRIBE, so it must not deliver next to EventSource
+  unsubscribe();
+  if (typeof EventSource === 'undefined') {
+    change_feed = null;
+    return;
+  }
+  change_feed = new EventSource((await getRemote()) + '/api/events');
+  change_feed.onmessage = (event) => onChange(JSON.parse(event.data));
+  change_feed.addEventListener('resync', onResync);
+}
+
+async function pullChange(change) {
+  const repo = change.path.split('/')[0];
+  if (change.sha === null || repo === await getGlobal().notes.local_repo_name()) {
+    return;
+  }
+  let local = null;
+  try {
+    local = await getGlobal().notes.readFile(change.path);
+  } catch (e) {
+    // we don't have it yet
+  }
+  if (local !== null && await sha256hex(new TextEncoder().encode(local)) === change.sha) {
+    return;
+  }
+  const updated = {[change.path]: {status: local === null ? 'created' : 'modified', sha: change.sha}};
+  const full_uuids = await pullNoteDeltas(repo, updated);
+  if (full_uuids.length > 0) {
+    await fetchNotes(repo, full_uuids);
+  }
+  console.log(`sync: pulled ${change.path} (seq ${change.seq})`);
+}
+
 // attempts to sync.
 // @returns true if sync succeeded.  false if it failed.
 async function sync(displayState) {
@@ -65,7 +123,12 @@ async function fetchNotes(repo, uuids) {
   }
   for (let batch of batches) {
     console.log('sync: getting all messages')
-    let result = await fetch((await getRemote()) +'/api/get/' + repo + "/" + batch.join(",")).then(t => t.json());
+    const response = await api('/api/get/' + repo + "/" + batch.join(","));
+    if (!response.ok) {
+      throw new Error(`get failed: ${response.status}`);
+    }
+    let result = await response.json();
+    logServerTiming(`sync: got ${batch.length} notes`, response);
     await getGlobal().notes.putFiles(result);
   }
 }
@@ -73,7 +136,7 @@ async function fetchNotes(repo, uuids) {
 async function getAllNotes(repo) {
   console.log('getting notes');
 
-  let list = await fetch((await getRemote()) + '/api/list/' + repo).then(x => x.json());
+  let list = await api('/api/list/' + repo).then(x => x.json());
 
   try {
     await fetchNotes(repo, list);
@@ -113,10 +176,61 @@ async function pullRemoteNotes(repo, dry_run, combined_remote_status, combined_l
   } else {
     // writeOutputIfElementIsPresent(repo + '_sync_output', "update committed:\n" + JSON.stringify(updated, undefined, 2));
     console.log('updated uuids', updated_uuids);
-    if (updated_uuids.length > 0) {
-      await fetchNotes(repo, updated_uuids);
+    let full_uuids = await pullNoteDeltas(repo, updated);
+    if (full_uuids.length > 0) {
+      await fetchNotes(repo, full_uuids);
+    }
+  }
+}
+
+// large notes that we already have a version of are pulled as block deltas against our copy.
+// @returns the uuids that still need to be fetched whole.
+async function pullNoteDeltas(repo, updated) {
+  let full_uuids = [];
+  let patched = {};
+  for (let note in updated) {
+    const uuid = note.slice((repo + '/').length);
+    if (updated[note].status !== 'modified') {
+      full_uuids.push(uuid);
+      continue;
+    }
+    const local = new TextEncoder().encode(await getGlobal().notes.readFile(note));
+    if (local.length < DELTA_MIN_SIZE) {
+      full_uuids.push(uuid);
+      continue;
     }
+    try {
+      patched[note] = await pullNoteDelta(note, local, updated[note].sha);
+    } catch (e) {
+      console.log('delta pull failed, getting whole note', note, e);
+      full_uuids.push(uuid);
+    }
+  }
+  if (Object.keys(patched).length > 0) {
+    await getGlobal().notes.putFiles(patched);
+  }
+  return full_uuids;
+}
+
+async function pullNoteDelta(note, local, expected_sha) {
+  const response = await api('/api/delta/' + note, {
+    method: "POST",
+    headers: {
+      "Content-Type": "application/octet-stream",
+    },
+    body: await signature(local),
+  });
+  if (!response.ok) {
+    throw new Error(`delta request failed: ${response.status}`);
   }
+  const content = applyDelta(local, new Uint8Array(await response.arrayBuffer()));
+  const sha = await sha256hex(content);
+  if (sha !== response.headers.get('x-hash') || sha !== expected_sha) {
+    throw new Error('patched note does not match remote hash');
+  }
+  console.log(`sync: pulled ${note} as a delta`);
+  logServerTiming(`sync: delta for ${note}`, response);
+  return new TextDecoder().decode(content);
 }
 
 async function pushLocalNotes(repo, dry_run, combined_remote_status, combined_local_status) {
@@ -137,20 +251,75 @@ async function pushLocalNotes(repo, dry_run, combined_remote_status, combined_lo
     // writeOutputIfElementIsPresent(repo + '_sync_output', "push update committed:\n" + JSON.stringify(updated, undefined, 2));
     console.log('updated uuids', updated_uuids);
     if (updated_uuids.length > 0) {
-      await putNotes(repo, updated_uuids);
+      await putNotes(repo, updated_uuids, remote_status);
     }
   }
 }
 
-async function putNote(note) {
+async function putNote(note, remote_status) {
   console.log('syncing note', note, 'to server');
-  const response = await fetch((await getRemote()) + "/api/put/" + note, {
+  const content = await getGlobal().notes.readFile(note);
+  if (note in remote_status) {
+    const bytes = new TextEncoder().encode(content);
+    if (bytes.length >= DELTA_MIN_SIZE) {
+      try {
+        return await putNoteDelta(note, bytes);
+      } catch (e) {
+        console.log('delta push failed, putting whole note', note, e);
+      }
+    }
+  }
+  const response = await api("/api/put/" + note, {
     method: "PUT", // *GET, POST, PUT, DELETE, etc.
     headers: {
       "Content-Type": "text/plain",
     },
-    body: await getGlobal().notes.readFile(note), // body data type must match "Content-Type" header
+    body: content, // body data type must match "Content-Type" header
+  });
+  return response.text();
+}
+
+async function putNoteBatch(notes) {
+  console.log('syncing', notes.length, 'notes to server');
+  let files = {};
+  for (let note of notes) {
+    files[note] = await getGlobal().notes.readFile(note);
+  }
+  const response = await api("/api/put-batch", {
+    method: "PUT",
+    headers: {
+      "Content-Type": "application/json",
+    },
+    body: JSON.stringify(files),
+  });
+  if (!response.ok) {
+    throw new Error(`batch put failed: ${response.status}`);
+  }
+  logServerTiming(`sync: put ${notes.length} notes`, response);
+  return response.text();
+}
+
+// sends only the blocks of `bytes` that the server's copy of `note` doesn't already have.
+async function putNoteDelta(note, bytes) {
+  const sig_response = await api('/api/signature/' + note);
+  if (!sig_response.ok) {
+    throw new Error(`signature request failed: ${sig_response.status}`);
+  }
+  const base_hash = sig_response.headers.get('x-hash');
+  const delta = await makeDelta(new Uint8Array(await sig_response.arrayBuffer()), bytes);
+  const response = await api('/api/patch/' + note, {
+    method: "PUT",
+    headers: {
+      "Content-Type": "application/octet-stream",
+      "x-base-hash": base_hash,
+      "x-hash": await sha256hex(bytes),
+    },
+    body: delta,
   });
+  if (!response.ok) {
+    throw new Error(`patch failed: ${response.status}`);
+  }
+  console.log(`sync: pushed ${note} as a ${delta.length} byte delta`);
   return response.text();
 }
 
@@ -160,25 +329,44 @@ function delay(millis) {
   });
 }
 
-async function putNotes(repo, uuids) {
-  // TODO make this a batch as well
+async function withRetries(label, action) {
+  for (let i of [1, 2, 3]) {
+    try {
+      await action();
+      return true;
+    } catch (e) {
+      console.log(`failed attempt #${i}: ${label}`)
+      if (i !== 3) {
+        console.log('trying again...');
+        await delay(100 * i);
+      } else {
+        console.log(e);
+      }
+    }
+  }
+  return false;
+}
+
+async function putNotes(repo, uuids, remote_status) {
+  // large notes the server already has go one at a time so they can be sent as deltas,
+  // everything else goes in batches so the server can commit them together.
   let failures = [];
+  let batched = [];
   for (let file of uuids.map(x => repo + '/' + x)) {
-    for (let i of [1, 2, 3]) {
-      try {
-        await putNote(file);
-        break;
-      } catch (e) {
-        console.log(`failed attempt #${i}: ${file}`)
-        if (i !== 3) {
-          console.log('trying again...');
-          await delay(100 * i);
-        } else {
-          failures.push(file);
-          console.log(e);
-          break;
-        }
-      }
+    const delta_candidate = (file in remote_status)
+      && new TextEncoder().encode(await getGlobal().notes.readFile(file)).length >= DELTA_MIN_SIZE;
+    if (! delta_candidate) {
+      batched.push(file);
+    } else if (! await withRetries(file, () => putNote(file, remote_status))) {
+      failures.push(file);
+    }
+  }
+
+  let batch_size = 100;
+  for (let i = 0; i < batched.length; i += batch_size) {
+    const batch = batched.slice(i, i + batch_size);
+    if (! await withRetries(`batch of ${batch.length}`, () => putNoteBatch(batch))) {
+      failures.push(...batch);
     }
   }
   return failures;
@@ -0,0 +1,207 @@
+# content-addressed note storage
+#
+# note bodies are stored once per distinct content at .blobs/<ab>/<sha256>, the same sha256 that
+# /api/status reports, and each repo is a ref table at .refs/<repo>.json mapping uuid -> sha256.
+# - identical notes (across repos, or a note reverted to an old version) share one blob
+# - a snapshot is a copy of a repo's ref table at .snapshots/<repo>/<id>.json, no note bodies are copied
+# - a blob never changes once written, so it can be served by hash with an immutable cache header
+# - blobs that no ref table or snapshot points at are removed by `gc`
+#
+# has the same interface as storage.LooseStore, plus read_blob, read_blob_stored, snapshot, snapshots, read_snapshot and gc.
+# with `compress`, blobs are gzipped but still named by the hash of the note itself.
+# `load` has to be called before anything else.
+
+import os
+import json
+import threading
+import time
+
+from kazhttp import log, error
+from storage import LooseStore, hash_content, is_note_file, compress, decompress, NOT_REPOS
+
+BLOBS_DIR = ".blobs"
+REFS_DIR = ".refs"
+SNAPSHOTS_DIR = ".snapshots"
+GC_GRACE_SECONDS = 60  # a blob this fresh may belong to a write whose ref table isn't renamed into place yet
+
+def strip_json(name: str) -> str:
+    return name[:-len('.json')]
+
+def is_sha256(name: str) -> bool:
+    return len(name) == 64 and all(c in '0123456789abcdef' for c in name)
+
+class BlobStore:
+    features = {'blobs', 'snapshots'}
+
+    def __init__(self, root: str, writer, compress: bool = False):
+        self.root = root
+        self.writer = writer
+        self.compress = compress
+        self.blob_root = os.path.join(root, BLOBS_DIR)
+        self.ref_root = os.path.join(root, REFS_DIR)
+        self.snapshot_root = os.path.join(root, SNAPSHOTS_DIR)
+        self.lock = threading.Lock()
+        self.ref_write_lock = threading.Lock()  # keeps ref table renames in the same order as the updates
+        self.refs = {}  # repo -> {uuid: sha256}
+
+    def blob_path(self, sha: str) -> str:
+        return os.path.join(self.blob_root, sha[:2], sha)
+
+    def ref_path(self, repo: str) -> str:
+        return os.path.join(self.ref_root, repo + '.json')
+
+    def load(self):
+        for path in [self.blob_root, self.ref_root, self.snapshot_root]:
+            os.makedirs(path, exist_ok=True)
+        refs = {}
+        for name in os.listdir(self.ref_root):
+            if name.endswith('.json') and is_note_file(name):
+                with open(os.path.join(self.ref_root, name)) as f:
+                    refs[strip_json(name)] = json.load(f)
+        self.refs = refs
+        self.import_loose()
+
+    def import_loose(self):
+        # repos written by the one-file-per-note layout are imported the first time we see them.
+        # the loose files (flat or fanout) are left where they are.
+        for repo in os.listdir(self.root):
+            repo_path = os.path.join(self.root, repo)
+            if not os.path.isdir(repo_path) or repo in NOT_REPOS or not is_note_file(repo) or repo in self.refs:
+                continue
+            loose = LooseStore(self.root, None, fanout=True)
+            items = [(repo, uuid, loose.read(repo, uuid)) for uuid in loose.list(repo)]
+            self.write_many(items)
+            log(f"imported {len(items)} loose notes from {repo_path} into the blob store")
+
+    # note interface
+
+    def repos(self):
+        with self.lock:
+            return list(self.refs)
+
+    def list(self, repo: str):
+        with self.lock:
+            refs = self.refs
+            if repo not in refs:
+                raise FileNotFoundError(self.ref_path(repo))
+            return list(refs[repo])
+
+    def exists(self, repo: str, uuid: str) -> bool:
+        with self.lock:
+            return uuid in self.refs.get(repo, {})
+
+    def read(self, repo: str, uuid: str) -> bytes:
+        with self.lock:
+            sha = self.refs.get(repo, {}).get(uuid)
+        if sha is None:
+            raise FileNotFoundError(os.path.join(repo, uuid))
+        return self.read_blob(sha)
+
+    def read_stored(self, repo: str, uuid: str) -> bytes:
+        with self.lock:
+            sha = self.refs.get(repo, {}).get(uuid)
+        if sha is None:
+            raise FileNotFoundError(os.path.join(repo, uuid))
+        return self.read_blob_stored(sha)
+
+    def hashes(self, repo: str):
+        with self.lock:
+            return dict(self.refs.get(repo, {}))
+
+    def write_many(self, items):
+        blobs = {}
+        updates = []
+        for repo, uuid, content in items:
+            sha = hash_content(content)
+            if sha not in blobs:
+                try:
+                    # a fresh mtime keeps gc from sweeping an existing blob we're about to point at again
+                    os.utime(self.blob_path(sha))
+                except FileNotFoundError:
+                    blobs[sha] = compress(content) if self.compress else content
+            updates.append((repo, uuid, sha))
+
+        # blobs have to be durable before a ref table can point at them
+        for sha in blobs:
+            os.makedirs(os.path.dirname(self.blob_path(sha)), exist_ok=True)
+        self.writer.write_many([(self.blob_path(sha), content) for sha, content in blobs.items()])
+
+        with self.ref_write_lock:
+            # readers keep seeing the old tables until the new ones are durable
+            with self.lock:
+                tables = {repo: dict(self.refs.get(repo, {})) for repo, _, _ in updates}
+            for repo, uuid, sha in updates:
+                tables[repo][uuid] = sha
+            self.writer.write_many([(self.ref_path(repo), json.dumps(table).encode()) for repo, table in tables.items()])
+            with self.lock:
+                self.refs.update(tables)
+
+    # blobs and snapshots
+
+    def read_blob(self, sha: str) -> bytes:
+        return decompress(self.read_blob_stored(sha))
+
+    def read_blob_stored(self, sha: str) -> bytes:
+        if not is_sha256(sha):
+            raise FileNotFoundError(sha)
+        with open(self.blob_path(sha), 'rb') as f:
+            return f.read()
+
+    def snapshot(self, repo: str) -> str:
+        with self.lock:
+            refs = self.refs
+            if repo not in refs:
+                raise FileNotFoundError(self.ref_path(repo))
+            table = json.dumps(refs[repo]).encode()
+        snapshot_id = time.strftime('%Y%m%dT%H%M%S') + f"-{time.time_ns() % 1000000:06d}"
+        os.makedirs(os.path.join(self.snapshot_root, repo), exist_ok=True)
+        self.writer.write(os.path.join(self.snapshot_root, repo, snapshot_id + '.json'), table)
+        return snapshot_id
+
+    def snapshots(self, repo: str):
+        snapshot_dir = os.path.join(self.snapshot_root, repo)
+        if not os.path.isdir(snapshot_dir):
+            return []
+        return sorted(strip_json(name) for name in os.listdir(snapshot_dir) if name.endswith('.json') and is_note_file(name))
+
+    def read_snapshot(self, repo: str, snapshot_id: str):
+        if '/' in snapshot_id or '..' in snapshot_id:
+            raise FileNotFoundError(snapshot_id)
+        with open(os.path.join(self.snapshot_root, repo, snapshot_id + '.json')) as f:
+            return json.load(f)
+
+    def delete_snapshot(self, repo: str, snapshot_id: str):
+        if '/' in snapshot_id or '..' in snapshot_id:
+            raise FileNotFoundError(snapshot_id)
+        os.remove(os.path.join(self.snapshot_root, repo, snapshot_id + '.json'))
+
+    def gc(self) -> int:
+        # mark everything reachable from a ref table or snapshot, sweep the rest
+        with self.lock:
+            live = {sha for table in self.refs.values() for sha in table.values()}
+        for repo in os.listdir(self.snapshot_root):
+            for snapshot_id in self.snapshots(repo):
+                live.update(self.read_snapshot(repo, snapshot_id).values())
+
+        removed = 0
+        now = time.time()
+        for prefix in os.listdir(self.blob_root):
+            prefix_path = os.path.join(self.blob_root, prefix)
+            for sha in os.listdir(prefix_path):
+                path = os.path.join(prefix_path, sha)
+                if is_sha256(sha) and sha not in live and now - os.path.getmtime(path) > GC_GRACE_SECONDS:
+                    os.remove(path)
+                    removed += 1
+        if removed:
+            log(f"blob gc removed {removed} unreferenced blobs")
+        return removed
+
+    def start_gc(self, interval: float):
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.gc()
+                except Exception as e:
+                    error(f"blob gc failed: {e}")
+        threading.Thread(target=run, name="blob-gc", daemon=True).start()
@@ -0,0 +1,156 @@
+# in-memory LRU of note contents, capped by total bytes
+#
+# stands in front of a store with the same interface.  an entry holds the note's bytes and its
+# pre-encoded json string, so a batch /api/get is assembled by concatenation instead of json.dumps.
+# for clients that accept gzip, an entry also keeps its `"<repo>/<uuid>": <json string>` member deflated
+# (see kazhttp.deflate_piece), so a gzipped /api/get is spliced together without compressing anything.
+#
+# entries are validated two ways:
+# - writes through the cache drop the notes they touch
+# - if the store can `stat` a note (loose files, which can also be edited out-of-band), a hit is only
+#   served if the note's size and mtime still match what they were when it was cached
+
+import json
+import threading
+from collections import OrderedDict
+
+from kazhttp import deflate_piece, timed
+
+STAMP, CONTENT, FRAGMENT, DEFLATED = range(4)
+
+def json_key(repo: str, uuid: str) -> bytes:
+    return json.dumps(repo + '/' + uuid).encode()
+
+class NoteCache:
+    def __init__(self, store, max_bytes: int):
+        self.store = store
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # (repo, uuid) -> [stamp, content, json fragment, deflated member or None]
+        self.bytes = 0
+        # bumped by every write, a read that raced with one doesn't get cached
+        self.write_seq = 0
+
+        # stats
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytes_read = 0  # note contents read from the store on misses
+
+    def __getattr__(self, name):
+        if name == 'store':
+            raise AttributeError(name)
+        return getattr(self.store, name)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'bytes_read': self.bytes_read,
+                'entries': len(self.entries),
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+            }
+
+    def _stamp(self, repo: str, uuid: str):
+        stat = getattr(self.store, 'stat', None)
+        if stat is None:
+            return None
+        try:
+            st = stat(repo, uuid)
+        except FileNotFoundError:
+            # not on disk (yet), e.g. still pending in the write-ahead log.  the stamp changes once it's written
+            return None
+        return (st.st_size, st.st_mtime_ns)
+
+    def _drop(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= self._size(entry)
+
+    def _size(self, entry) -> int:
+        return len(entry[CONTENT]) + len(entry[FRAGMENT]) + len(entry[DEFLATED] or b"")
+
+    def _evict(self):
+        while self.bytes > self.max_bytes:
+            oldest = next(iter(self.entries))
+            self._drop(oldest)
+            self.evictions += 1
+
+    def _get(self, repo: str, uuid: str):
+        key = (repo, uuid)
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry is not None:
+            stamp = self._stamp(repo, uuid)
+            with self.lock:
+                if stamp == entry[STAMP] and self.entries.get(key) is entry:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return entry
+                self._drop(key)
+
+        with self.lock:
+            self.misses += 1
+            seq = self.write_seq
+        if self.max_bytes <= 0:
+            with timed('disk'):
+                content = self.store.read(repo, uuid)
+            with self.lock:
+                self.bytes_read += len(content)
+            return [None, content, json.dumps(content.decode('utf-8')).encode('utf-8'), None]
+        with timed('disk'):
+            stamp = self._stamp(repo, uuid)
+            content = self.store.read(repo, uuid)
+        with self.lock:
+            self.bytes_read += len(content)
+        fragment = json.dumps(content.decode('utf-8')).encode('utf-8')
+        entry = [stamp, content, fragment, None]
+        size = self._size(entry)
+        if size > self.max_bytes:
+            return entry
+
+        with self.lock:
+            if seq == self.write_seq:
+                self._drop(key)
+                self.entries[key] = entry
+                self.bytes += size
+                self._evict()
+        return entry
+
+    def read(self, repo: str, uuid: str) -> bytes:
+        return self._get(repo, uuid)[CONTENT]
+
+    def read_json(self, repo: str, uuid: str) -> bytes:
+        # the note's content as an encoded json string, quotes included
+        return self._get(repo, uuid)[FRAGMENT]
+
+    def read_json_deflated(self, repo: str, uuid: str):
+        # (json fragment, deflated json_key + b": " + fragment), the member is compressed once per cached entry
+        entry = self._get(repo, uuid)
+        deflated = entry[DEFLATED]
+        if deflated is None:
+            with timed('encode'):
+                deflated = deflate_piece(json_key(repo, uuid) + b": " + entry[FRAGMENT])
+            with self.lock:
+                if self.entries.get((repo, uuid)) is entry and entry[DEFLATED] is None:
+                    entry[DEFLATED] = deflated
+                    self.bytes += len(deflated)
+                    self._evict()
+        return entry[FRAGMENT], deflated
+
+    def write_many(self, items):
+        keys = [(repo, uuid) for repo, uuid, _ in items]
+        with self.lock:
+            self.write_seq += 1
+            for key in keys:
+                self._drop(key)
+        try:
+            self.store.write_many(items)
+        finally:
+            with self.lock:
+                self.write_seq += 1
+                for key in keys:
+                    self._drop(key)
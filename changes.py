@@ -0,0 +1,89 @@
+# sequence-numbered log of note changes
+#
+# stands in front of a store with the same interface.  every note written through it, and every change the
+# watcher (watcher.py) sees happen to the notes root out-of-band, gets the next sequence number.
+# a client that remembers the last seq it saw can ask for everything after it instead of a full /api/status.
+# only the last MAX_CHANGES are kept, a cursor older than that has to resync from /api/status.
+#
+# a note is only logged when its hash actually changed, so the watcher seeing our own writes land is a no-op.
+#
+# listeners (the /api/events streams) are called with each change as it's logged, under the log's lock so
+# they see changes in order.  they must not block.
+
+import threading
+from collections import deque
+
+from storage import hash_content
+
+MAX_CHANGES = 4096
+
+class ChangeLog:
+    def __init__(self, store, max_changes: int = MAX_CHANGES):
+        self.store = store
+        self.lock = threading.Lock()
+        self.seq = 0
+        self.recent = deque(maxlen=max_changes)  # (seq, repo, uuid, sha256 or None if removed)
+        self.latest = {}  # (repo, uuid) -> sha256 last logged, None if it was removed
+        self.floor = 0  # oldest cursor we still have everything after
+        self.listeners = set()  # called with (seq, repo, uuid, sha), or with None when every cursor has to resync
+
+    def __getattr__(self, name):
+        if name == 'store':
+            raise AttributeError(name)
+        return getattr(self.store, name)
+
+    def record(self, repo: str, uuid: str, sha) -> int:
+        # sha is None for a removed note.  returns the note's seq, or the current one if nothing changed
+        with self.lock:
+            key = (repo, uuid)
+            if key in self.latest and self.latest[key] == sha:
+                return self.seq
+            self.latest[key] = sha
+            if len(self.recent) == self.recent.maxlen:
+                self.floor = self.recent[0][0]
+            self.seq += 1
+            change = (self.seq, repo, uuid, sha)
+            self.recent.append(change)
+            for listener in list(self.listeners):
+                listener(change)
+            return self.seq
+
+    def reset(self):
+        # changes were missed (e.g. the watcher's event queue overflowed), every cursor has to resync
+        with self.lock:
+            self.seq += 1
+            self.floor = self.seq
+            self.recent.clear()
+            self.latest = {}
+            for listener in list(self.listeners):
+                listener(None)
+
+    def since(self, cursor: int):
+        # (seq, [(seq, repo, uuid, sha)]) after `cursor`, or (seq, None) if they're no longer all kept
+        with self.lock:
+            if cursor < self.floor or cursor > self.seq:
+                return self.seq, None
+            return self.seq, [change for change in self.recent if change[0] > cursor]
+
+    def subscribe(self, listener, cursor: int = None) -> int:
+        # replays what was logged after `cursor` (None if that's no longer all kept) to `listener` first,
+        # so it doesn't miss or reorder anything.  returns the current seq
+        with self.lock:
+            if cursor is not None:
+                if cursor < self.floor or cursor > self.seq:
+                    listener(None)
+                else:
+                    for change in self.recent:
+                        if change[0] > cursor:
+                            listener(change)
+            self.listeners.add(listener)
+            return self.seq
+
+    def unsubscribe(self, listener):
+        with self.lock:
+            self.listeners.discard(listener)
+
+    def write_many(self, items):
+        self.store.write_many(items)
+        for repo, uuid, content in items:
+            self.record(repo, uuid, hash_content(content))
@@ -0,0 +1,179 @@
+# rsync-style block deltas for notes
+#
+# the receiver of an update sends a signature of the version it already has,
+# the sender answers with a delta that only carries the bytes that changed.
+# - used by /api/signature, /api/delta and /api/patch in simple_server
+# - the client side is in assets/delta.js, and the binary formats must match it
+
+# signature: b"KSIG" u32:block_size u32:length, then per block u32:weak 8s:strong
+# delta:     b"KDLT" u32:block_size, then ops
+#   COPY u32:first_block u32:block_count
+#   DATA u32:length bytes
+
+import struct
+import hashlib
+import math
+
+SIGNATURE_MAGIC = b"KSIG"
+DELTA_MAGIC = b"KDLT"
+SIGNATURE_HEADER = struct.Struct(">4sII")
+SIGNATURE_BLOCK = struct.Struct(">I8s")
+DELTA_HEADER = struct.Struct(">4sI")
+OP_HEADER = struct.Struct(">BII")
+OP_DATA_HEADER = struct.Struct(">BI")
+
+OP_COPY = 1
+OP_DATA = 2
+
+MIN_BLOCK_SIZE = 512
+MAX_BLOCK_SIZE = 65536
+STRONG_SIZE = 8
+MOD = 1 << 16
+
+class DeltaError(Exception):
+    pass
+
+def block_size_for(length: int) -> int:
+    # signature size grows with length / block_size and a changed block costs block_size,
+    # so the total transfer is smallest around sqrt(length * bytes-per-block-entry).
+    size = math.isqrt(length * SIGNATURE_BLOCK.size)
+    return max(MIN_BLOCK_SIZE, min(MAX_BLOCK_SIZE, size))
+
+def strong_hash(block) -> bytes:
+    return hashlib.sha256(block).digest()[:STRONG_SIZE]
+
+def weak_hash(block) -> int:
+    a = 0
+    b = 0
+    n = len(block)
+    for i, x in enumerate(block):
+        a += x
+        b += (n - i) * x
+    return (a % MOD) | ((b % MOD) << 16)
+
+def signature(content: bytes, block_size: int = None) -> bytes:
+    if block_size is None:
+        block_size = block_size_for(len(content))
+    parts = [SIGNATURE_HEADER.pack(SIGNATURE_MAGIC, block_size, len(content))]
+    for offset in range(0, len(content), block_size):
+        block = content[offset:offset + block_size]
+        parts.append(SIGNATURE_BLOCK.pack(weak_hash(block), strong_hash(block)))
+    return b"".join(parts)
+
+def parse_signature(sig: bytes):
+    if len(sig) < SIGNATURE_HEADER.size:
+        raise DeltaError("signature too short")
+    magic, block_size, length = SIGNATURE_HEADER.unpack_from(sig, 0)
+    if magic != SIGNATURE_MAGIC or block_size == 0:
+        raise DeltaError("bad signature header")
+    block_count = (length + block_size - 1) // block_size
+    if len(sig) != SIGNATURE_HEADER.size + block_count * SIGNATURE_BLOCK.size:
+        raise DeltaError("signature length does not match block count")
+    blocks = [SIGNATURE_BLOCK.unpack_from(sig, SIGNATURE_HEADER.size + i * SIGNATURE_BLOCK.size) for i in range(block_count)]
+    return block_size, length, blocks
+
+def make_delta(sig: bytes, content: bytes) -> bytes:
+    block_size, length, blocks = parse_signature(sig)
+    out = [DELTA_HEADER.pack(DELTA_MAGIC, block_size)]
+
+    # only full-size blocks can match while rolling, a short tail block can only match the end of content.
+    full_blocks = {}
+    for index, (weak, strong) in enumerate(blocks):
+        if (index + 1) * block_size <= length:
+            full_blocks.setdefault(weak, []).append((index, strong))
+    tail = None
+    if length % block_size:
+        tail = (len(blocks) - 1, length % block_size, blocks[-1][1])
+
+    pending_copy = None  # [first_block, count]
+    literal_start = 0
+
+    def flush(upto):
+        nonlocal pending_copy
+        if pending_copy is not None:
+            out.append(OP_HEADER.pack(OP_COPY, *pending_copy))
+            pending_copy = None
+        if upto > literal_start:
+            out.append(OP_DATA_HEADER.pack(OP_DATA, upto - literal_start))
+            out.append(content[literal_start:upto])
+
+    def copy(index):
+        nonlocal pending_copy
+        if pending_copy is not None and literal_start == i and pending_copy[0] + pending_copy[1] == index:
+            pending_copy[1] += 1
+        else:
+            flush(i)
+            pending_copy = [index, 1]
+
+    n = len(content)
+    i = 0
+    weak = None
+    while i + block_size <= n:
+        if weak is None:
+            block = content[i:i + block_size]
+            a = sum(block) % MOD
+            b = sum((block_size - k) * x for k, x in enumerate(block)) % MOD
+        weak = a | (b << 16)
+
+        match = None
+        candidates = full_blocks.get(weak)
+        if candidates:
+            strong = strong_hash(content[i:i + block_size])
+            match = next((index for index, s in candidates if s == strong), None)
+
+        if match is not None:
+            copy(match)
+            i += block_size
+            literal_start = i
+            weak = None
+            continue
+
+        if i + block_size < n:
+            out_byte = content[i]
+            in_byte = content[i + block_size]
+            a = (a - out_byte + in_byte) % MOD
+            b = (b - block_size * out_byte + a) % MOD
+        i += 1
+
+    if tail is not None and n - literal_start >= tail[1]:
+        tail_index, tail_length, tail_strong = tail
+        if strong_hash(content[n - tail_length:]) == tail_strong:
+            flush(n - tail_length)
+            literal_start = n
+            out.append(OP_HEADER.pack(OP_COPY, tail_index, 1))
+    flush(n)
+    return b"".join(out)
+
+def apply_delta(base: bytes, delta: bytes) -> bytes:
+    if len(delta) < DELTA_HEADER.size:
+        raise DeltaError("delta too short")
+    magic, block_size = DELTA_HEADER.unpack_from(delta, 0)
+    if magic != DELTA_MAGIC or block_size == 0:
+        raise DeltaError("bad delta header")
+    view = memoryview(delta)
+    base_view = memoryview(base)
+    parts = []
+    offset = DELTA_HEADER.size
+    while offset < len(delta):
+        op = delta[offset]
+        if op == OP_COPY:
+            if offset + OP_HEADER.size > len(delta):
+                raise DeltaError("copy op is truncated")
+            _, first, count = OP_HEADER.unpack_from(delta, offset)
+            start = first * block_size
+            if start >= len(base) and count > 0:
+                raise DeltaError(f"copy of block {first} is past the end of the base")
+            parts.append(base_view[start:start + count * block_size])
+            offset += OP_HEADER.size
+        elif op == OP_DATA:
+            if offset + OP_DATA_HEADER.size > len(delta):
+                raise DeltaError("data op is truncated")
+            _, length = OP_DATA_HEADER.unpack_from(delta, offset)
+            offset += OP_DATA_HEADER.size
+            if offset + length > len(delta):
+                raise DeltaError("data op is past the end of the delta")
+            parts.append(view[offset:offset + length])
+            offset += length
+        else:
+            raise DeltaError(f"unknown delta op {op}")
+    return b"".join(parts)
@@ -0,0 +1,248 @@
+# sha256 of every loose note, validated by stat instead of re-reading
+#
+# stands in front of a storage.LooseStore with the same interface.  `hashes` only hashes notes whose size or
+# mtime changed since they were last hashed, and it hashes them on a thread pool (sha256 releases the GIL),
+# so a cold /api/status after a restart or a bulk import uses every core instead of one.
+# the index is saved to <notes root>/.hashindex in the background, so a restart starts warm.
+#
+# a note rewritten within the same mtime tick as it was hashed could keep its size and mtime, so entries for
+# notes modified less than RACY_SECONDS before they were hashed aren't kept and get hashed again next time.
+#
+# while watcher.py has inotify watches on the notes root, a repo's hashes are kept current from its events
+# after one full pass, and /api/status is answered without stat-ing every note.
+
+import os
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from kazhttp import log, error
+from storage import hash_file, hash_content, TEMP_SUFFIX
+
+INDEX_NAME = ".hashindex"
+INDEX_VERSION = 1
+RACY_SECONDS = 2
+SAVE_INTERVAL = 5
+BATCH_SIZE = 256  # notes per pool task, so a big repo isn't one future per note
+
+class HashIndex:
+    def __init__(self, root: str, store, workers: int = None):
+        self.path = os.path.join(root, INDEX_NAME)
+        self.store = store
+        self.workers = workers or os.cpu_count() or 1
+        self.pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="hash")
+        self.lock = threading.Lock()
+        self.entries = {}  # repo -> {uuid: (size, mtime_ns, sha256)}
+        self.dirty = False
+
+        # kept by the watcher
+        self.watching = False
+        self.watched = {}  # repo -> {uuid: sha256}, complete and current
+        self.unsettled = {}  # repo -> uuids that changed while the repo's first full pass ran
+        self.writes = {}  # (repo, uuid) -> writes through us, so a slower rehash can't undo a newer write
+
+        # stats
+        self.hits = 0
+        self.hashed = 0
+        self.bytes_hashed = 0
+
+    def __getattr__(self, name):
+        if name == 'store':
+            raise AttributeError(name)
+        return getattr(self.store, name)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'workers': self.workers,
+                'hits': self.hits,
+                'hashed': self.hashed,
+                'bytes_hashed': self.bytes_hashed,
+                'entries': sum(len(table) for table in self.entries.values()),
+            }
+
+    # persistence
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except ValueError as e:
+            log(f"ignoring unreadable hash index {self.path}: {e}")
+            return
+        if data.get('version') != INDEX_VERSION:
+            return
+        with self.lock:
+            self.entries = {repo: {uuid: tuple(entry) for uuid, entry in table.items()} for repo, table in data['repos'].items()}
+        log(f"loaded hash index of {sum(len(table) for table in self.entries.values())} notes from {self.path}")
+
+    def save(self):
+        with self.lock:
+            data = {'version': INDEX_VERSION, 'repos': self.entries}
+            encoded = json.dumps(data).encode()
+            self.dirty = False
+        # no fsync, a lost or torn index is ignored on load and rebuilt
+        temp_path = os.path.join(os.path.dirname(self.path), f".{INDEX_NAME}{TEMP_SUFFIX}")
+        with open(temp_path, 'wb') as f:
+            f.write(encoded)
+        os.replace(temp_path, self.path)
+
+    def start(self):
+        def run():
+            while True:
+                time.sleep(SAVE_INTERVAL)
+                if self.dirty:
+                    try:
+                        self.save()
+                    except Exception as e:
+                        error(f"saving hash index failed: {e}")
+        threading.Thread(target=run, name="hash-index-save", daemon=True).start()
+
+    # hashing
+
+    def _hash_batch(self, repo: str, batch, known):
+        # [(uuid, entry, hashed bytes)] for the notes that still exist, entry is (size, mtime_ns, sha256)
+        results = []
+        for uuid in batch:
+            try:
+                path, st = self.store.locate(repo, uuid)
+                entry = known.get(uuid)
+                if entry is not None and entry[0] == st.st_size and entry[1] == st.st_mtime_ns:
+                    results.append((uuid, entry, None))
+                    continue
+                sha = hash_file(path)
+            except FileNotFoundError:
+                continue  # removed since we listed it
+            results.append((uuid, (st.st_size, st.st_mtime_ns, sha), st.st_size))
+        return results
+
+    def hashes(self, repo: str):
+        with self.lock:
+            if repo in self.watched:
+                self.hits += len(self.watched[repo])
+                return dict(self.watched[repo])
+            watching = self.watching
+            if watching:
+                self.unsettled.setdefault(repo, set())
+        hashes = self._stat_hashes(repo)
+        if watching:
+            self._settle(repo, hashes)
+        return hashes
+
+    def _stat_hashes(self, repo: str):
+        if not os.path.isdir(self.store.repo_path(repo)):
+            return {}
+        uuids = self.store.list(repo)
+        with self.lock:
+            known = self.entries.get(repo, {})
+        batches = [uuids[i:i + BATCH_SIZE] for i in range(0, len(uuids), BATCH_SIZE)]
+        if len(batches) == 1:
+            results = [self._hash_batch(repo, batches[0], known)]
+        else:
+            results = self.pool.map(lambda batch: self._hash_batch(repo, batch, known), batches)
+
+        racy = (time.time() - RACY_SECONDS) * 1e9
+        hashes = {}
+        table = {}
+        hits = hashed = bytes_hashed = 0
+        for batch in results:
+            for uuid, entry, size in batch:
+                hashes[uuid] = entry[2]
+                if size is None:
+                    hits += 1
+                else:
+                    hashed += 1
+                    bytes_hashed += size
+                if entry[1] < racy:
+                    table[uuid] = entry
+        with self.lock:
+            # notes that were removed drop out of the table here too
+            if table != known:
+                self.entries[repo] = table
+                self.dirty = True
+            self.hits += hits
+            self.hashed += hashed
+            self.bytes_hashed += bytes_hashed
+        return hashes
+
+    def _settle(self, repo: str, hashes):
+        # the pass may have looked at a note before a change to it landed, look again before trusting the pass
+        while True:
+            with self.lock:
+                uuids = self.unsettled.get(repo)
+                if not self.watching or uuids is None:
+                    return  # events were lost, or a concurrent pass already settled the repo
+                if not uuids:
+                    del self.unsettled[repo]
+                    self.watched[repo] = dict(hashes)
+                    return
+                self.unsettled[repo] = set()
+            for uuid in uuids:
+                try:
+                    path, _ = self.store.locate(repo, uuid)
+                    hashes[uuid] = hash_file(path)
+                except FileNotFoundError:
+                    hashes.pop(uuid, None)
+
+    def rebuild(self):
+        # rehashes every note from scratch, returns (notes, bytes hashed)
+        with self.lock:
+            self.entries = {}
+            hashed, bytes_hashed = self.hashed, self.bytes_hashed
+        for repo in self.store.repos():
+            self.hashes(repo)
+        with self.lock:
+            return self.hashed - hashed, self.bytes_hashed - bytes_hashed
+
+    # watching
+
+    def watch(self):
+        # the watcher has its watches in place, every change from here on will be refreshed
+        with self.lock:
+            self.watching = True
+
+    def unwatch(self):
+        # events were lost, go back to stat validation until the next full pass of each repo
+        with self.lock:
+            self.watching = False
+            self.watched = {}
+            self.unsettled = {}
+
+    def _changed(self, repo: str, uuid: str, sha):
+        # lock held
+        if repo in self.watched:
+            if sha is None:
+                self.watched[repo].pop(uuid, None)
+            else:
+                self.watched[repo][uuid] = sha
+        elif repo in self.unsettled:
+            self.unsettled[repo].add(uuid)
+
+    def refresh(self, repo: str, uuid: str):
+        # rehashes a note the watcher saw change.  returns (sha256 or None if it's gone, False if a write through
+        # us got there while we were hashing and the result is already stale)
+        with self.lock:
+            writes = self.writes.get((repo, uuid), 0)
+        try:
+            path, _ = self.store.locate(repo, uuid)
+            sha = hash_file(path)
+        except FileNotFoundError:
+            sha = None
+        with self.lock:
+            if self.writes.get((repo, uuid), 0) != writes:
+                return sha, False
+            self._changed(repo, uuid, sha)
+        return sha, True
+
+    def write_many(self, items):
+        self.store.write_many(items)
+        if not self.watching:
+            return
+        shas = [(repo, uuid, hash_content(content)) for repo, uuid, content in items]
+        with self.lock:
+            for repo, uuid, sha in shas:
+                self.writes[(repo, uuid)] = self.writes.get((repo, uuid), 0) + 1
+                self._changed(repo, uuid, sha)
@@ -1,40 +1,593 @@
 from typing import Any, Dict, Tuple, Callable
+from collections import OrderedDict, deque
 import socket
 import os
+import sys
+import atexit
+import bisect
 import ssl
 import json
+import base64
+import hashlib
+import struct
+import zlib
+import math
+import threading
+import time
 from datetime import datetime
 import traceback
+from contextlib import contextmanager
 
 PACKET_READ_SIZE = 65536  # 2 ^ 16
-LISTEN_BACKLOG = 20
+RECV_POOL_BUFFERS = 16  # PACKET_READ_SIZE buffers kept for reading requests into, more are made when they're all lent out
+MAX_REQUEST_HEAD = 1024 * 1024  # request line and headers, long GETs of many notes go past PACKET_READ_SIZE
+LISTEN_BACKLOG = 128  # a burst of reconnects past this waits out a second syn retransmit
+STREAM_HEARTBEAT_SECONDS = 15
+STREAM_MAX_BUFFER = 256 * 1024
+HANDSHAKE_TIMEOUT_SECONDS = 10
+TLS_SESSION_TICKETS = 2  # tickets sent after each full tls 1.3 handshake, each good for one resumption
+MAX_CONNECTIONS = 256  # select() can't watch fds past 1024
+IDLE_TIMEOUT_SECONDS = 60  # keep-alive connections with no request in flight
+REQUEST_TIMEOUT_SECONDS = 10  # to send a whole request, counted from when its connection turns readable
+SEND_TIMEOUT_SECONDS = 10  # for a client to take a whole response, the loop waits on it meanwhile
+TCP_KEEPALIVE = (60, 10, 3)  # idle seconds before probing, seconds between probes, probes before giving up
+SEND_COALESCE_BYTES = 16384  # responses up to this are joined and sent in one write, it's cheaper than gathering them
+SEND_CHUNK_BYTES = 256 * 1024  # per write of a memoryview slice on a tls socket, which has no sendmsg
+IOV_MAX = os.sysconf('SC_IOV_MAX') if hasattr(os, 'sysconf') else 1024
+MAX_QUEUED_REQUESTS = 128  # read and waiting for the loop to answer them
+QUEUE_TARGET_SECONDS = 0.05  # queue delay that's fine, codel's target
+QUEUE_INTERVAL_SECONDS = 0.5  # how long the delay has to stay above target before shedding starts, codel's interval
+MAX_QUEUE_SECONDS = 2  # shed whatever waited this long, overloaded or not
+CLIENT_RATE = 50  # tokens per second per client address, 0 turns the buckets off
+CLIENT_BURST = 200
+MAX_RETRY_AFTER_SECONDS = 30
+
+# logging
+#
+# lines are formatted on the calling thread and queued, a background thread writes whatever has piled up
+# with one write and one flush.  per-request detail goes through debug(), which is a comparison when it's off.
+# failures on our side go through error(), the only lines left at --log-level error.
+# if the queue fills up (stdout is stuck) lines are dropped and counted, the server never waits on its log.
+DEBUG, INFO, ERROR = 10, 20, 40
+LOG_LEVELS = {'debug': DEBUG, 'info': INFO, 'error': ERROR}
+LOG_QUEUE_LINES = 10000
+LOG_BATCH_SECONDS = 0.05
+
+class LogWriter:
+    def __init__(self, out=None, max_lines: int = LOG_QUEUE_LINES):
+        self.out = out
+        self.max_lines = max_lines
+        self.level = INFO
+        self.lock = threading.Lock()
+        self.ready = threading.Condition(self.lock)
+        self.writing = threading.Lock()  # keeps batches in order between the thread and flush()
+        self.lines = []
+        self.dropped = 0
+        self.thread = None
+
+    def put(self, line: str):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+                self.thread.start()
+                atexit.register(self.flush)
+            if len(self.lines) >= self.max_lines:
+                self.dropped += 1
+                return
+            self.lines.append(line)
+            if len(self.lines) == 1:
+                self.ready.notify()
+
+    def _take(self):
+        # lock held
+        lines, self.lines = self.lines, []
+        if self.dropped:
+            lines.append(f"{datetime.now()} dropped {self.dropped} log lines, the log couldn't keep up")
+            self.dropped = 0
+        return lines
+
+    def _write(self, lines):
+        if lines:
+            out = self.out or sys.stdout
+            out.write("\n".join(lines) + "\n")
+            out.flush()
+
+    def _run(self):
+        while True:
+            with self.lock:
+                self.ready.wait_for(lambda: self.lines)
+            time.sleep(LOG_BATCH_SECONDS)  # let the rest of the burst catch up
+            with self.writing:
+                with self.lock:
+                    lines = self._take()
+                try:
+                    self._write(lines)
+                except Exception:
+                    pass  # nowhere left to say so
+
+    def flush(self):
+        with self.writing:
+            with self.lock:
+                lines = self._take()
+            self._write(lines)
+
+log_writer = LogWriter()
+
+def set_log_level(name: str):
+    log_writer.level = LOG_LEVELS[name]
 
 def log(*k):
-    print(datetime.now(), *k, flush=True)
+    if log_writer.level <= INFO:
+        log_writer.put(" ".join(map(str, (datetime.now(),) + k)))
+
+def debug(*k):
+    if log_writer.level <= DEBUG:
+        log_writer.put(" ".join(map(str, (datetime.now(),) + k)))
+
+def error(*k):
+    # something failed on our side, logged at every level
+    if log_writer.level <= ERROR:
+        log_writer.put(" ".join(map(str, (datetime.now(), "ERROR:") + k)))
+
+# access log
+#
+# with an access log, `run` writes one json line per request, and one per tls handshake, through its own
+# LogWriter, so it costs the loop a json.dumps.  times are milliseconds.  see access_report.py
+#   {"ts", "method", "route", "status", "in", "out", "recv_ms", "parse_ms", "handler_ms", "send_ms", "keep_alive"}
+#   {"ts", "tls_ms", "resumed"}
+access_writer = None
+
+def open_access_log(path: str):
+    global access_writer
+    access_writer = LogWriter(out=open(path, 'a', buffering=1024 * 1024))
+
+def access(record: dict):
+    if access_writer is not None:
+        record['ts'] = round(time.time(), 3)
+        access_writer.put(json.dumps(record))
+
+def route_of(path: str) -> str:
+    # the endpoint without the note or repo it's about, so records group by what was asked for
+    path = path.split('?', 1)[0]
+    if path.startswith('/api/'):
+        return '/'.join(path.split('/', 4)[:3])
+    return path
+
+def ms(seconds: float) -> float:
+    return round(seconds * 1000, 3)
+
+# metrics
+#
+# counters and fixed-bucket histograms, rendered in prometheus' text format for /api/metrics.  request metrics are
+# only updated from `run`'s loop thread, which also renders them, so they're plain ints in dicts and nothing
+# takes a lock.  numbers kept by other parts of the server (the hash index, the cache) are read by callbacks
+# when the metrics are rendered.
+# a metric keeps at most MAX_SERIES label sets, past that they're counted under "other", so clients asking
+# for made-up paths can't grow it without bound.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+MAX_SERIES = 500
+
+def _labels(names, values) -> str:
+    if not names:
+        return ""
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in values)
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(names, escaped)) + "}"
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name: str, help: str, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}  # label values -> count
+
+    def _key(self, values):
+        if values in self.values or len(self.values) < MAX_SERIES:
+            return values
+        return ('other',) * len(values)
+
+    def inc(self, *values, amount=1):
+        key = self._key(values)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def lines(self):
+        for values, count in self.values.items():
+            yield f"{self.name}{_labels(self.labels, values)} {count}"
+
+class Histogram(Counter):
+    kind = 'histogram'
+
+    def __init__(self, name: str, help: str, buckets, labels=()):
+        super().__init__(name, help, labels)
+        self.buckets = buckets  # values: label values -> [count per bucket ..., count past the last, sum]
+
+    def observe(self, value: float, *values):
+        key = self._key(values)
+        counts = self.values.get(key)
+        if counts is None:
+            counts = self.values[key] = [0] * (len(self.buckets) + 2)
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def lines(self):
+        for values, counts in self.values.items():
+            total = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                total += count
+                yield f"{self.name}_bucket{_labels(self.labels + ('le',), values + (bound,))} {total}"
+            yield f"{self.name}_sum{_labels(self.labels, values)} {counts[-1]}"
+            yield f"{self.name}_count{_labels(self.labels, values)} {total}"
+
+class Callback:
+    # a counter or gauge read when the metrics are rendered.  `read` returns a number, or with labels,
+    # a dict of label values -> number
+    def __init__(self, name: str, help: str, kind: str, read, labels=()):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.read = read
+        self.labels = labels
+
+    def lines(self):
+        value = self.read()
+        if value is None:
+            return
+        if not self.labels:
+            value = {(): value}
+        for values, number in value.items():
+            yield f"{self.name}{_labels(self.labels, values)} {number}"
+
+class Metrics:
+    def __init__(self):
+        self.metrics = {}  # name -> metric
+
+    def _add(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, labels=()) -> Counter:
+        return self._add(Counter(name, help, labels))
+
+    def histogram(self, name: str, help: str, buckets, labels=()) -> Histogram:
+        return self._add(Histogram(name, help, buckets, labels))
+
+    def callback(self, name: str, help: str, kind: str, read, labels=()) -> Callback:
+        return self._add(Callback(name, help, kind, read, labels))
+
+    def render(self) -> bytes:
+        lines = []
+        for metric in self.metrics.values():
+            try:
+                samples = list(metric.lines())
+            except Exception as e:
+                error(f"reading metric {metric.name} failed: {e}")
+                continue
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(samples)
+        return ("\n".join(lines) + "\n").encode()
+
+metrics = Metrics()
+requests_total = metrics.counter('kaz_requests_total', "Requests answered", ('method', 'route', 'status'))
+request_seconds = metrics.histogram('kaz_request_duration_seconds', "Time from reading a request to having sent the response", LATENCY_BUCKETS, ('route', 'status'))
+response_bytes = metrics.histogram('kaz_response_size_bytes', "Bytes sent per response, headers included", SIZE_BUCKETS, ('route',))
+keepalive_reused = metrics.counter('kaz_keepalive_reused_total', "Requests that came in on a connection that had already answered one")
+handshake_seconds = metrics.histogram('kaz_tls_handshake_duration_seconds', "Time from accepting a connection to finishing its tls handshake", LATENCY_BUCKETS, ('resumed',))
+queue_seconds = metrics.histogram('kaz_request_queue_seconds', "Time a request waited to be answered after it was read", LATENCY_BUCKETS)
+
+def count_request(method: str, route: str, status: int, bytes_out: int, seconds: float):
+    requests_total.inc(method, route, status)
+    request_seconds.observe(seconds, route, status)
+    response_bytes.observe(bytes_out, route)
+
+def _time_left(connection: socket.socket, deadline):
+    # sets the socket's timeout to what's left until `deadline`, a write that can't finish by then raises socket.timeout
+    if deadline is None:
+        return
+    left = deadline - time.monotonic()
+    if left <= 0:
+        raise socket.timeout("send deadline passed")
+    connection.settimeout(left)
+
+def send_buffers(connection: socket.socket, buffers, deadline: float = None) -> int:
+    # writes `buffers` in order without joining them.  a plain socket gathers them with sendmsg, a tls one
+    # (sendmsg isn't implemented for it) gets each buffer in memoryview slices, neither copies the data.
+    # with a `deadline` (time.monotonic()) the socket is left with a timeout, the caller puts it back
+    total = sum(len(buffer) for buffer in buffers)
+    if total <= SEND_COALESCE_BYTES:
+        _time_left(connection, deadline)
+        connection.sendall(b"".join(buffers))
+        return total
+    if isinstance(connection, ssl.SSLSocket) or not hasattr(connection, 'sendmsg'):
+        for buffer in buffers:
+            view = memoryview(buffer).cast('B')
+            for start in range(0, len(view), SEND_CHUNK_BYTES):
+                _time_left(connection, deadline)
+                connection.sendall(view[start:start + SEND_CHUNK_BYTES])
+        return total
+    views = [memoryview(buffer).cast('B') for buffer in buffers if len(buffer)]
+    while views:
+        _time_left(connection, deadline)
+        sent = connection.sendmsg(views[:IOV_MAX])
+        # drop what went out, a partly sent buffer continues from where it stopped
+        done = 0
+        while done < len(views) and sent >= len(views[done]):
+            sent -= len(views[done])
+            done += 1
+        del views[:done]
+        if sent:
+            views[0] = views[0][sent:]
+    return total
 
 class KazHttpResponse:
-    def __init__(self, status: bytes, body: bytes, mimetype: bytes = b"text/plain", keep_alive: bool = False, extra_headers: bytes = b""):
+    # `body` is bytes, or a list of bytes-like pieces that are written one after another without being joined,
+    # so a handler can put a large response together from buffers it already has
+    def __init__(self, status: bytes, body, mimetype: bytes = b"text/plain", keep_alive: bool = False, extra_headers: bytes = b""):
         self.status = status
         self.mimetype = mimetype
         self.body = body
         self.keep_alive = keep_alive
         self.extra_headers = extra_headers
-    
-    def to_bytes(self):
+
+    def body_pieces(self) -> list:
+        return self.body if isinstance(self.body, list) else [self.body]
+
+    def content_length(self) -> int:
+        return sum(len(piece) for piece in self.body_pieces())
+
+    def body_bytes(self) -> bytes:
+        # the body in one piece, for when it has to be
+        return b"".join(self.body) if isinstance(self.body, list) else self.body
+
+    def header_bytes(self) -> bytes:
         return (
             b"HTTP/1.1 " + self.status + b"\r\n"
             + (b"Connection: keep-alive\n" if self.keep_alive else b"Connection: close\r\n")
             + b"Content-Type: " + self.mimetype + b"; charset=utf-8\r\n"
             + self.extra_headers
-            + b"Content-Length: " + str(len(self.body)).encode() + b"\r\n"
-            + b"\r\n"
-            + self.body)
-
-    def write_to(self, connection: socket.socket):
-        response_bytes = self.to_bytes()
-        log("sending", len(response_bytes), "bytes")
-        connection.sendall(response_bytes)
-    
+            + b"Content-Length: " + str(self.content_length()).encode() + b"\r\n"
+            + b"\r\n")
+
+    def to_bytes(self):
+        return self.header_bytes() + self.body_bytes()
+
+    def write_to(self, connection: socket.socket, deadline: float = None) -> int:
+        buffers = [self.header_bytes()] + self.body_pieces()
+        sent = send_buffers(connection, buffers, deadline)
+        debug("sent", sent, "bytes in", len(buffers), "buffers")
+        return sent
+
+class KazStream:
+    # a connection that stays open after the handler returns, `run` keeps it in its select loop.
+    # `write` can be called from any thread: bytes are buffered and written out as the socket takes them.
+    # a client that lets more than `max_buffer` bytes pile up is disconnected.
+    def __init__(self, extra_headers: bytes = b"", max_buffer: int = STREAM_MAX_BUFFER):
+        self.extra_headers = extra_headers
+        self.max_buffer = max_buffer
+        self.lock = threading.Lock()
+        self.buffer = bytearray()
+        self.closed = False
+        self.last_write = time.monotonic()
+        self.on_close = None  # called once the connection is gone
+        self.wake = None  # set by `run`, tells the loop there's something to write
+        self.submit = None  # set by `run`, see queue_request
+
+    def header_bytes(self) -> bytes:
+        raise NotImplementedError
+
+    def received(self, data: bytes):
+        # bytes the client sent after the headers
+        pass
+
+    def heartbeat(self):
+        # called when nothing was written for STREAM_HEARTBEAT_SECONDS
+        pass
+
+    def queue_request(self, request: dict, answer):
+        # hands a request that came in over the stream to `run`'s admission control, so it waits in the same queue
+        # with the same priority and client tokens as one read off a connection.  answer(request, shed) is called from
+        # the loop when its turn comes, with shed None or the 503/429 response to send instead of handling it.
+        if self.submit is None:
+            answer(request, None)
+        else:
+            self.submit(request, answer)
+
+    def write(self, chunk: bytes) -> bool:
+        with self.lock:
+            if self.closed:
+                return False
+            if len(self.buffer) + len(chunk) > self.max_buffer:
+                log(f"{type(self).__name__}: client isn't keeping up, disconnecting it")
+                self.closed = True
+                self.buffer.clear()
+            else:
+                self.buffer += chunk
+            wake = self.wake
+        if wake is not None:
+            wake()
+        return not self.closed
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            wake = self.wake
+        if wake is not None:
+            wake()
+
+    def wants_write(self) -> bool:
+        with self.lock:
+            return bool(self.buffer) or self.closed
+
+    def flush_to(self, connection: socket.socket) -> bool:
+        # writes what the socket takes without blocking, returns False once the stream is done
+        with self.lock:
+            while self.buffer:
+                try:
+                    sent = connection.send(self.buffer)
+                except (BlockingIOError, ssl.SSLWantWriteError, ssl.SSLWantReadError):
+                    return True
+                del self.buffer[:sent]
+                self.last_write = time.monotonic()
+            return not self.closed
+
+class KazEventStream(KazStream):
+    # a server-sent events response.  EventSource reconnects with the last event id it got after a
+    # disconnect, so a client that fell behind can pick up where it left off.
+    def header_bytes(self) -> bytes:
+        return (
+            b"HTTP/1.1 200 OK\r\n"
+            + b"Content-Type: text/event-stream; charset=utf-8\r\n"
+            + b"Cache-Control: no-cache\r\n"
+            + b"Connection: keep-alive\r\n"
+            + self.extra_headers
+            + b"\r\n")
+
+    def heartbeat(self):
+        self.write(b": heartbeat\n\n")
+
+    def send(self, data: str, event: str = None, id: int = None) -> bool:
+        lines = []
+        if event is not None:
+            lines.append("event: " + event)
+        if id is not None:
+            lines.append(f"id: {id}")
+        lines.extend("data: " + line for line in data.split("\n"))
+        return self.write(("\n".join(lines) + "\n\n").encode())
+
+WEBSOCKET_GUID = b"258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+WEBSOCKET_MAX_MESSAGE = 16 * 1024 * 1024
+WS_CONTINUATION, WS_TEXT, WS_BINARY, WS_CLOSE, WS_PING, WS_PONG = 0x0, 0x1, 0x2, 0x8, 0x9, 0xA
+WS_CLOSE_NORMAL, WS_CLOSE_PROTOCOL_ERROR, WS_CLOSE_TOO_BIG = 1000, 1002, 1009
+
+def websocket_accept(key: str) -> bytes:
+    return base64.b64encode(hashlib.sha1(key.encode() + WEBSOCKET_GUID).digest())
+
+def websocket_frame(opcode: int, payload: bytes) -> bytes:
+    # server frames are never masked or fragmented
+    length = len(payload)
+    if length < 126:
+        header = struct.pack(">BB", 0x80 | opcode, length)
+    elif length < 65536:
+        header = struct.pack(">BBH", 0x80 | opcode, 126, length)
+    else:
+        header = struct.pack(">BBQ", 0x80 | opcode, 127, length)
+    return header + payload
+
+def websocket_unmask(mask: bytes, payload: bytes) -> bytes:
+    # xor as one big integer instead of byte by byte
+    if not payload:
+        return b""
+    repeated = (mask * (len(payload) // 4 + 1))[:len(payload)]
+    return (int.from_bytes(payload, 'little') ^ int.from_bytes(repeated, 'little')).to_bytes(len(payload), 'little')
+
+class KazWebSocket(KazStream):
+    # RFC 6455 on top of a request that asked to upgrade.  `on_message(websocket, opcode, payload)` is called
+    # from the loop for each complete text or binary message, control frames are handled here.
+    def __init__(self, key: str, on_message, extra_headers: bytes = b"", max_buffer: int = 2 * WEBSOCKET_MAX_MESSAGE):
+        super().__init__(extra_headers, max_buffer)
+        self.key = key
+        self.on_message = on_message
+        self.incoming = bytearray()
+        self.fragments = []
+        self.fragments_opcode = None
+        self.fragments_size = 0
+
+    def header_bytes(self) -> bytes:
+        return (
+            b"HTTP/1.1 101 Switching Protocols\r\n"
+            + b"Upgrade: websocket\r\n"
+            + b"Connection: Upgrade\r\n"
+            + b"Sec-WebSocket-Accept: " + websocket_accept(self.key) + b"\r\n"
+            + self.extra_headers
+            + b"\r\n")
+
+    def heartbeat(self):
+        self.write(websocket_frame(WS_PING, b""))
+
+    def send_text(self, text: str) -> bool:
+        return self.write(websocket_frame(WS_TEXT, text.encode('utf-8')))
+
+    def send_binary(self, data: bytes) -> bool:
+        return self.write(websocket_frame(WS_BINARY, data))
+
+    def close_with(self, code: int, reason: str = ""):
+        self.write(websocket_frame(WS_CLOSE, struct.pack(">H", code) + reason.encode('utf-8')[:120]))
+        self.close()
+
+    def received(self, data: bytes):
+        self.incoming += data
+        while not self.closed:
+            frame = self._next_frame()
+            if frame is None:
+                return
+            self._handle_frame(*frame)
+
+    def _next_frame(self):
+        # (fin, opcode, payload) of the first complete frame, or None if we need more bytes
+        data = self.incoming
+        if len(data) < 2:
+            return None
+        fin, opcode = data[0] & 0x80, data[0] & 0x0F
+        masked, length = data[1] & 0x80, data[1] & 0x7F
+        offset = 2
+        if length == 126:
+            if len(data) < 4:
+                return None
+            length, = struct.unpack_from(">H", data, 2)
+            offset = 4
+        elif length == 127:
+            if len(data) < 10:
+                return None
+            length, = struct.unpack_from(">Q", data, 2)
+            offset = 10
+        if not masked:
+            self.close_with(WS_CLOSE_PROTOCOL_ERROR, "client frames must be masked")
+            return None
+        if length > WEBSOCKET_MAX_MESSAGE:
+            self.close_with(WS_CLOSE_TOO_BIG)
+            return None
+        if len(data) < offset + 4 + length:
+            return None
+        mask = bytes(data[offset:offset + 4])
+        payload = websocket_unmask(mask, bytes(data[offset + 4:offset + 4 + length]))
+        del data[:offset + 4 + length]
+        return fin, opcode, payload
+
+    def _handle_frame(self, fin: int, opcode: int, payload: bytes):
+        if opcode == WS_CLOSE:
+            code = payload[:2] if len(payload) >= 2 else struct.pack(">H", WS_CLOSE_NORMAL)
+            self.write(websocket_frame(WS_CLOSE, code))
+            self.close()
+        elif opcode == WS_PING:
+            self.write(websocket_frame(WS_PONG, payload))
+        elif opcode == WS_PONG:
+            pass
+        elif opcode in (WS_TEXT, WS_BINARY, WS_CONTINUATION):
+            if opcode != WS_CONTINUATION:
+                if self.fragments_opcode is not None:
+                    self.close_with(WS_CLOSE_PROTOCOL_ERROR, "expected a continuation frame")
+                    return
+                self.fragments_opcode = opcode
+            elif self.fragments_opcode is None:
+                self.close_with(WS_CLOSE_PROTOCOL_ERROR, "continuation without a message")
+                return
+            self.fragments.append(payload)
+            self.fragments_size += len(payload)
+            if self.fragments_size > WEBSOCKET_MAX_MESSAGE:
+                self.close_with(WS_CLOSE_TOO_BIG)
+                return
+            if fin:
+                message_opcode, message = self.fragments_opcode, b"".join(self.fragments)
+                self.fragments, self.fragments_opcode, self.fragments_size = [], None, 0
+                self.on_message(self, message_opcode, message)
+        else:
+            self.close_with(WS_CLOSE_PROTOCOL_ERROR, "unknown opcode")
+
+def is_websocket_upgrade(headers: Dict[str, str]) -> bool:
+    return headers.get('upgrade', '').lower() == 'websocket' and 'sec-websocket-key' in headers
+
 class KazHttpRequest:
     def __init__(self, method: str, path: str, headers: Dict[str, str], body: bytes):
         self.method = method
@@ -42,100 +595,626 @@ class KazHttpRequest:
         self.headers = headers
         self.body = body
 
+# routing
+#
+# routes are a method and a pattern like "/api/get/<repo>/<uuids:path>", compiled once into a trie of path
+# segments, so matching a request is a dict probe per segment instead of a startswith per route.
+#   <name> matches one non-empty segment, <name:int> one that's an integer (passed as an int),
+#   <name:path> the rest of the path, slashes included.
+# a literal segment is tried before a parameter in the same place.  the query string isn't part of the match.
+# routes without parameters also go in a flat table keyed by the whole path, most requests never walk the trie.
+# neither do requests for a route that's the only one of its method under its literal prefix, like
+# "/api/get/<repo>/<uuids:path>": its prefix is looked up and the parameters are split off the rest.
+ROUTE_CONVERTERS = {'str': str, 'int': int}
+
+class _RouteNode:
+    __slots__ = ('children', 'param', 'rest', 'handlers')
+
+    def __init__(self):
+        self.children = {}  # literal segment -> _RouteNode
+        self.param = None  # (name, converter, _RouteNode)
+        self.rest = None  # (name, {method: (handler, pattern)})
+        self.handlers = {}  # method -> (handler, pattern)
+
+class Router:
+    def __init__(self):
+        self.root = _RouteNode()
+        self.exact = {}  # (method, path with one leading slash and no trailing one) -> (handler, pattern)
+        self.added = []  # (method, segments, handler, pattern)
+        self.prefixed = {}  # method -> {"/literal/prefix/": the one route under it}, see _build_prefixed
+        self.prefix_lengths = []  # segments in those prefixes
+
+    def add(self, method: str, pattern: str, handler):
+        segments = pattern.strip('/').split('/')
+        self._add_to_trie(method, pattern, segments, handler)
+        self.added.append((method, segments, handler, pattern))
+        self._build_prefixed()
+
+    def _add_to_trie(self, method: str, pattern: str, segments, handler):
+        node = self.root
+        if '<' not in pattern:
+            self.exact[(method, '/' + pattern.strip('/'))] = (handler, pattern)
+        for i, segment in enumerate(segments):
+            if segment.startswith('<') and segment.endswith('>'):
+                name, _, kind = segment[1:-1].partition(':')
+                if kind == 'path':
+                    assert i == len(segments) - 1, f"<{name}:path> has to be last in {pattern}"
+                    if node.rest is None:
+                        node.rest = (name, {})
+                    assert node.rest[0] == name, f"{pattern} names the rest of the path differently than another route"
+                    node.rest[1][method] = (handler, pattern)
+                    return
+                if node.param is None:
+                    node.param = (name, ROUTE_CONVERTERS[kind or 'str'], _RouteNode())
+                assert node.param[:2] == (name, ROUTE_CONVERTERS[kind or 'str']), f"{pattern} conflicts with another route's <{node.param[0]}>"
+                node = node.param[2]
+            else:
+                node = node.children.setdefault(segment, _RouteNode())
+        node.handlers[method] = (handler, pattern)
+
+    def route(self, method: str, pattern: str):
+        # decorator form of `add`
+        def register(handler):
+            self.add(method, pattern, handler)
+            return handler
+        return register
+
+    def _build_prefixed(self):
+        # a route is only looked up by its literal prefix if it's all parameters after it, and no other route of its
+        # method continues that prefix (the trie would try that one's literals first)
+        prefixed = {}
+        for method, segments, handler, pattern in self.added:
+            literal = next((i for i, segment in enumerate(segments) if segment.startswith('<')), len(segments))
+            if literal == 0 or literal == len(segments) or any(not segment.startswith('<') for segment in segments[literal:]):
+                continue
+            if any(other_method == method and other is not segments and len(other) > literal and other[:literal] == segments[:literal]
+                   for other_method, other, _, _ in self.added):
+                continue
+            names, converters = [], []
+            for segment in segments[literal:]:
+                name, _, kind = segment[1:-1].partition(':')
+                names.append(name)
+                converters.append(None if kind in ('', 'str', 'path') else ROUTE_CONVERTERS[kind])
+            rest = segments[-1].endswith(':path>')
+            # handler, pattern, param names, their converters (None if they're all strings), splits of what follows the prefix
+            prefixed.setdefault(method, {})['/' + '/'.join(segments[:literal]) + '/'] = (
+                handler, pattern, names, converters if any(converters) else None, len(names) - 1 if rest else -1)
+        self.prefixed = prefixed
+        # a path can't have two prefixes of the same method, the shorter one's route would be continued by the longer
+        # one's.  the longer ones are the api and go first
+        self.prefix_lengths = sorted({prefix.count('/') - 1 for table in prefixed.values() for prefix in table}, reverse=True)
+
+    def match(self, method: str, path: str):
+        # (handler, pattern, params) or None
+        found = self.exact.get((method, path))
+        if found is not None:
+            return found[0], found[1], {}
+        table = self.prefixed.get(method)
+        if table is not None and '?' not in path:
+            # "/api/get/..." -> "/api/get/", for each number of segments a literal prefix has.  a path with a query
+            # string or empty segments takes the long way below
+            for length in self.prefix_lengths:
+                end = 0
+                for _ in range(length):
+                    end = path.find('/', end + 1)
+                found = table.get(path[:end + 1])
+                if found is None:
+                    continue
+                handler, pattern, names, converters, splits = found
+                values = path[end + 1:].split('/', splits)
+                if len(values) != len(names) or '' in values or values[-1][0] == '/' or values[-1][-1] == '/':
+                    break
+                if converters is not None:
+                    try:
+                        values = [value if convert is None else convert(value) for convert, value in zip(converters, values)]
+                    except ValueError:
+                        break
+                params = {}
+                i = 0
+                for name in names:
+                    params[name] = values[i]
+                    i += 1
+                return handler, pattern, params
+
+        path = path.split('?', 1)[0].strip('/')
+        found = self.exact.get((method, '/' + path))
+        if found is not None:
+            return found[0], found[1], {}
+
+        # follow literal segments as far as they go, remembering the nodes where a parameter could have matched
+        # instead.  at a dead end, back up to the last of those and try its <param>, then its <rest:path>
+        segments = path.split('/')
+        params = []  # (name, value) on the way down
+        pending = []  # (node, segment index, len(params) there, 0 if its param is untried or 1 if only its rest is)
+        node, i = self.root, 0
+        while True:
+            if i == len(segments):
+                found = node.handlers.get(method)
+                if found is not None:
+                    return found[0], found[1], dict(params)
+            else:
+                segment = segments[i]
+                if segment and (node.param is not None or node.rest is not None):
+                    pending.append((node, i, len(params), 0))
+                child = node.children.get(segment)
+                if child is not None:
+                    node, i = child, i + 1
+                    continue
+            while pending:
+                base, i, depth, stage = pending.pop()
+                del params[depth:]
+                segment = segments[i]
+                if stage == 0 and base.param is not None:
+                    pending.append((base, i, depth, 1))
+                    name, convert, child = base.param
+                    try:
+                        params.append((name, convert(segment)))
+                    except ValueError:
+                        continue
+                    node, i = child, i + 1
+                    break
+                if base.rest is not None:
+                    name, handlers = base.rest
+                    found = handlers.get(method)
+                    if found is not None:
+                        params.append((name, '/'.join(segments[i:])))
+                        return found[0], found[1], dict(params)
+            else:
+                return None
+
+# server timing
+#
+# `run` collects where each request's time went and sends it back as a Server-Timing header on /api responses,
+# so a client can tell the server's time from the network's.  handlers mark their expensive parts with
+# `with timed('disk'):` and the like, timings are per thread so work done elsewhere isn't charged to the request
+_timings = threading.local()
+
+def begin_timing():
+    _timings.current = {}
+
+def end_timing() -> dict:
+    phases, _timings.current = getattr(_timings, 'current', None) or {}, None
+    return phases
+
+@contextmanager
+def timed(phase: str):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        phases = getattr(_timings, 'current', None)
+        if phases is not None:
+            phases[phase] = phases.get(phase, 0) + time.perf_counter() - started
+
+def add_server_timing(response: KazHttpResponse, phases: dict):
+    entries = ", ".join(f"{phase};dur={seconds * 1000:.3f}" for phase, seconds in phases.items())
+    response.extra_headers = response.extra_headers + b"Server-Timing: " + entries.encode() + b"\r\n"
 
 def HTTP_OK(body: bytes, mimetype: bytes, keep_alive: bool = False, extra_headers=b"") -> bytes:
     return KazHttpResponse(b"200 OK", body, keep_alive=keep_alive, mimetype=mimetype, extra_headers=extra_headers)
 
 def HTTP_OK_JSON(obj: Any, extra_header=b"", keep_alive: bool = False) -> bytes:
-    return KazHttpResponse(b"200 OK", json.dumps(obj).encode('utf-8'), mimetype=b"application/json", keep_alive=keep_alive, extra_headers=extra_header)
+    with timed('encode'):
+        body = json.dumps(obj).encode('utf-8')
+    return KazHttpResponse(b"200 OK", body, mimetype=b"application/json", keep_alive=keep_alive, extra_headers=extra_header)
 
 def HTTP_NOT_FOUND(msg: bytes, keep_alive: bool = False) -> bytes:
     return KazHttpResponse(b"404 NOT_FOUND", b"HTTP 404: " + msg + b"\n", keep_alive=keep_alive, mimetype=b"text/plain")
 
+def HTTP_BAD_REQUEST(msg: bytes, keep_alive: bool = False) -> bytes:
+    return KazHttpResponse(b"400 BAD_REQUEST", b"HTTP 400: " + msg + b"\n", keep_alive=keep_alive, mimetype=b"text/plain")
+
+def HTTP_CONFLICT(msg: bytes, keep_alive: bool = False, extra_headers=b"") -> bytes:
+    return KazHttpResponse(b"409 CONFLICT", b"HTTP 409: " + msg + b"\n", keep_alive=keep_alive, mimetype=b"text/plain", extra_headers=extra_headers)
+
+def accepts_gzip(headers: Dict[str, str]) -> bool:
+    return 'gzip' in headers.get('accept-encoding', '')
+
+GZIP_HEADER = b"\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff"
+DEFLATE_END = b"\x03\x00"  # an empty final block
+
+def deflate_piece(data: bytes) -> bytes:
+    # compresses `data` into byte-aligned deflate blocks that can be spliced between other pieces' blocks
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+def gzip_pieces(pieces, data) -> list:
+    # one gzip stream out of deflate_piece outputs, without compressing anything again, as a list of buffers
+    # for a response body.
+    # the trailer's crc32 covers the whole stream, so it's computed over `data`, the same pieces uncompressed
+    # and in the same order, which is far cheaper than deflating them.
+    crc = 0
+    length = 0
+    for piece in data:
+        crc = zlib.crc32(piece, crc)
+        length += len(piece)
+    return [GZIP_HEADER, *pieces, DEFLATE_END, struct.pack("<II", crc, length & 0xffffffff)]
+
 def allow_cors_for_localhost(headers: Dict[str, str]):
     if 'Origin' in headers:
-        log(headers['Origin'])
+        debug(headers['Origin'])
         if 'localhost' == headers['Origin'].split("//", 1)[1].split(":", 1)[0]:
             return b"Access-Control-Allow-Origin: " + headers['Origin'].encode() + b"\n"
     return b""
 
-def receive_headers_and_content(client_connection: socket.socket) -> Dict[str, Any]:
+class BufferPool:
+    # reusable receive buffers.  a connection borrows one while it reads a request and gives it back after, so
+    # reading doesn't allocate one per recv, and idle keep-alive connections don't each hold one
+    def __init__(self, size: int = PACKET_READ_SIZE, count: int = RECV_POOL_BUFFERS):
+        self.size = size
+        self.count = count
+        self.lock = threading.Lock()
+        self.free = []
+        self.created = 0
+        self.reused = 0
+
+    def acquire(self) -> bytearray:
+        with self.lock:
+            if self.free:
+                self.reused += 1
+                return self.free.pop()
+            self.created += 1
+        return bytearray(self.size)
+
+    def release(self, buffer: bytearray):
+        # a buffer that grew for a long request isn't kept
+        with self.lock:
+            if len(buffer) == self.size and len(self.free) < self.count:
+                self.free.append(buffer)
+
+    def stats(self):
+        with self.lock:
+            return {'created': self.created, 'reused': self.reused, 'free': len(self.free)}
+
+recv_buffers = BufferPool()
+metrics.callback('kaz_recv_buffers_total', "Receive buffers lent out to read a request, newly made or reused from the pool", 'counter',
+                 lambda: {('created',): recv_buffers.created, ('reused',): recv_buffers.reused}, ('source',))
+
+def find_head_end(buffer: bytearray, start: int, end: int):
+    # (index of the blank line after the headers, its length), or (-1, 0) if it isn't in buffer[start:end] yet
+    found = buffer.find(b"\r\n\r\n", start, end)
+    if found >= 0:
+        return found, 4
+    found = buffer.find(b"\n\n", start, end)
+    return found, 2 if found >= 0 else 0
+
+# the only headers anything here looks at, the rest of the head is skipped over without being decoded
+READ_HEADERS = frozenset([b'connection', b'content-length', b'accept-encoding', b'origin', b'upgrade', b'sec-websocket-key',
+                          b'x-forwarded-for', b'last-event-id', b'x-base-hash', b'x-hash'])
+
+def parse_headers(buffer: bytearray, start: int, end: int, wanted: frozenset = READ_HEADERS) -> Dict[str, str]:
+    # the `wanted` header lines in buffer[start:end], keys lowercased.  only their values get decoded
+    headers = {}
+    with memoryview(buffer) as view:
+        while start < end:
+            line_end = buffer.find(b"\n", start, end)
+            if line_end < 0:
+                line_end = end
+            colon = buffer.find(b":", start, line_end)
+            if colon > start:
+                name = bytes(view[start:colon]).strip().lower()
+                if name in wanted:
+                    headers[name.decode('ascii')] = str(view[colon + 1:line_end], 'utf-8', 'replace').strip()
+            start = line_end + 1
+    return headers
+
+class RequestError(Exception):
+    # the request can't be read, the connection has to be closed
+    pass
+
+def _recv_into(connection: socket.socket, view: memoryview):
+    # bytes received, 0 once the client closed, None if there's nothing to read right now
     try:
-        request_data = client_connection.recv(PACKET_READ_SIZE)
-        log("received", len(request_data), "bytes")
-    except socket.timeout:
-        log('timeout before receiving data')
-        return None
-    
-    if len(request_data) == 0:
-        log('no data received')
+        return connection.recv_into(view)
+    except (BlockingIOError, ssl.SSLWantReadError, ssl.SSLWantWriteError):
         return None
 
-    if len(request_data) == PACKET_READ_SIZE and request_data.startswith(b"GET "):  # only support long 'GET's for now
-        log('MORE: requesting more')
-        while True:  # TODO make this a generator and only get more when we actually need it
-            more = client_connection.recv(PACKET_READ_SIZE)
-            log('received', len(more), 'bytes')
-            log("got MORE:\n", more)
-            request_data += more
-            if request_data.startswith(b"GET ") and request_data.endswith(b"\r\n\r\n"):
-                log('got all the data')
-                break
-            if len(more) == 0:
-                break
-    try:
-        first_line, rest = request_data.split(b'\n', 1)
-    except ValueError as e:
-        log("ERROR: couldn't split request_data into first_line and rest:", request_data)
-        raise e
+class RequestReader:
+    # reads one request off a nonblocking socket as it arrives.  `run` calls `receive` whenever select says the
+    # socket is readable, so a client sending its request slowly costs the loop a few recvs instead of a wait.
+    # the head is read with recv_into straight into a buffer borrowed from `buffers`, grown in place if the headers
+    # don't fit, and parsed there.  the body then goes into its own buffer.  `run` closes the connection if the
+    # whole request isn't in by `deadline`, however it trickles in.
+    def __init__(self, deadline: float, buffers: BufferPool = recv_buffers):
+        self.deadline = deadline
+        self.buffers = buffers
+        self.buffer = buffers.acquire()
+        self.filled = 0
+        self.request = None  # once the head is parsed
+        self.body = None
+        self.body_filled = 0
+        self.started = None  # first byte
+        self.parse_seconds = 0.0
 
-    log(first_line)
-    first_line = first_line.decode("utf-8")
-    parts = first_line.split()
+    def release(self):
+        if self.buffer is not None:
+            self.buffers.release(self.buffer)
+            self.buffer = None
 
-    if len(parts) != 3:
-        return HTTP_NOT_FOUND(b"bad request line: " + first_line.encode())
+    def receive(self, connection: socket.socket) -> Dict[str, Any]:
+        # the request once all of it is in, None until then.  raises RequestError if it can't be read
+        while True:
+            if self.request is not None:
+                if self.body_filled == len(self.body):
+                    return self._complete()
+                with memoryview(self.body) as view:
+                    received = _recv_into(connection, view[self.body_filled:])
+                if received is None:
+                    return None
+                if received == 0:
+                    raise RequestError(f"connection closed after {self.body_filled} of {len(self.body)} body bytes")
+                debug(f'{self.body_filled=} {received=} of {len(self.body)}')
+                self.body_filled += received
+                continue
 
-    method, path, httpver = parts
+            if self.filled == len(self.buffer):
+                if len(self.buffer) >= MAX_REQUEST_HEAD:
+                    self._reject(connection, f'request head over {MAX_REQUEST_HEAD} bytes', b"request head too large")
+                debug('MORE: request head is longer than', len(self.buffer), 'bytes')
+                self.buffer.extend(bytes(len(self.buffer)))
+            with memoryview(self.buffer) as view:
+                received = _recv_into(connection, view[self.filled:])
+            if received is None:
+                return None
+            debug("received", received, "bytes")
+            if received == 0:
+                raise RequestError('no data received' if self.filled == 0 else 'connection closed in the middle of the request head')
+            if self.started is None:
+                self.started = time.perf_counter()
+            head_end, separator = find_head_end(self.buffer, max(0, self.filled - 3), self.filled + received)
+            self.filled += received
+            if head_end >= 0:
+                parse_started = time.perf_counter()
+                self._parse_head(connection, head_end, separator)
+                self.parse_seconds += time.perf_counter() - parse_started
 
-    # parse headers, newline, then body
-    if b'\r\n\r\n' in rest:
-        headers, body = rest.split(b'\r\n\r\n', 1)
-    elif b'\n\n' in rest:
-        headers, body = rest.split(b'\n\n', 1)
-    else:
-        log('ERROR: empty line before body not found')
-        http_response = HTTP_NOT_FOUND(b"empty line between body and headers not found")
-        client_connection.sendall(http_response)
-        client_connection.close()    
-        return None
+    def _reject(self, connection: socket.socket, reason: str, body: bytes):
+        try:
+            HTTP_BAD_REQUEST(body).write_to(connection)
+        except OSError:
+            pass  # it's being closed either way
+        raise RequestError(reason)
+
+    def _parse_head(self, connection: socket.socket, head_end: int, separator: int):
+        buffer = self.buffer
+        line_end = buffer.find(b"\n", 0, head_end)
+        if line_end < 0:
+            line_end = head_end
+        first_line = buffer[:line_end].decode("utf-8", "replace")
+        debug(first_line)
+        parts = first_line.split()
+        if len(parts) != 3:
+            self._reject(connection, f'bad request line: {first_line!r}', b"bad request line: " + first_line.encode())
+        method, path, httpver = parts
+
+        headers = parse_headers(buffer, line_end + 1, head_end)
+
+        if "connection" in headers:
+            debug("- connection :", headers["connection"])
+
+        connection_header = None
+        if "connection" in headers and headers["connection"] == "keep-alive":
+            connection_header = "keep-alive"
+
+        body_start = head_end + separator
+        if 'content-length' not in headers:
+            content_length = self.filled - body_start
+        else:
+            try:
+                content_length = int(headers['content-length'])
+            except ValueError:
+                content_length = -1
+            if content_length < 0:
+                self._reject(connection, 'bad content-length', b"bad content-length")
+        available = min(self.filled - body_start, content_length)
+        with memoryview(buffer) as view:
+            if available == content_length:
+                self.body = bytes(view[body_start:body_start + content_length])
+            else:
+                # the rest of the body goes straight into its own buffer
+                self.body = bytearray(content_length)
+                self.body[:available] = view[body_start:body_start + available]
+        self.body_filled = available
+        self.request = {'method': method, 'path': path, 'httpver': httpver, 'headers': headers, 'connection': connection_header,
+                        'bytes_in': body_start + content_length}
+        self.release()
+
+    def _complete(self) -> Dict[str, Any]:
+        request = self.request
+        request['body'] = self.body  # bytes, or the bytearray a body that came in over several reads was received into
+        elapsed = time.perf_counter() - self.started
+        request['recv_seconds'] = elapsed - self.parse_seconds
+        request['parse_seconds'] = self.parse_seconds
+        return request
+
+class TlsStats:
+    # handshake counters kept by `run`, a resumed handshake skips the certificate signature entirely
+    def __init__(self):
+        self.context = None
+        self.full = 0
+        self.resumed = 0
+        self.failed = 0
+        self.timed_out = 0
+        self.full_seconds = 0.0
+        self.resumed_seconds = 0.0
+
+    def handshake_done(self, resumed: bool, seconds: float):
+        if resumed:
+            self.resumed += 1
+            self.resumed_seconds += seconds
+        else:
+            self.full += 1
+            self.full_seconds += seconds
+
+    def stats(self):
+        if self.context is None:
+            return None
+        session = self.context.session_stats()
+        return {
+            'full': self.full,
+            'resumed': self.resumed,
+            'failed': self.failed,
+            'timed_out': self.timed_out,
+            'full_ms': round(1000 * self.full_seconds / self.full, 2) if self.full else None,
+            'resumed_ms': round(1000 * self.resumed_seconds / self.resumed, 2) if self.resumed else None,
+            'session_hits': session['hits'],
+            'session_misses': session['misses'],
+            'session_timeouts': session['timeouts'],
+            'tickets': self.context.num_tickets,
+        }
+
+tls_stats = TlsStats()
+
+class ConnectionStats:
+    # kept by `run`
+    def __init__(self):
+        self.open = 0
+        self.accepted = 0
+        self.expired = 0
+        self.evicted = 0
+        self.rejected = 0
+        self.timed_out = 0  # closed for not sending a whole request within REQUEST_TIMEOUT_SECONDS, or taking a response within SEND_TIMEOUT_SECONDS
+
+    def stats(self):
+        return {'open': self.open, 'accepted': self.accepted, 'expired': self.expired, 'evicted': self.evicted, 'rejected': self.rejected,
+                'timed_out': self.timed_out}
+
+connection_stats = ConnectionStats()
+metrics.callback('kaz_connections_open', "Connections open, streams included", 'gauge', lambda: connection_stats.open)
+metrics.callback('kaz_connections_total', "Connections by what became of them", 'counter',
+                 lambda: {(outcome,): getattr(connection_stats, outcome) for outcome in ['accepted', 'expired', 'evicted', 'rejected', 'timed_out']}, ('outcome',))
+
+def set_keepalive(connection: socket.socket):
+    # phones that sleep or drop off wifi leave connections half-open, let the kernel find out for us
+    connection.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    idle, interval, count = TCP_KEEPALIVE
+    if hasattr(socket, 'TCP_KEEPIDLE'):
+        connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, idle)
+        connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, interval)
+        connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, count)
+
+# admission control
+#
+# `run` reads every request that's ready into a bounded queue before answering any, and answers cheap ones
+# (static files, status) before expensive ones (snapshots, batch gets), first come first served within each.
+# when everything arrives at once the queue delay grows instead of the work getting done, so requests are shed
+# with a quick 503 and a Retry-After the way codel drops packets: once the delay of what's taken off the queue
+# has stayed above QUEUE_TARGET_SECONDS for QUEUE_INTERVAL_SECONDS, whatever waited longer than the target is
+# shed until something gets through within it again.  nothing waits past MAX_QUEUE_SECONDS.
+# each client address also has a token bucket, an expensive request takes more tokens, a client that runs
+# out gets a 429.  behind a proxy every client has the proxy's address, so raise the rate or turn it off.
+# requests sent as websocket messages go through the same queue and buckets, see KazStream.queue_request.
+PRIORITY_CHEAP = 0
+PRIORITY_EXPENSIVE = 1
+PRIORITY_COSTS = (1, 5)  # tokens a request takes, by priority
+
+class AdmissionControl:
+    def __init__(self, priority: Callable[[dict], int] = None, max_queued: int = MAX_QUEUED_REQUESTS,
+                 client_rate: float = CLIENT_RATE, client_burst: float = CLIENT_BURST,
+                 target: float = QUEUE_TARGET_SECONDS, interval: float = QUEUE_INTERVAL_SECONDS, max_delay: float = MAX_QUEUE_SECONDS):
+        self.priority = priority or (lambda request: PRIORITY_CHEAP)
+        self.max_queued = max_queued
+        self.client_rate = client_rate
+        self.client_burst = client_burst
+        self.target = target
+        self.interval = interval
+        self.max_delay = max_delay
+        self.queues = [deque() for _ in PRIORITY_COSTS]  # by priority: (socket, request, queued at)
+        self.buckets = {}  # client address -> [tokens, last refilled]
+        self.first_above = None  # when the delay going above target started counting, codel's first_above_time
+        self.dropping = False
+        self.service_seconds = 0.0  # moving average of the time to answer one, for Retry-After
+
+        # stats
+        self.admitted = 0
+        self.shed = {'full': 0, 'delay': 0, 'client': 0}
+
+    def __len__(self):
+        return sum(len(queue) for queue in self.queues)
+
+    def stats(self):
+        return {'queued': len(self), 'admitted': self.admitted, 'shed': dict(self.shed), 'dropping': self.dropping,
+                'service_ms': ms(self.service_seconds), 'clients': len(self.buckets)}
+
+    def take(self, client: str, cost: float, now: float) -> float:
+        # 0 if the client had the tokens, otherwise the seconds until it will
+        if not self.client_rate:
+            return 0
+        bucket = self.buckets.get(client)
+        if bucket is None:
+            bucket = self.buckets[client] = [self.client_burst, now]
+        bucket[0] = min(self.client_burst, bucket[0] + (now - bucket[1]) * self.client_rate)
+        bucket[1] = now
+        if bucket[0] < cost:
+            return (cost - bucket[0]) / self.client_rate
+        bucket[0] -= cost
+        return 0
+
+    def forget_clients(self, now: float):
+        # a bucket that has refilled is the same as no bucket
+        if self.client_rate:
+            full = [client for client, (tokens, refilled) in self.buckets.items() if tokens + (now - refilled) * self.client_rate >= self.client_burst]
+            for client in full:
+                del self.buckets[client]
+
+    def admit(self, sock, request: dict, now: float) -> list:
+        # queues the request.  returns what has to be shed instead, [(socket, request, reason, retry after)]
+        priority = self.priority(request)
+        wait = self.take(request.get('client'), PRIORITY_COSTS[priority], now)
+        if wait:
+            self.shed['client'] += 1
+            return [(sock, request, 'client', wait)]
+        shed = []
+        if len(self) >= self.max_queued:
+            # the newest of the least important ones makes room, if it's less important than this one
+            lowest = max(p for p, queue in enumerate(self.queues) if queue)
+            if lowest <= priority:
+                self.shed['full'] += 1
+                return [(sock, request, 'full', self.retry_after())]
+            victim, victim_request, _ = self.queues[lowest].pop()
+            self.shed['full'] += 1
+            shed.append((victim, victim_request, 'full', self.retry_after()))
+        self.queues[priority].append((sock, request, now))
+        self.admitted += 1
+        return shed
+
+    def next(self, now: float):
+        # (socket, request, seconds it waited, None or the reason to shed it), or None if nothing's queued
+        queue = next((queue for queue in self.queues if queue), None)
+        if queue is None:
+            self.first_above = None
+            self.dropping = False
+            return None
+        sock, request, queued = queue.popleft()
+        waited = now - queued
+        if waited < self.target:
+            self.first_above = None
+            self.dropping = False
+        elif self.first_above is None:
+            self.first_above = now + self.interval
+        elif now >= self.first_above and not self.dropping:
+            self.dropping = True
+            log(f"queue delay above {ms(self.target)}ms for {self.interval}s with {len(self) + 1} queued, shedding")
+        if waited > self.max_delay or (self.dropping and waited > self.target):
+            self.shed['delay'] += 1
+            return sock, request, waited, 'delay'
+        return sock, request, waited, None
+
+    def served(self, seconds: float):
+        self.service_seconds += (seconds - self.service_seconds) * 0.1
+
+    def retry_after(self) -> float:
+        # about how long the queue takes to drain
+        return len(self) * self.service_seconds
 
-    headers = [line.split(': ', 1) for line in headers.decode().splitlines()]
-    headers = {key.lower(): value for key, value in headers}
-
-    for header in ["user-agent", "sec-ch-ua-platform", "referer", "connection"]:
-        if header in headers:
-            log("-", header, ":", headers[header])
-    
-    connection = None
-    if "connection" in headers and headers["connection"] == "keep-alive":
-        connection = "keep-alive"
-
-    if 'content-length' in headers:
-        content_length = int(headers['content-length'])
-        retry_count = 5
-        while content_length - len(body) > 0:
-            log(f'{len(body)=} {content_length=}')
-            more = client_connection.recv(content_length - len(body))
-            body += more
-            if len(more) == 0:
-                retry_count -= 1
-            if retry_count == 0:
-                raise Exception("ERROR: retried 5 times, got 0 bytes every time, giving up.  body doesn't match content-length header.")
-        log(f'{len(body)=} {content_length=}')
-    return {'method': method, 'path': path, 'httpver': httpver, 'headers': headers, 'body': body, "connection": connection}
-
-def create_server_socket(host, port, cert_folder) -> Tuple[socket.socket, ssl.SSLContext]:
+def shed_response(reason: str, retry_after: float) -> KazHttpResponse:
+    seconds = max(1, min(MAX_RETRY_AFTER_SECONDS, math.ceil(retry_after)))
+    retry_header = b"Retry-After: " + str(seconds).encode() + b"\r\n"
+    if reason == 'client':
+        return KazHttpResponse(b"429 TOO_MANY_REQUESTS", f"HTTP 429: too many requests, retry in {seconds}s\n".encode(), extra_headers=retry_header)
+    return KazHttpResponse(b"503 SERVICE_UNAVAILABLE", f"HTTP 503: overloaded, retry in {seconds}s\n".encode(), extra_headers=retry_header)
+
+def create_server_socket(host, port, cert_folder, session_tickets: int = TLS_SESSION_TICKETS) -> Tuple[socket.socket, ssl.SSLContext]:
     listen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     context = None
     cert_path = os.path.join(cert_folder, 'cert.pem')
@@ -143,6 +1222,15 @@ def create_server_socket(host, port, cert_folder) -> Tuple[socket.socket, ssl.SS
     if os.path.exists(cert_path) and os.path.exists(key_path):
         context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
         context.load_cert_chain(certfile=cert_path, keyfile=key_path)
+        # reconnects resume with a ticket instead of a full handshake: tls 1.3 tickets, plus the server-side
+        # session cache for tls 1.2 clients.  the ticket key lives as long as the process
+        if session_tickets > 0:
+            context.options &= ~ssl.OP_NO_TICKET
+            context.num_tickets = session_tickets
+        else:
+            context.options |= ssl.OP_NO_TICKET
+            context.num_tickets = 0
+        tls_stats.context = context
 
     listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     listen_socket.bind((host, port))
@@ -151,79 +1239,366 @@ def create_server_socket(host, port, cert_folder) -> Tuple[socket.socket, ssl.SS
     return listen_socket, context
 
 
-def run(host: str, port: int, handle_request: Callable[[dict], KazHttpResponse], cert_folder: str) -> None:
+def run(host: str, port: int, handle_request: Callable[[dict], KazHttpResponse], cert_folder: str, session_tickets: int = TLS_SESSION_TICKETS,
+        max_connections: int = MAX_CONNECTIONS, idle_timeout: float = IDLE_TIMEOUT_SECONDS, access_log: str = None,
+        admission: AdmissionControl = None) -> None:
     import select
-    listen_socket, context = create_server_socket(host, port, cert_folder)
+    if admission is None:
+        admission = AdmissionControl()
+    metrics.callback('kaz_request_queue_length', "Requests read and waiting to be answered", 'gauge', lambda: len(admission))
+    metrics.callback('kaz_requests_shed_total', "Requests answered with a 503 or 429 instead of being handled", 'counter',
+                     lambda: {(reason,): count for reason, count in admission.shed.items()}, ('reason',))
+    listen_socket, context = create_server_socket(host, port, cert_folder, session_tickets)
     listen_socket.setblocking(False)
+    if access_log is not None:
+        open_access_log(access_log)
     inputs = [listen_socket]
-    
+
+    # streams are written from the loop, other threads wake it up through this pair when they write
+    wake_reader, wake_writer = socket.socketpair()
+    wake_reader.setblocking(False)
+    wake_writer.setblocking(False)
+    inputs.append(wake_reader)
+    def wake():
+        try:
+            wake_writer.send(b"\0")
+        except (BlockingIOError, OSError):
+            pass  # already awake
+    streams = {}  # socket -> KazStream
+    metrics.callback('kaz_streams_open', "Event streams and websockets open", 'gauge', lambda: len(streams))
+    last_heartbeat = time.monotonic()
+
+    # tls handshakes are stepped from the loop as the client's packets arrive, so a client on a slow link
+    # doesn't hold up everyone else for its round trips.  they're dropped after HANDSHAKE_TIMEOUT_SECONDS
+    handshakes = {}  # socket -> [client address, deadline, wants write, started]
+
+    # connections waiting for their next request, least recently used first.  they all get the same idle
+    # timeout, so this order is also the order they expire in, and expiring or evicting pops from the front
+    idle = OrderedDict()  # socket -> time of its last request
+
+    # requests being read, oldest first.  they all get the same REQUEST_TIMEOUT_SECONDS, so like `idle`
+    # this is also the order their deadlines come up in
+    reading = OrderedDict()  # socket -> RequestReader
+
+    served = {}  # socket -> requests answered on it
+    queued = set()  # sockets with a request in the admission queue, they aren't read from until it's answered
+
+    def close_connection(sock):
+        handshakes.pop(sock, None)
+        idle.pop(sock, None)
+        reader = reading.pop(sock, None)
+        if reader is not None:
+            reader.release()
+        served.pop(sock, None)
+        inputs.remove(sock)
+        connection_stats.open -= 1
+        try:
+            sock.close()
+        except OSError:
+            pass
+
+    def now_idle(sock):
+        idle[sock] = time.monotonic()
+        idle.move_to_end(sock)
+
+    def step_handshake(sock):
+        address = handshakes[sock][0]
+        try:
+            sock.do_handshake()
+        except ssl.SSLWantReadError:
+            handshakes[sock][2] = False
+            return
+        except ssl.SSLWantWriteError:
+            handshakes[sock][2] = True
+            return
+        except (ssl.SSLError, OSError) as e:
+            log(f"SSL handshake failed with {address}: {e}")
+            tls_stats.failed += 1
+            close_connection(sock)
+            return
+        seconds = time.monotonic() - handshakes.pop(sock)[3]
+        tls_stats.handshake_done(sock.session_reused, seconds)
+        handshake_seconds.observe(seconds, 'true' if sock.session_reused else 'false')
+        access({'tls_ms': ms(seconds), 'resumed': sock.session_reused})
+        now_idle(sock)
+        debug(f"SSL handshake successful with {address}{' (resumed)' if sock.session_reused else ''}")
+
+    def serve(sock, request, shed: str = None, retry_after: float = 0.0):
+        # answers a request taken off the admission queue, or with a 503/429 if it's `shed`
+        if 'answer' in request:
+            answer_streamed(sock, request, shed, retry_after)
+            return
+        try:
+            handler_started = time.perf_counter()
+            if shed is None:
+                begin_timing()
+                try:
+                    http_response = handle_request(request)
+                finally:
+                    phases = end_timing()
+            else:
+                http_response = shed_response(shed, retry_after)
+                phases = {}
+            handled = time.perf_counter()
+            if shed is None:
+                admission.served(handled - handler_started)
+            if isinstance(http_response, KazHttpResponse) and request['path'].startswith('/api/'):
+                add_server_timing(http_response, {'queue': request['queue_seconds'], 'parse': request['parse_seconds'], 'handler': handled - handler_started, **phases})
+            record = {'method': request['method'], 'route': request.get('route') or route_of(request['path']), 'in': request['bytes_in'],
+                      'recv_ms': ms(request['recv_seconds']), 'parse_ms': ms(request['parse_seconds']), 'queue_ms': ms(request['queue_seconds']),
+                      'handler_ms': ms(handled - handler_started)}
+            if shed is not None:
+                record['shed'] = shed
+            waited = request['recv_seconds'] + request['parse_seconds'] + request['queue_seconds']
+
+            if isinstance(http_response, KazStream):
+                header_bytes = http_response.header_bytes()
+                sock.settimeout(SEND_TIMEOUT_SECONDS)
+                sock.sendall(header_bytes)
+                sock.setblocking(False)
+                streams[sock] = http_response
+                http_response.wake = wake
+                http_response.submit = lambda request, answer: submit(sock, {**request, 'answer': answer})
+                log('stream opened, streams now:', len(streams))
+                status = int(header_bytes.split(b" ", 2)[1])
+                access({**record, 'status': status, 'out': len(header_bytes), 'send_ms': ms(time.perf_counter() - handled), 'keep_alive': False})
+                count_request(request['method'], record['route'], status, len(header_bytes), waited + time.perf_counter() - handler_started)
+                return
+
+            if request['connection'] == 'keep-alive':
+                http_response.keep_alive = True
+
+            # responses are written blocking, but a client that doesn't take one within SEND_TIMEOUT_SECONDS is dropped
+            bytes_out = http_response.write_to(sock, time.monotonic() + SEND_TIMEOUT_SECONDS)
+            sock.setblocking(False)
+            status = int(http_response.status.split(b" ", 1)[0])
+            access({**record, 'status': status, 'out': bytes_out, 'send_ms': ms(time.perf_counter() - handled), 'keep_alive': http_response.keep_alive})
+            count_request(request['method'], record['route'], status, bytes_out, waited + time.perf_counter() - handler_started)
+            if served.get(sock, 0):
+                keepalive_reused.inc()
+            served[sock] = served.get(sock, 0) + 1
+
+            if not http_response.keep_alive:
+                debug('closing connection', sock.getpeername(), len(inputs), "(no keep-alive)")
+                close_connection(sock)
+            else:
+                debug('keep-alive, reusing connection', sock.getpeername())
+                now_idle(sock)
+
+        except socket.timeout:
+            log(f"client didn't take its response within {SEND_TIMEOUT_SECONDS}s, closing the connection")
+            connection_stats.timed_out += 1
+            close_connection(sock)
+        except Exception as e:
+            error(f"handling request failed: {e}")
+            error("".join(traceback.format_exception(e)))
+            try:
+                close_connection(sock)
+            except Exception as e:
+                error(f"closing socket failed: {e}")
+
+    def submit(sock, request):
+        # queues a request for the slice below to answer, whatever admission control sheds instead is answered now
+        request['client'] = sock.getpeername()[0]
+        request['queue_seconds'] = 0.0
+        for shed_sock, shed_request, reason, retry_after in admission.admit(sock, request, time.monotonic()):
+            queued.discard(shed_sock)
+            serve(shed_sock, shed_request, reason, retry_after)
+
+    def answer_streamed(sock, request, shed, retry_after):
+        # a request that came in over a websocket, the stream sends the answer back itself
+        if sock not in streams:
+            return  # closed while it was queued
+        handler_started = time.perf_counter()
+        try:
+            request['answer'](request, None if shed is None else shed_response(shed, retry_after))
+        except Exception as e:
+            error(f"handling stream request failed: {e}")
+            error("".join(traceback.format_exception(e)))
+            close_stream(sock)
+            return
+        if shed is None:
+            admission.served(time.perf_counter() - handler_started)
+
+    def accept(client_connection, client_address):
+        debug(client_address)
+
+        if connection_stats.open >= max_connections:
+            if not idle:
+                # everything open is busy streaming or handshaking
+                log(f'at {max_connections} connections, turning {client_address} away')
+                connection_stats.rejected += 1
+                client_connection.close()
+                return
+            log('at', max_connections, 'connections, closing the least recently used idle one')
+            connection_stats.evicted += 1
+            close_connection(next(iter(idle)))
+        try:
+            set_keepalive(client_connection)
+        except OSError as e:
+            log(f"couldn't set keepalive on {client_address}: {e}")
+
+        if context:
+            try:
+                client_connection.setblocking(False)
+                client_connection = context.wrap_socket(client_connection, server_side=True, do_handshake_on_connect=False)
+            except (ssl.SSLError, OSError) as e:
+                log(f"SSL setup failed with {client_address}: {e}")
+                client_connection.close()
+                return
+            started = time.monotonic()
+            handshakes[client_connection] = [client_address, started + HANDSHAKE_TIMEOUT_SECONDS, False, started]
+        else:
+            client_connection.setblocking(False)
+            now_idle(client_connection)
+
+        inputs.append(client_connection)
+        connection_stats.open += 1
+        connection_stats.accepted += 1
+        debug('added new input, inputs now:', len(inputs))
+        if context:
+            step_handshake(client_connection)  # the client hello is usually already here
+
+    def close_stream(sock):
+        stream = streams.pop(sock)
+        stream.close()
+        close_connection(sock)
+        log('stream closed, streams now:', len(streams))
+        if stream.on_close is not None:
+            stream.on_close()
+
     while True:
         try:
-            readable, _, _ = select.select(inputs, [], [], 1.0)
+            writing = [sock for sock, stream in streams.items() if stream.wants_write()]
+            writing += [sock for sock, handshake in handshakes.items() if handshake[2]]
+            watching = [sock for sock in inputs if sock not in queued] if queued else inputs
+            readable, writable, _ = select.select(watching, writing, [], 0 if queued else 1.0)
+            for sock in writable:
+                if sock in handshakes:
+                    step_handshake(sock)
+                elif sock in streams:
+                    try:
+                        if not streams[sock].flush_to(sock):
+                            close_stream(sock)
+                    except OSError as e:
+                        log('event stream write failed:', e)
+                        close_stream(sock)
+
+            now = time.monotonic()
+            if now - last_heartbeat >= 1.0:
+                last_heartbeat = now
+                for stream in list(streams.values()):
+                    if now - stream.last_write >= STREAM_HEARTBEAT_SECONDS:
+                        stream.last_write = now
+                        stream.heartbeat()
+                for sock, handshake in list(handshakes.items()):
+                    if now >= handshake[1]:
+                        log(f"SSL handshake timed out with {handshake[0]}")
+                        tls_stats.timed_out += 1
+                        close_connection(sock)
+                expired = 0
+                while idle and now - next(iter(idle.values())) >= idle_timeout:
+                    close_connection(next(iter(idle)))
+                    expired += 1
+                if expired:
+                    connection_stats.expired += expired
+                    log(f'closed {expired} idle connections, connections now: {connection_stats.open}')
+                while reading and now >= next(iter(reading.values())).deadline:
+                    sock, reader = next(iter(reading.items()))
+                    log('request timed out' if reader.started is None else 'request timed out before all of it was received')
+                    connection_stats.timed_out += 1
+                    close_connection(sock)
+                admission.forget_clients(now)
+
             for sock in readable:
-                log(f'-----------------------')
-                if sock is listen_socket:
-                    log('accepting new connection')
+                if sock.fileno() < 0:
+                    continue  # closed earlier this round, timed out or a stream whose write failed
+                if sock is wake_reader:
                     try:
-                        sock.settimeout(1)
-                        client_connection, client_address = sock.accept()
-                    except socket.timeout:
-                        log('listen_socket timeout')
+                        while wake_reader.recv(4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+                    continue
+                if sock in handshakes:
+                    step_handshake(sock)
+                    continue
+                if sock in streams:
+                    try:
+                        data = sock.recv(PACKET_READ_SIZE)
+                        # ssl may have decrypted more than select can see
+                        while data and isinstance(sock, ssl.SSLSocket) and sock.pending():
+                            data += sock.recv(sock.pending())
+                    except (BlockingIOError, ssl.SSLWantReadError, ssl.SSLWantWriteError):
+                        continue
+                    except OSError:
+                        data = b""
+                    if not data:
+                        close_stream(sock)
                         continue
-                    log(client_address)
-                    
-                    if context:
+                    try:
+                        streams[sock].received(data)
+                    except Exception as e:
+                        error(f"handling stream data failed: {e}")
+                        error("".join(traceback.format_exception(e)))
+                        close_stream(sock)
+                    continue
+                debug(f'-----------------------')
+                if sock is listen_socket:
+                    # everything that's waiting, so its requests are read and queued (or shed) this round instead
+                    # of sitting in the kernel's accept queue where nothing can tell cheap from expensive
+                    for _ in range(max_connections):
                         try:
-                            client_connection = context.wrap_socket(client_connection, server_side=True, do_handshake_on_connect=True)
-                            client_connection.do_handshake()  # delete this if above already does handshake?
-                            log(f"SSL handshake successful with {client_address}")
-                        except (ssl.SSLError, ConnectionResetError, Exception) as e:
-                            log(f"SSL handshake failed with {client_address}: {e}")
-                            client_connection.close()
-                            continue
-                    
-                    inputs.append(client_connection)
-                    log('added new input, inputs now:', len(inputs))
+                            client_connection, client_address = listen_socket.accept()
+                        except (BlockingIOError, InterruptedError):
+                            break
+                        debug('accepted new connection')
+                        accept(client_connection, client_address)
                 else:
                     try:
-                        log('reading new data on', sock.getpeername())
+                        debug('reading new data on', sock.getpeername())
                     except OSError as e:
-                        log('ERROR:', e)
-                        inputs.remove(sock)
-                        sock.close()
+                        error(e)
+                        close_connection(sock)
                         continue
                     try:
-                        request = receive_headers_and_content(sock)
-                        if request is None:
-                            log('closing connection', sock.getpeername(), len(inputs), "(no request received)")
-                            inputs.remove(sock)
-                            sock.close()
+                        reader = reading.get(sock)
+                        if reader is None:
+                            idle.pop(sock, None)
+                            reader = reading[sock] = RequestReader(time.monotonic() + REQUEST_TIMEOUT_SECONDS)
+                        try:
+                            request = reader.receive(sock)
+                        except RequestError as e:
+                            log('closing connection', sock.getpeername(), len(inputs), f"({e})")
+                            close_connection(sock)
                             continue
-                        
-                        http_response = handle_request(request)
-
-                        if request['connection'] == 'keep-alive':
-                            http_response.keep_alive = True
-
-                        http_response.write_to(sock)
-                        
-                        if not http_response.keep_alive:
-                            log('closing connection', sock.getpeername(), len(inputs), "(no keep-alive)")
-                            inputs.remove(sock)
-                            sock.close()
-                        else:
-                            log('keep-alive, reusing connection', sock.getpeername())
-                        
+                        if request is None:
+                            continue  # the rest of it hasn't arrived yet
+                        del reading[sock]
+                        queued.add(sock)
+                        submit(sock, request)
                     except Exception as e:
-                        log(f"Error handling request: {str(e)}")
-                        log("".join(traceback.format_exception(e)))
+                        error(f"reading request failed: {e}")
+                        error("".join(traceback.format_exception(e)))
                         try:
-                            inputs.remove(sock)
-                            sock.close()
+                            close_connection(sock)
                         except Exception as e:
-                            log(f"Error closing socket: {str(e)}")
-        
+                            error(f"closing socket failed: {e}")
+
+            # answer what's queued, cheap requests first.  after QUEUE_TARGET_SECONDS of it, go back to select
+            # so requests that came in meanwhile get queued too and the cheap ones among them can go first
+            slice_end = time.monotonic() + admission.target
+            while time.monotonic() < slice_end:
+                entry = admission.next(time.monotonic())
+                if entry is None:
+                    break
+                sock, request, waited, reason = entry
+                queued.discard(sock)
+                queue_seconds.observe(waited)
+                request['queue_seconds'] = waited
+                serve(sock, request, reason, admission.retry_after())
+
         except Exception as e:
-            log("Error in main loop")
-            log("".join(traceback.format_exception(e)))
+            error("main loop failed")
+            error("".join(traceback.format_exception(e)))
             break
\ No newline at end of file
@@ -0,0 +1,92 @@
+# moves the notes in a loose notes root between the flat (<repo>/<uuid>) and fanout (<repo>/<ab>/<uuid>) layouts.
+#
+# to fanout is safe while the server runs, as long as it runs with --fanout: it finds a note in either place,
+# and always writes the sharded path.  each note is hard-linked into its shard, which fails instead of
+# clobbering a newer copy the server just wrote there, and then the flat name is removed.
+# to flat has to run with the server stopped, then restart it without --fanout.
+#
+# python migrate_layout.py --notes-root ~/notes --to fanout
+
+import os
+import time
+import argparse
+
+from storage import LooseStore, is_note_file, is_shard_dir, shard, fsync_dir
+
+def link_or_rename(source: str, destination: str) -> bool:
+    # returns False if destination already exists, in which case it's newer than source
+    try:
+        os.link(source, destination)
+    except FileExistsError:
+        return False
+    except OSError:
+        # no hard links on this filesystem
+        if os.path.exists(destination):
+            return False
+        os.rename(source, destination)
+        return True
+    os.remove(source)
+    return True
+
+def to_fanout(root: str, repo: str, pause: float, batch: int) -> int:
+    repo_path = os.path.join(root, repo)
+    moved = 0
+    touched = set()
+    for uuid in os.listdir(repo_path):
+        path = os.path.join(repo_path, uuid)
+        if not is_note_file(uuid) or not os.path.isfile(path):
+            continue
+        shard_path = os.path.join(repo_path, shard(uuid))
+        os.makedirs(shard_path, exist_ok=True)
+        if not link_or_rename(path, os.path.join(shard_path, uuid)):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        touched.add(shard_path)
+        moved += 1
+        if moved % batch == 0:
+            for directory in touched | {repo_path}:
+                fsync_dir(directory)
+            touched = set()
+            time.sleep(pause)  # leave the disk to the server for a bit
+    for directory in touched | {repo_path}:
+        fsync_dir(directory)
+    return moved
+
+def to_flat(root: str, repo: str) -> int:
+    repo_path = os.path.join(root, repo)
+    moved = 0
+    for shard_dir in os.listdir(repo_path):
+        shard_path = os.path.join(repo_path, shard_dir)
+        if not is_shard_dir(shard_dir) or not os.path.isdir(shard_path):
+            continue
+        for uuid in os.listdir(shard_path):
+            if is_note_file(uuid):
+                # the sharded copy is the newer one if both exist
+                os.replace(os.path.join(shard_path, uuid), os.path.join(repo_path, uuid))
+                moved += 1
+        if not os.listdir(shard_path):
+            os.rmdir(shard_path)
+    fsync_dir(repo_path)
+    return moved
+
+def main():
+    argparser = argparse.ArgumentParser(description="Move the notes in a notes root between the flat and fanout layouts")
+    argparser.add_argument("--notes-root", type=str, help="Root directory for notes", default=os.path.join(os.path.expanduser('~'), "notes"))
+    argparser.add_argument("--to", choices=["fanout", "flat"], required=True, help="Layout to move the notes into")
+    argparser.add_argument("--batch", type=int, help="Notes moved between directory syncs and pauses", default=500)
+    argparser.add_argument("--pause", type=float, help="Seconds to pause between batches", default=0.05)
+    args = argparser.parse_args()
+
+    repos = LooseStore(args.notes_root, None).repos()
+    for repo in repos:
+        start = time.time()
+        if args.to == "fanout":
+            moved = to_fanout(args.notes_root, repo, args.pause, args.batch)
+        else:
+            moved = to_flat(args.notes_root, repo)
+        print(f"{repo}: moved {moved} notes to the {args.to} layout in {time.time() - start:.2f}s")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,380 @@
+# packed note storage, for repos too big for one file per note
+#
+# each repo is two files in .packs/:
+# - <repo>.pack, append-only.  every write appends a record, so a rewritten note leaves its old record behind as dead bytes.
+#     header: b"KPK1" u64:generation
+#     record: b"KREC" u16:uuid_length u32:content_length 32s:sha256, uuid, content
+# - <repo>.idx, sorted by uuid so it can be binary searched straight out of an mmap.
+#     header: b"KIX1" u64:generation u32:count u64:covered (how much of the pack the index accounts for)
+#     entry:  64s:uuid (NUL padded) u64:content_offset u32:content_length 32s:sha256
+#
+# records appended after the index was last written are kept in memory and found again on startup by
+# scanning the pack past `covered`.  the index is rewritten once enough of those pile up.
+# compaction rewrites the pack with only live records under a new generation, and an index whose
+# generation doesn't match its pack is ignored and rebuilt by scanning the whole pack.
+#
+# status, list, get and snapshot are answered from the two mmaps: no listdir, open or hashing per note.
+# repos in the one-file-per-note layout are imported into a pack the first time we see them.
+# with `compress`, record contents are gzipped, the record's sha256 is still of the note itself.
+
+import os
+import mmap
+import struct
+import hashlib
+import threading
+import time
+
+from kazhttp import log, error
+from storage import LooseStore, is_note_file, fsync_dir, compress, decompress, NOT_REPOS
+
+PACKS_DIR = ".packs"
+PACK_HEADER = struct.Struct(">4sQ")
+RECORD_HEADER = struct.Struct(">4sHI32s")
+INDEX_HEADER = struct.Struct(">4sQIQ")
+INDEX_ENTRY = struct.Struct(">64sQI32s")
+PACK_MAGIC = b"KPK1"
+RECORD_MAGIC = b"KREC"
+INDEX_MAGIC = b"KIX1"
+UUID_WIDTH = 64
+REINDEX_THRESHOLD = 1024  # unindexed records before the index is rewritten
+COMPACT_DEAD_RATIO = 0.5  # fraction of the pack that's superseded records before compaction is worth it
+
+class PackError(Exception):
+    pass
+
+def record_size(uuid: str, length: int) -> int:
+    return RECORD_HEADER.size + len(uuid.encode()) + length
+
+def _write_file(path: str, content: bytes):
+    # whole-file rewrite of a pack or index: write a temp file, fsync, rename into place
+    temp_path = os.path.join(os.path.dirname(path), '.' + os.path.basename(path) + '.tmp')
+    with open(temp_path, 'wb') as f:
+        f.write(content)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+    fsync_dir(os.path.dirname(path))
+
+class Pack:
+    def __init__(self, directory: str, repo: str):
+        self.repo = repo
+        self.pack_path = os.path.join(directory, repo + '.pack')
+        self.index_path = os.path.join(directory, repo + '.idx')
+        self.lock = threading.Lock()
+        self.generation = 0
+        self.file = None        # append handle on the pack
+        self.pack_map = None
+        self.index_map = None
+        self.index_count = 0
+        self.index_keys = None  # lazily decoded uuids in the index, for list
+        self.index_key_set = None
+        self.recent = {}        # uuid -> (offset, length, sha) appended since the index was written
+        self.size = 0
+        self.live_bytes = 0
+
+    # loading
+
+    def open(self):
+        if not os.path.exists(self.pack_path):
+            _write_file(self.pack_path, PACK_HEADER.pack(PACK_MAGIC, int(time.time())))
+        self.file = open(self.pack_path, 'ab')
+        self.size = os.path.getsize(self.pack_path)
+        self._map_pack()
+        magic, self.generation = PACK_HEADER.unpack_from(self.pack_map, 0)
+        if magic != PACK_MAGIC:
+            raise PackError(f"{self.pack_path} is not a pack")
+
+        covered = PACK_HEADER.size
+        if self._load_index():
+            covered = INDEX_HEADER.unpack_from(self.index_map, 0)[3]
+        else:
+            self.index_map = None
+            self.index_count = 0
+        self.recent = {}
+        end = self._scan(covered)
+        if end != self.size:
+            log(f"pack {self.pack_path}: dropping {self.size - end} bytes of torn record")
+            self.file.truncate(end)
+            self.size = end
+            self._map_pack()
+        self.live_bytes = sum(record_size(uuid, length) for uuid, (_, length, _) in self._entries().items())
+        if self.index_map is None or len(self.recent) >= REINDEX_THRESHOLD:
+            self.write_index()
+
+    def _map_pack(self):
+        with open(self.pack_path, 'rb') as f:
+            self.pack_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _load_index(self) -> bool:
+        if not os.path.exists(self.index_path) or os.path.getsize(self.index_path) < INDEX_HEADER.size:
+            return False
+        with open(self.index_path, 'rb') as f:
+            index_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, generation, count, covered = INDEX_HEADER.unpack_from(index_map, 0)
+        if magic != INDEX_MAGIC or generation != self.generation or covered > self.size \
+                or len(index_map) != INDEX_HEADER.size + count * INDEX_ENTRY.size:
+            log(f"pack {self.pack_path}: index doesn't match the pack, rebuilding it")
+            return False
+        self.index_map = index_map
+        self.index_count = count
+        self.index_keys = None
+        return True
+
+    def _scan(self, offset: int) -> int:
+        # picks up records the index doesn't cover, returns where the last whole record ends
+        data = self.pack_map
+        while offset + RECORD_HEADER.size <= self.size:
+            magic, uuid_length, length, sha = RECORD_HEADER.unpack_from(data, offset)
+            content_offset = offset + RECORD_HEADER.size + uuid_length
+            if magic != RECORD_MAGIC or content_offset + length > self.size:
+                break
+            uuid = bytes(data[offset + RECORD_HEADER.size:content_offset]).decode()
+            self.recent[uuid] = (content_offset, length, sha)
+            offset = content_offset + length
+        return offset
+
+    # index lookups
+
+    def _index_entry(self, i: int):
+        key, offset, length, sha = INDEX_ENTRY.unpack_from(self.index_map, INDEX_HEADER.size + i * INDEX_ENTRY.size)
+        return key.rstrip(b'\0').decode(), (offset, length, sha)
+
+    def _keys(self):
+        if self.index_keys is None:
+            self.index_keys = [self._index_entry(i)[0] for i in range(self.index_count)]
+            self.index_key_set = set(self.index_keys)
+        return self.index_keys
+
+    def _lookup(self, uuid: str):
+        entry = self.recent.get(uuid)
+        if entry is not None or self.index_map is None:
+            return entry
+        # binary search over the mmap'd entries, the index is sorted by uuid bytes
+        key = uuid.encode().ljust(UUID_WIDTH, b'\0')
+        lo, hi = 0, self.index_count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            mid_key = self.index_map[INDEX_HEADER.size + mid * INDEX_ENTRY.size:INDEX_HEADER.size + mid * INDEX_ENTRY.size + UUID_WIDTH]
+            if mid_key < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.index_count:
+            found, entry = self._index_entry(lo)
+            if found == uuid:
+                return entry
+        return None
+
+    def _entries(self):
+        entries = {}
+        if self.index_map is not None:
+            for i in range(self.index_count):
+                uuid, entry = self._index_entry(i)
+                entries[uuid] = entry
+        entries.update(self.recent)
+        return entries
+
+    # reads
+
+    def list(self):
+        with self.lock:
+            if self.index_map is None:
+                return list(self.recent)
+            keys = self._keys()
+            return keys + [uuid for uuid in self.recent if uuid not in self.index_key_set]
+
+    def exists(self, uuid: str) -> bool:
+        with self.lock:
+            return self._lookup(uuid) is not None
+
+    def read(self, uuid: str) -> bytes:
+        return decompress(self.read_stored(uuid))
+
+    def read_stored(self, uuid: str) -> bytes:
+        with self.lock:
+            entry = self._lookup(uuid)
+            if entry is None:
+                raise FileNotFoundError(os.path.join(self.repo, uuid))
+            offset, length, _ = entry
+            if offset + length > len(self.pack_map):
+                self._map_pack()
+            return self.pack_map[offset:offset + length]
+
+    def hashes(self):
+        with self.lock:
+            return {uuid: sha.hex() for uuid, (_, _, sha) in self._entries().items()}
+
+    # writes
+
+    def append_many(self, items, compress_content: bool = False):
+        # items are (uuid, content)
+        with self.lock:
+            offset = self.size
+            records = []
+            for uuid, content in items:
+                encoded = uuid.encode()
+                if len(encoded) > UUID_WIDTH:
+                    raise PackError(f"note name is longer than {UUID_WIDTH} bytes: {uuid}")
+                sha = hashlib.sha256(content).digest()
+                if compress_content:
+                    content = compress(content)
+                records.append(RECORD_HEADER.pack(RECORD_MAGIC, len(encoded), len(content), sha) + encoded + content)
+                content_offset = offset + RECORD_HEADER.size + len(encoded)
+                previous = self._lookup(uuid)
+                if previous is not None:
+                    self.live_bytes -= record_size(uuid, previous[1])
+                self.recent[uuid] = (content_offset, len(content), sha)
+                self.live_bytes += record_size(uuid, len(content))
+                offset = content_offset + len(content)
+            self.file.write(b"".join(records))
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.size = offset
+            if len(self.recent) >= REINDEX_THRESHOLD:
+                self._write_index()
+
+    def write_index(self):
+        with self.lock:
+            self._write_index()
+
+    def _write_index(self):
+        entries = sorted(self._entries().items(), key=lambda item: item[0].encode())
+        parts = [INDEX_HEADER.pack(INDEX_MAGIC, self.generation, len(entries), self.size)]
+        for uuid, (offset, length, sha) in entries:
+            parts.append(INDEX_ENTRY.pack(uuid.encode(), offset, length, sha))
+        _write_file(self.index_path, b"".join(parts))
+        self.recent = {}
+        if not self._load_index():
+            raise PackError(f"{self.index_path} didn't load after writing it")
+
+    def dead_ratio(self) -> float:
+        with self.lock:
+            data_bytes = self.size - PACK_HEADER.size
+            return 0.0 if data_bytes <= 0 else 1 - self.live_bytes / data_bytes
+
+    def compact(self):
+        with self.lock:
+            entries = sorted(self._entries().items(), key=lambda item: item[0].encode())
+            generation = self.generation + 1
+            if len(self.pack_map) < self.size:
+                self._map_pack()  # records appended since it was mapped would be copied short
+            parts = [PACK_HEADER.pack(PACK_MAGIC, generation)]
+            for uuid, (offset, length, sha) in entries:
+                encoded = uuid.encode()
+                parts.append(RECORD_HEADER.pack(RECORD_MAGIC, len(encoded), length, sha) + encoded)
+                parts.append(self.pack_map[offset:offset + length])
+            before = self.size
+            _write_file(self.pack_path, b"".join(parts))
+            self.file.close()
+            self.open_after_compaction()
+            log(f"compacted pack {self.pack_path}: {before} -> {self.size} bytes")
+
+    def open_after_compaction(self):
+        # the index is stale (wrong generation), so this rebuilds it from a scan of the new pack
+        self.file = open(self.pack_path, 'ab')
+        self.size = os.path.getsize(self.pack_path)
+        self._map_pack()
+        _, self.generation = PACK_HEADER.unpack_from(self.pack_map, 0)
+        self.index_map = None
+        self.index_count = 0
+        self.recent = {}
+        self._scan(PACK_HEADER.size)
+        self.live_bytes = sum(record_size(uuid, length) for uuid, (_, length, _) in self.recent.items())
+        self._write_index()
+
+class PackStore:
+    # same interface as storage.LooseStore.  `load` has to be called before anything else.
+    features = set()
+
+    def __init__(self, root: str, writer=None, compress: bool = False):
+        self.root = root
+        self.compress = compress
+        self.pack_root = os.path.join(root, PACKS_DIR)
+        self.lock = threading.Lock()
+        self.packs = {}  # repo -> Pack
+
+    def load(self):
+        os.makedirs(self.pack_root, exist_ok=True)
+        for name in os.listdir(self.pack_root):
+            if name.endswith('.pack') and is_note_file(name):
+                self._open_pack(name[:-len('.pack')])
+        self.import_loose()
+
+    def _open_pack(self, repo: str) -> Pack:
+        pack = Pack(self.pack_root, repo)
+        pack.open()
+        self.packs[repo] = pack
+        return pack
+
+    def import_loose(self):
+        # the loose files (flat or fanout) are left where they are
+        for repo in os.listdir(self.root):
+            repo_path = os.path.join(self.root, repo)
+            if not os.path.isdir(repo_path) or repo in NOT_REPOS or not is_note_file(repo) or repo in self.packs:
+                continue
+            loose = LooseStore(self.root, None, fanout=True)
+            items = [(repo, uuid, loose.read(repo, uuid)) for uuid in loose.list(repo)]
+            self.write_many(items)
+            self.packs[repo].write_index()
+            log(f"imported {len(items)} loose notes from {repo_path} into a pack")
+
+    def _pack(self, repo: str, create: bool = False) -> Pack:
+        with self.lock:
+            pack = self.packs.get(repo)
+            if pack is None:
+                if not create:
+                    raise FileNotFoundError(os.path.join(self.pack_root, repo + '.pack'))
+                pack = self._open_pack(repo)
+            return pack
+
+    def repos(self):
+        with self.lock:
+            return list(self.packs)
+
+    def list(self, repo: str):
+        return self._pack(repo).list()
+
+    def exists(self, repo: str, uuid: str) -> bool:
+        try:
+            return self._pack(repo).exists(uuid)
+        except FileNotFoundError:
+            return False
+
+    def read(self, repo: str, uuid: str) -> bytes:
+        return self._pack(repo).read(uuid)
+
+    def read_stored(self, repo: str, uuid: str) -> bytes:
+        return self._pack(repo).read_stored(uuid)
+
+    def hashes(self, repo: str):
+        try:
+            return self._pack(repo).hashes()
+        except FileNotFoundError:
+            return {}
+
+    def write_many(self, items):
+        by_repo = {}
+        for repo, uuid, content in items:
+            by_repo.setdefault(repo, []).append((uuid, content))
+        for repo, repo_items in by_repo.items():
+            self._pack(repo, create=True).append_many(repo_items, self.compress)
+
+    def compact(self, min_dead_ratio: float = COMPACT_DEAD_RATIO):
+        with self.lock:
+            packs = list(self.packs.values())
+        for pack in packs:
+            if pack.dead_ratio() >= min_dead_ratio:
+                pack.compact()
+            elif pack.recent:
+                # checkpoint the index so a restart doesn't have to scan the tail of the pack
+                pack.write_index()
+
+    def start_compaction(self, interval: float):
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.compact()
+                except Exception as e:
+                    error(f"pack compaction failed: {e}")
+        threading.Thread(target=run, name="pack-compact", daemon=True).start()
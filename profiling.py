@@ -0,0 +1,125 @@
+# on-demand profiling of the live server, behind the /api/admin endpoints in simple_server.py
+#
+# the sampler is a thread that records every other thread's stack every `interval` seconds for a while
+# (sys._current_frames), so it sees the select loop, the hash pool and the writers without slowing them
+# down the way cProfile's per-call hooks would.  it's wall-clock: a thread waiting in select() shows up
+# waiting in select().  results come as collapsed stacks, the input of flamegraph.pl and speedscope: one
+# line per distinct stack, thread name first and frames root first separated by ';', then its sample count.
+#
+# tracemalloc snapshots are diffed against the previous one taken, to see what grew in between.
+
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+
+from kazhttp import log
+
+SAMPLE_INTERVAL = 0.005
+MAX_SECONDS = 300
+TRACE_FRAMES = 10
+
+def frame_name(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+class Sampler:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.thread = None
+        self.stacks = Counter()  # (thread name, frame names root first) -> samples
+        self.samples = 0
+        self.started = None
+        self.seconds = 0
+
+    def running(self) -> bool:
+        return self.thread is not None and self.thread.is_alive()
+
+    def remaining(self) -> float:
+        return max(0, self.started + self.seconds - time.monotonic())
+
+    def start(self, seconds: float, interval: float = SAMPLE_INTERVAL) -> bool:
+        # False if a run is already going
+        with self.lock:
+            if self.running():
+                return False
+            self.stacks = Counter()
+            self.samples = 0
+            self.started = time.monotonic()
+            self.seconds = min(seconds, MAX_SECONDS)
+            self.thread = threading.Thread(target=self._run, args=(self.seconds, interval), name="profile-sampler", daemon=True)
+            self.thread.start()
+        log(f"profiling every thread for {self.seconds}s")
+        return True
+
+    def _run(self, seconds: float, interval: float):
+        me = threading.get_ident()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(frame_name(frame))
+                    frame = frame.f_back
+                self.stacks[(names.get(ident, str(ident)), tuple(reversed(stack)))] += 1
+            self.samples += 1
+            time.sleep(interval)
+        log(f"profiled {self.samples} samples")
+
+    def collapsed(self) -> str:
+        return "".join(f"{';'.join((thread,) + stack)} {count}\n" for (thread, stack), count in self.stacks.most_common())
+
+    def top(self, limit: int = 40) -> str:
+        # like pstats sorted by cumulative time, in samples: own is time in the function itself, total includes callees
+        own = Counter()
+        total = Counter()
+        for (thread, stack), count in self.stacks.items():
+            if stack:
+                own[(thread, stack[-1])] += count
+            for name in set(stack):
+                total[(thread, name)] += count
+        lines = [f"{self.samples} samples over {self.seconds}s", f"{'total':>7} {'own':>7}  thread / function"]
+        for (thread, name), count in total.most_common(limit):
+            lines.append(f"{count:>7} {own[(thread, name)]:>7}  {thread} / {name}")
+        return "\n".join(lines) + "\n"
+
+class MemoryTracer:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.previous = None
+
+    def start(self, frames: int = TRACE_FRAMES):
+        with self.lock:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(frames)
+                self.previous = None
+                log(f"tracing allocations, {frames} frames deep")
+
+    def stop(self):
+        with self.lock:
+            tracemalloc.stop()
+            self.previous = None
+            log("stopped tracing allocations")
+
+    def report(self, limit: int = 30) -> str:
+        # the biggest allocation sites now, and what changed since the last report
+        with self.lock:
+            if not tracemalloc.is_tracing():
+                return None
+            snapshot = tracemalloc.take_snapshot().filter_traces([
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+            ])
+            previous, self.previous = self.previous, snapshot
+        current, peak = tracemalloc.get_traced_memory()
+        lines = [f"traced {current / 1e6:.1f} MB now, {peak / 1e6:.1f} MB at peak", "", "top allocation sites:"]
+        lines += [str(stat) for stat in snapshot.statistics('lineno')[:limit]]
+        if previous is not None:
+            lines += ["", "changed since the last snapshot:"]
+            lines += [str(stat) for stat in snapshot.compare_to(previous, 'lineno')[:limit]]
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,51 @@
+# short-lived response cache for expensive read endpoints (status, snapshot)
+#
+# a response is kept for `ttl` seconds, keyed by the request and the change log's seq at the time it was
+# computed (see changes.py): any write moves the seq and retires it, so within the ttl it's never staler
+# than a change we know about.  changes made out-of-band without --watch are at most `ttl` seconds late.
+# handlers run one at a time on the event loop, so there is never an identical request in flight to wait for,
+# the win is a client (or several) polling faster than the notes change.
+
+import threading
+import time
+
+from kazhttp import KazHttpResponse
+
+def _copy(response: KazHttpResponse) -> KazHttpResponse:
+    # every request gets its own response object, the server sets keep_alive on it, the bytes are shared
+    return KazHttpResponse(response.status, response.body, response.mimetype, response.keep_alive, response.extra_headers)
+
+class ResponseCache:
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = {}  # key -> (cursor, computed_at, response)
+
+        # stats
+        self.computed = 0
+        self.hits = 0
+
+    def stats(self):
+        with self.lock:
+            return {'computed': self.computed, 'hits': self.hits, 'entries': len(self.entries)}
+
+    def get(self, key, cursor: int, compute) -> KazHttpResponse:
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] == cursor and now - entry[1] < self.ttl:
+                self.hits += 1
+                return _copy(entry[2])
+
+        response = compute()
+        with self.lock:
+            self._expire(now)
+            self.entries[key] = (cursor, now, response)
+            self.computed += 1
+        return _copy(response)
+
+    def _expire(self, now: float):
+        # lock held
+        stale = [key for key, (_, computed_at, _) in self.entries.items() if now - computed_at >= self.ttl]
+        for key in stale:
+            del self.entries[key]
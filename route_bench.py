@@ -0,0 +1,131 @@
+# micro-benchmark of per-request dispatch: the routes simple_server.py registers against the startswith chain
+# it used to walk, and the static file table against scanning lists the way it used to, for typical paths.
+# prints the best ns per dispatch for each path, and how many times faster than the old way it is.  nothing is handled.
+#
+# python route_bench.py
+# python route_bench.py --rounds 20
+
+import argparse
+import sys
+import timeit
+
+REQUESTS = [
+    ('GET', '/api/status'),
+    ('GET', '/api/changes/1234'),
+    ('GET', '/api/get/core/0b6f3a.note,9c2e71.note'),
+    ('PUT', '/api/put/core/0b6f3a.note'),
+    ('GET', '/api/raw/core/0b6f3a.note'),
+    ('GET', '/api/status/core,journal'),
+    ('GET', '/api/nope'),
+]
+
+ASSETS = ["style.css", "boolean-state.js", "calendar.js", "components.js", "date-util.js", "delta.js", "filedb.js",
+          "flatdb.js", "global.js", "indexed-fs.js", "parse.js", "ref.js", "render.js", "remote.js", "rewrite.js",
+          "socket.js", "state.js", "status.js", "sync.js", "manifest.json", "service-worker.js"]
+ICONS = ["favicon.ico", "icon512.png", "icon192.png", "maskable_icon.png", "maskable_icon_x192.png"]
+STATIC_REQUESTS = ['/sync.js', '/style.css', '/icon192.png', '/', '/some/page']
+
+def load_routes():
+    # simple_server.py parses its arguments when it's imported, and opens nothing until main()
+    argv, sys.argv = sys.argv, [sys.argv[0], '--port', '0']
+    try:
+        import simple_server
+    finally:
+        sys.argv = argv
+    return simple_server.routes
+
+def chain(method: str, path: str):
+    # the old handle_api_request, minus the handlers
+    path = path.removeprefix('/api')
+    if path.startswith('/list/') and method == 'GET':
+        return path.removeprefix('/list/')
+    elif path.startswith('/get/') and method == 'GET':
+        repo, uuids = path.removeprefix('/get/').split('/', 1)
+        return repo, uuids.split(',')
+    elif path.startswith('/raw/') and method == 'GET':
+        return path.removeprefix('/raw/')
+    elif path.startswith('/signature/') and method == 'GET':
+        return path.removeprefix('/signature/')
+    elif path.startswith('/delta/') and method == 'POST':
+        return path.removeprefix('/delta/')
+    elif path.startswith('/patch/') and method == 'PUT':
+        return path.removeprefix('/patch/')
+    elif path.startswith('/put/') and method == 'PUT':
+        return path.removeprefix('/put/')
+    elif path == '/put-batch' and method == 'PUT':
+        return path
+    elif path.startswith('/admin/'):
+        return path
+    elif path == '/metrics' and method == 'GET':
+        return path
+    elif path == '/stats' and method == 'GET':
+        return path
+    elif path == '/ws' and method == 'GET':
+        return path
+    elif path == '/events' and method == 'GET':
+        return path
+    elif path.startswith('/changes/') and method == 'GET':
+        try:
+            return int(path.removeprefix('/changes/'))
+        except ValueError:
+            return None
+    elif path.startswith('/blob/') and method == 'GET':
+        return path.removeprefix('/blob/')
+    elif path.startswith('/snapshots/') and method == 'GET':
+        return path.removeprefix('/snapshots/')
+    elif path.startswith('/snapshot/') and method == 'POST':
+        return path.removeprefix('/snapshot/')
+    elif path.startswith('/snapshot/') and method == 'GET':
+        return path.removeprefix('/snapshot/')
+    elif path.startswith('/status') and method == 'GET':
+        return path
+    return None
+
+def static_scan(path: str):
+    # the old handle_request: tables rebuilt per request, then list membership
+    mimetype_table = {"manifest.json": b"application/manifest+json", ".html": b"text/html", ".css": b"text/css",
+                      ".js": b"text/javascript", ".png": b"image/png", ".ico": b"image/x-icon"}
+    assets = list(ASSETS)
+    icons = list(ICONS)
+    name = path.removeprefix("/")
+    if name in icons:
+        return "icons/" + name, mimetype_table[name[name.rindex('.'):]]
+    elif name in assets:
+        return "assets/" + name, next(mt for ending, mt in mimetype_table.items() if name.endswith(ending))
+    return 'assets/index.html', b"text/html"
+
+STATIC_FILES = {'/' + name: ('assets/' + name, b"") for name in ASSETS}
+STATIC_FILES.update({'/' + name: ('icons/' + name, b"") for name in ICONS})
+INDEX = ('assets/index.html', b"text/html")
+
+def static_table(path: str):
+    return STATIC_FILES.get(path, INDEX)
+
+def bench(dispatchers, requests, rounds: int, number: int = 5000):
+    # the best of `rounds` runs for each request and dispatcher, interleaved so a noisy neighbour hits them alike
+    best = {}
+    for _ in range(rounds):
+        for request in requests:
+            for name, dispatch in dispatchers.items():
+                seconds = min(timeit.repeat(lambda: dispatch(*request), number=number, repeat=3)) / number
+                best[(request, name)] = min(best.get((request, name), seconds), seconds)
+    for request in requests:
+        times = [best[(request, name)] for name in dispatchers]
+        print(f"{' '.join(request):<44}" + "".join(f"{name} {seconds * 1e9:>6.0f} ns  " for name, seconds in zip(dispatchers, times))
+              + f"{times[1] / times[0]:.1f}x")
+
+def main():
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument("--rounds", type=int, default=10, help="Runs to take the best of for each path")
+    args = argparser.parse_args()
+
+    router = load_routes()
+    for method, path in REQUESTS:
+        print(f"{method} {path} -> {(router.match(method, path) or (None, None, None))[1:]}")
+    print()
+    bench({'router': router.match, 'chain': chain}, REQUESTS, args.rounds)
+    print()
+    bench({'table': static_table, 'scan': static_scan}, [(path,) for path in STATIC_REQUESTS], args.rounds)
+
+if __name__ == "__main__":
+    main()
@@ -1,26 +1,130 @@
 # current TODO for compatibility with pipeline python impl
 # GET /api/get/<note> - returns raw text of note
+# GET /api/raw/<repo>/<note> - the note's content as text/plain, gzipped as stored if the client accepts it
 # GET /api/list/<repo> - returns a json of all note uuids
+# GET /api/stats - returns a json of cache hit/miss and write counters
+# GET /api/metrics - the same and per-route request latency and sizes, in prometheus text format
+# /api/admin/... - profiling and allocation tracing of the live server, from localhost or wireguard only, see admin_route
+# GET /api/changes/<seq> - returns a json of the notes that changed after <seq>, see changes.py
+# GET /api/events - server-sent events, {path, sha, seq} for each note as it changes (sha is null if it was removed).
+#   a `resync` event means changes were missed and the client should compare a full /api/status.
+# GET /api/ws - websocket for a whole sync session, any of these requests can be sent over it, see websocket_session
 
 # PUT /api/put/<note> - stores the body into the note file
+# PUT /api/put-batch - body is a json of <repo>/<note> to content, stores them all in one group commit
+
+# block deltas, see delta.py
+# GET /api/signature/<repo>/<note> - block signature of the note, x-hash is the hash it was computed over
+# POST /api/delta/<repo>/<note> - body is a signature of the client's copy, returns a delta to the server's copy
+# PUT /api/patch/<repo>/<note> - body is a delta against the x-base-hash version, stores the result
+
+# GET /api/snapshot/<repo> - returns a json of all notes in the repo
+# storage with snapshots (--storage blob):
+# POST /api/snapshot/<repo> - records a point-in-time snapshot of the repo, returns its id
+# GET /api/snapshots/<repo> - returns a json of snapshot ids
+# GET /api/snapshot/<repo>@<id> - returns a json of all notes in the repo as of that snapshot
+# storage with blobs (--storage blob):
+# GET /api/blob/<sha256> - raw note content by hash, cacheable forever
+
+# under overload requests are answered 503 with a Retry-After, expensive ones (EXPENSIVE_ROUTES) are queued behind
+# the rest, and a client going past --client-rate gets a 429.  see admission control in kazhttp.py
+
+# with --compress notes are gzipped at rest.  responses to clients that send `Accept-Encoding: gzip` are gzipped
+# either way, from the stored bytes (raw, blob) or from the cache's deflated json members (get, snapshot).
 
 # Python3.7+
 import os
-import hashlib
 import argparse
-
-from kazhttp import HTTP_OK, HTTP_NOT_FOUND, HTTP_OK_JSON, allow_cors_for_localhost, log, run, KazHttpResponse
+import json
+import time
+import base64
+import ipaddress
+import traceback
+
+from kazhttp import KazStream, KazEventStream, KazWebSocket, is_websocket_upgrade, HTTP_OK, HTTP_NOT_FOUND, HTTP_OK_JSON, HTTP_BAD_REQUEST, HTTP_CONFLICT, allow_cors_for_localhost, accepts_gzip, deflate_piece, gzip_pieces, Router, timed, begin_timing, end_timing, add_server_timing, log, debug, error, set_log_level, LOG_LEVELS, run, KazHttpResponse, tls_stats, TLS_SESSION_TICKETS, connection_stats, recv_buffers, metrics, MAX_CONNECTIONS, IDLE_TIMEOUT_SECONDS, AdmissionControl, PRIORITY_CHEAP, PRIORITY_EXPENSIVE, MAX_QUEUED_REQUESTS, CLIENT_RATE, CLIENT_BURST
+import delta
+import storage
+from wal import WriteAheadLog, WAL_NAME
+from blobstore import BlobStore
+from packstore import PackStore
+from cache import NoteCache, json_key
+from hashindex import HashIndex
+from changes import ChangeLog
+from watcher import Watcher
+from responsecache import ResponseCache
+from profiling import Sampler, MemoryTracer, SAMPLE_INTERVAL, TRACE_FRAMES
 
 argparser = argparse.ArgumentParser(description="Run a simple pipeline replication/sync server")
-argparser.add_argument("--port", type=int, required=True, help="Port to host the server on")
+argparser.add_argument("--port", type=int, help="Port to host the server on")
 argparser.add_argument("--notes-root", type=str, help="Root directory for notes", default=os.path.join(os.path.expanduser('~'), "notes"))
 argparser.add_argument("--host", type=str, help="Host to bind to", default="")
 argparser.add_argument("--no-api", action="store_true", help="Disable the api server.  Used for debugging service worker failures and caching failures by providing fresh new assets from a wireguard config that has the same IP.")
 argparser.add_argument("--cert-folder", type=str, help="Folder containing cert.pem and key.pem", default="cert")
+argparser.add_argument("--fsync-window", type=float, help="Seconds a group of concurrent writers waits for more before fsyncing, a lone writer never waits", default=0.01)
+argparser.add_argument("--storage", choices=["loose", "blob", "pack"], help="How notes are laid out in the notes root: one file per note, content-addressed blobs with per-repo ref tables, or one append-only pack and index per repo", default="loose")
+argparser.add_argument("--fanout", action="store_true", help="With --storage loose, store notes at <repo>/<ab>/<uuid> so directories stay small.  See migrate_layout.py")
+argparser.add_argument("--gc-interval", type=float, help="Seconds between sweeps of unreferenced blobs with --storage blob", default=3600)
+argparser.add_argument("--compact-interval", type=float, help="Seconds between pack compactions with --storage pack", default=600)
+argparser.add_argument("--cache-bytes", type=int, help="Memory budget for caching note contents served by /api/get, 0 to disable", default=64 * 1024 * 1024)
+argparser.add_argument("--compress", action="store_true", help="Store notes gzipped.  Notes already stored stay readable either way")
+argparser.add_argument("--wal", action="store_true", help="Acknowledge puts once they're appended to a write-ahead log in the notes root, and write the note files in the background")
+argparser.add_argument("--hash-workers", type=int, help="Threads that hash notes changed since the hash index last saw them, with --storage loose", default=os.cpu_count())
+argparser.add_argument("--reindex", action="store_true", help="Rehash every note into the hash index with --storage loose, report throughput and exit")
+argparser.add_argument("--watch", action="store_true", help="With --storage loose, pick up notes edited outside the server as they change (inotify), instead of by stat-ing every note on /api/status")
+argparser.add_argument("--watch-interval", type=float, help="Seconds between scans of the notes root with --watch where inotify isn't available", default=5)
+argparser.add_argument("--session-tickets", type=int, help="TLS 1.3 session tickets issued per full handshake, so reconnects can resume without one.  0 disables resumption by ticket", default=TLS_SESSION_TICKETS)
+argparser.add_argument("--max-connections", type=int, help="Open connections to allow, past it the least recently used idle keep-alive connection is closed", default=MAX_CONNECTIONS)
+argparser.add_argument("--idle-timeout", type=float, help="Seconds a keep-alive connection can sit without a request before it's closed", default=IDLE_TIMEOUT_SECONDS)
+argparser.add_argument("--log-level", choices=list(LOG_LEVELS), help="debug logs every request as it's read and answered", default="info")
+argparser.add_argument("--access-log", type=str, help="Append a json line per request with its phase timings to this file.  See access_report.py")
+argparser.add_argument("--admin-networks", type=str, help="Comma separated networks allowed to use /api/admin.  Loopback and, with --host, the /24 it's in (the wireguard network) always are", default="")
+argparser.add_argument("--max-queued", type=int, help="Requests read and waiting to be answered, past it they're answered 503", default=MAX_QUEUED_REQUESTS)
+argparser.add_argument("--client-rate", type=float, help="Requests per second a client address is allowed on average, expensive ones count for more.  0 turns the limit off, e.g. behind a proxy", default=CLIENT_RATE)
+argparser.add_argument("--client-burst", type=float, help="Requests a client address can make at once before --client-rate applies", default=CLIENT_BURST)
+argparser.add_argument("--response-cache-ttl", type=float, help="Seconds an /api/status or /api/snapshot response is reused for identical requests while no note changes", default=1.0)
 args = argparser.parse_args()
+set_log_level(args.log_level)
+if args.port is None and not args.reindex:
+    argparser.error("--port is required")
 
 NOTES_ROOT = args.notes_root
 HOST, PORT = args.host, args.port
+writer = storage.DurableWriter(window=args.fsync_window)
+hash_index = None
+wal = None
+watcher = None
+if args.storage == "blob":
+    notes = BlobStore(NOTES_ROOT, writer, compress=args.compress)
+elif args.storage == "pack":
+    notes = PackStore(NOTES_ROOT, compress=args.compress)
+else:
+    notes = hash_index = HashIndex(NOTES_ROOT, storage.LooseStore(NOTES_ROOT, writer, fanout=args.fanout, compress=args.compress), workers=args.hash_workers)
+if args.wal:
+    notes = wal = WriteAheadLog(NOTES_ROOT, notes)
+notes = cache = NoteCache(notes, args.cache_bytes)
+notes = changes = ChangeLog(notes)
+if hash_index is not None and args.watch:
+    watcher = Watcher(NOTES_ROOT, hash_index, changes, interval=args.watch_interval)
+responses = ResponseCache(ttl=args.response_cache_ttl)
+
+metrics.callback('kaz_cache_requests_total', "Note reads through the cache", 'counter', lambda: {('hit',): cache.hits, ('miss',): cache.misses}, ('result',))
+metrics.callback('kaz_cache_bytes', "Bytes the note cache holds", 'gauge', lambda: cache.bytes)
+metrics.callback('kaz_disk_read_bytes_total', "Note bytes read from the notes root, for serving and for hashing", 'counter',
+                 lambda: {('serve',): cache.bytes_read, ('hash',): hash_index.bytes_hashed if hash_index is not None else 0}, ('purpose',))
+metrics.callback('kaz_notes_committed_total', "Notes made durable by the writer", 'counter', lambda: writer.notes_committed)
+if hash_index is not None:
+    metrics.callback('kaz_hash_index_lookups_total', "Note hashes answered from the index, or hashed from the file", 'counter',
+                     lambda: {('hit',): hash_index.hits, ('miss',): hash_index.hashed}, ('result',))
+
+sampler = Sampler()
+memory_tracer = MemoryTracer()
+
+admin_networks = [ipaddress.ip_network("127.0.0.0/8"), ipaddress.ip_network("::1/128")]
+admin_networks += [ipaddress.ip_network(network.strip(), strict=False) for network in args.admin_networks.split(',') if network.strip()]
+try:
+    admin_networks.append(ipaddress.ip_network(HOST + "/24", strict=False))
+except ValueError:
+    pass  # bound to every interface or a hostname
 
 # provide .removeprefix if it doesn't have it (e.g. python 3.8 on ubuntu 20.04)
 if not hasattr(str, 'removeprefix'):
@@ -30,11 +134,7 @@ if not hasattr(str, 'removeprefix'):
         return self
     str.removeprefix = removeprefix
 
-def get_repo_path(repo):
-    return os.path.join(NOTES_ROOT, repo)
-
-def hash_content(content) -> str:
-    return hashlib.sha256(content).hexdigest()
+hash_content = storage.hash_content
 
 def hash(path) -> str:
     with open(path, "rb") as f:
@@ -42,11 +142,9 @@ def hash(path) -> str:
 
 def compute_status(repos, headers) -> KazHttpResponse:
     def hash_repo(repo):
-        repo_path = get_repo_path(repo)
-        if not os.path.isdir(repo_path):
-            return {}
-        else:
-            return {os.path.join(repo, uuid): hash(os.path.join(repo_path, uuid)) for uuid in os.listdir(repo_path)}
+        with timed('hash'):
+            hashes = notes.hashes(repo)
+        return {os.path.join(repo, uuid): sha for uuid, sha in hashes.items()}
 
     for repo in repos:
         if '/' in repo or '..' in repo:
@@ -57,194 +155,634 @@ def compute_status(repos, headers) -> KazHttpResponse:
     return HTTP_OK_JSON(status, extra_header=cors_header)
 
 
-def handle_api_request(request) -> KazHttpResponse:
-    if args.no_api:
-        return HTTP_NOT_FOUND("this is a non-api server")
-
-    method = request['method']
+def cached(path, headers, compute) -> KazHttpResponse:
+    # identical requests reuse a response until a note changes, see responsecache.py
+    key = (path, accepts_gzip(headers), allow_cors_for_localhost(headers))
+    return responses.get(key, changes.seq, compute)
+
+GZIP_HEADERS = b"Content-Encoding: gzip\r\n"
+VARY_HEADER = b"Vary: Accept-Encoding\r\n"
+DEFLATED_OPEN, DEFLATED_SEPARATOR, DEFLATED_CLOSE = deflate_piece(b"{"), deflate_piece(b", "), deflate_piece(b"}")
+
+def notes_json_response(repo, uuids, headers, extra_headers) -> KazHttpResponse:
+    # {"<repo>/<uuid>": <content>, ...}, joined from the cache's pre-encoded notes
+    extra_headers += VARY_HEADER
+    if not accepts_gzip(headers):
+        # the notes are sent from the cache's buffers as they are, not copied into one body
+        body = [b"{"]
+        for i, uuid in enumerate(uuids):
+            if i:
+                body.append(b", ")
+            body.extend([json_key(repo, uuid), b": ", notes.read_json(repo, uuid)])
+        body.append(b"}")
+        return HTTP_OK(body, mimetype=b"application/json", extra_headers=extra_headers)
+
+    pieces = [DEFLATED_OPEN]
+    data = [b"{"]
+    for i, uuid in enumerate(uuids):
+        fragment, deflated = notes.read_json_deflated(repo, uuid)
+        if i:
+            pieces.append(DEFLATED_SEPARATOR)
+            data.append(b", ")
+        pieces.append(deflated)
+        data.extend([json_key(repo, uuid), b": ", fragment])
+    pieces.append(DEFLATED_CLOSE)
+    data.append(b"}")
+    with timed('encode'):
+        body = gzip_pieces(pieces, data)
+    return HTTP_OK(body, mimetype=b"application/json", extra_headers=extra_headers + GZIP_HEADERS)
+
+def stored_response(stored, headers, extra_headers) -> KazHttpResponse:
+    # a note as it's stored: passed through if it's gzipped and the client takes gzip, decompressed otherwise
+    extra_headers += VARY_HEADER
+    if storage.is_compressed(stored) and accepts_gzip(headers):
+        return HTTP_OK(bytes(stored), mimetype=b"text/plain", extra_headers=extra_headers + GZIP_HEADERS)
+    with timed('encode'):
+        stored = storage.decompress(stored)
+    return HTTP_OK(stored, mimetype=b"text/plain", extra_headers=extra_headers)
+
+def event_stream(headers, cors_header) -> KazEventStream:
+    stream = KazEventStream(extra_headers=cors_header)
+
+    def listener(change):
+        if change is None:
+            stream.send(json.dumps({'seq': changes.seq}), event='resync', id=changes.seq)
+            return
+        seq, repo, uuid, sha = change
+        stream.send(json.dumps({'path': repo + '/' + uuid, 'sha': sha, 'seq': seq}), id=seq)
+
+    # EventSource sends the last id it saw when it reconnects, everything after it is replayed
+    try:
+        cursor = int(headers['last-event-id'])
+    except (KeyError, ValueError):
+        cursor = None
+    seq = changes.subscribe(listener, cursor)
+    if cursor is None:
+        stream.send(json.dumps({'seq': seq}), event='ready', id=seq)
+    stream.on_close = lambda: changes.unsubscribe(listener)
+    return stream
+
+def response_message(message_id, response: KazHttpResponse) -> dict:
+    headers = {'content-type': response.mimetype.decode()}
+    # some extra headers (the CORS one) end in a bare \n
+    for line in response.extra_headers.decode().replace('\r\n', '\n').split('\n'):
+        if ': ' in line:
+            key, value = line.split(': ', 1)
+            headers[key.lower()] = value
+    message = {'id': message_id, 'status': int(response.status.split()[0]), 'headers': headers}
+    body = response.body_bytes()
+    try:
+        message['body'] = body.decode('utf-8')
+    except UnicodeDecodeError:
+        message['body_base64'] = base64.b64encode(body).decode()
+    return message
+
+def websocket_session(headers, cors_header) -> KazWebSocket:
+    # one connection for a whole sync instead of a fetch per request.  the client sends json messages:
+    #   {id, method, path, headers, body or body_base64} - any /api request, answered with
+    #   {id, status, headers, body or body_base64} in whatever order they finish
+    #   {id, method: "SUBSCRIBE", since} - change notifications like /api/events, pushed as
+    #   {event: "change", path, sha, seq} or {event: "resync", seq}
+    listeners = []
+
+    def subscribe(websocket, message):
+        def listener(change):
+            if change is None:
+                websocket.send_text(json.dumps({'event': 'resync', 'seq': changes.seq}))
+                return
+            seq, repo, uuid, sha = change
+            websocket.send_text(json.dumps({'event': 'change', 'path': repo + '/' + uuid, 'sha': sha, 'seq': seq}))
+        listeners.append(listener)
+        return changes.subscribe(listener, message.get('since'))
+
+    def on_message(websocket, opcode, payload):
+        message_id = None
+        try:
+            message = json.loads(payload)
+            message_id = message['id']
+            if message['method'] == 'SUBSCRIBE':
+                websocket.send_text(json.dumps({'id': message_id, 'status': 200, 'seq': subscribe(websocket, message)}))
+                return
+            if 'body_base64' in message:
+                body = base64.b64decode(message['body_base64'])
+            else:
+                body = message.get('body', '').encode('utf-8')
+            request = {
+                'method': message['method'],
+                'path': message['path'],
+                'httpver': 'HTTP/1.1',
+                'headers': {key.lower(): value for key, value in message.get('headers', {}).items()},
+                'body': body,
+                'connection': 'keep-alive',
+            }
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            websocket.send_text(json.dumps({'id': message_id, 'status': 400, 'body': f"bad message: {e}"}))
+            return
+
+        if not request['path'].startswith('/api/'):
+            response = HTTP_NOT_FOUND(b"only /api requests go over the websocket")
+            websocket.send_text(json.dumps(response_message(message_id, response)))
+            return
+        # queued, prioritized and rate limited like the same request over http.  SUBSCRIBE above isn't,
+        # it only registers a listener and the changes it pushes are written as the socket takes them
+        websocket.queue_request(request, lambda request, shed: answer(websocket, message_id, request, shed))
+
+    def answer(websocket, message_id, request, shed):
+        if shed is not None:
+            websocket.send_text(json.dumps(response_message(message_id, shed)))
+            return
+        handler_started = time.perf_counter()
+        begin_timing()
+        try:
+            response = handle_api_request(request)
+        except Exception as e:
+            # the details (paths under the notes root) only go to the log
+            error(f"websocket request {request['method']} {request['path']} failed: {e}")
+            error("".join(traceback.format_exception(e)))
+            response = KazHttpResponse(b"500 INTERNAL_SERVER_ERROR", b"HTTP 500: internal server error\n")
+        finally:
+            phases = end_timing()
+        if isinstance(response, KazHttpResponse):
+            add_server_timing(response, {'queue': request.get('queue_seconds', 0.0), 'handler': time.perf_counter() - handler_started, **phases})
+        if isinstance(response, KazStream):
+            response.close()
+            if response.on_close is not None:
+                response.on_close()
+            response = HTTP_BAD_REQUEST(b"streams aren't available over the websocket, SUBSCRIBE instead")
+        websocket.send_text(json.dumps(response_message(message_id, response)))
+
+    websocket = KazWebSocket(headers['sec-websocket-key'], on_message, extra_headers=cors_header)
+    websocket.on_close = lambda: [changes.unsubscribe(listener) for listener in listeners]
+    return websocket
+
+def snapshot_response(repo, headers, cors_header) -> KazHttpResponse:
+    if '@' in repo:
+        if 'snapshots' not in notes.features:
+            return HTTP_NOT_FOUND(b"snapshots need --storage blob")
+        repo, snapshot_id = repo.split('@', 1)
+        try:
+            table = notes.read_snapshot(repo, snapshot_id)
+        except FileNotFoundError:
+            return HTTP_NOT_FOUND(b"no snapshot: " + snapshot_id.encode())
+        contents = {repo + '/' + uuid: notes.read_blob(sha).decode('utf-8') for uuid, sha in table.items()}
+        return HTTP_OK_JSON(contents, extra_header=cors_header)
+    try:
+        uuids = notes.list(repo)
+    except FileNotFoundError:
+        return HTTP_NOT_FOUND(b"no repo: " + repo.encode())
+    return notes_json_response(repo, uuids, headers, cors_header)
+
+def is_admin(request) -> bool:
+    # a proxy in front of us connects from localhost, so it has to say who it's forwarding for
+    addresses = [request.get('client')] + [address.strip() for address in request['headers'].get('x-forwarded-for', '').split(',') if address.strip()]
+    try:
+        return all(any(ipaddress.ip_address(address) in network for network in admin_networks) for address in addresses)
+    except (ValueError, TypeError):
+        return False
+
+def query_params(request) -> dict:
+    query = request['path'].partition('?')[2]
+    return dict(param.split('=', 1) for param in query.split('&') if '=' in param)
+
+# routes, see kazhttp.Router.  handlers take the request, the cors header for it, and the pattern's params
+
+routes = Router()
+
+def api_route(method: str, pattern: str):
+    # registers the handler under /api, and skips it on a --no-api server
+    def register(handler):
+        def api_handler(request, cors_header, **params):
+            if args.no_api:
+                return HTTP_NOT_FOUND("this is a non-api server")
+            return handler(request, cors_header, **params)
+        routes.add(method, '/api' + pattern, api_handler)
+        return handler
+    return register
+
+def admin_route(method: str, pattern: str):
+    # profiling and allocation tracing of the live server, from localhost or wireguard only
+    def register(handler):
+        def admin_handler(request, cors_header, **params):
+            if not is_admin(request):
+                return KazHttpResponse(b"403 Forbidden", b"HTTP 403: admin endpoints are only for localhost and the wireguard network\n")
+            try:
+                return handler(request, cors_header, **params)
+            except ValueError as e:
+                return HTTP_BAD_REQUEST(b"bad parameter: " + str(e).encode())
+        routes.add(method, '/api/admin' + pattern, admin_handler)
+        return handler
+    return register
+
+@api_route('GET', '/list/<repo>')
+def list_notes(request, cors_header, repo):
+    debug('listing notes')
+    return HTTP_OK_JSON(notes.list(repo), extra_header=cors_header)
+
+@api_route('GET', '/get/<repo>/<uuids:path>')
+def get_notes(request, cors_header, repo, uuids):
+    # <repo>/<note>(,<note>)*
+    # consider making this a POST request and putting the uuids in the body as a json.
+    # - within the spirit of http, we're "getting" the notes.  we _should_ use a 'GET' request.
+    return notes_json_response(repo, uuids.split(','), request['headers'], cors_header)
+
+@api_route('GET', '/raw/<note:path>')
+def get_raw(request, cors_header, note):
+    repo_uuid = storage.split_note(note)
+    if repo_uuid is None or not notes.exists(*repo_uuid):
+        return HTTP_NOT_FOUND(b"no note: " + note.encode())
+    with timed('disk'):
+        stored = notes.read_stored(*repo_uuid)
+    return stored_response(stored, request['headers'], cors_header)
+
+@api_route('GET', '/signature/<note:path>')
+def get_signature(request, cors_header, note):
+    repo_uuid = storage.split_note(note)
+    if repo_uuid is None or not notes.exists(*repo_uuid):
+        return HTTP_NOT_FOUND(b"no note: " + note.encode())
+    content = notes.read(*repo_uuid)
+    hash_header = b"x-hash: " + hash_content(content).encode() + b"\r\n"
+    return HTTP_OK(delta.signature(content), mimetype=b"application/octet-stream", extra_headers=cors_header + hash_header)
+
+@api_route('POST', '/delta/<note:path>')
+def post_delta(request, cors_header, note):
+    repo_uuid = storage.split_note(note)
+    if repo_uuid is None or not notes.exists(*repo_uuid):
+        return HTTP_NOT_FOUND(b"no note: " + note.encode())
+    content = notes.read(*repo_uuid)
+    try:
+        result = delta.make_delta(request['body'], content)
+    except delta.DeltaError as e:
+        return HTTP_BAD_REQUEST(b"bad signature: " + str(e).encode())
+    debug(f"delta for {note}: {len(result)} bytes for a {len(content)} byte note")
+    hash_header = b"x-hash: " + hash_content(content).encode() + b"\r\n"
+    return HTTP_OK(result, mimetype=b"application/octet-stream", extra_headers=cors_header + hash_header)
+
+@api_route('PUT', '/patch/<note:path>')
+def put_patch(request, cors_header, note):
+    headers, body = request['headers'], request['body']
+    repo_uuid = storage.split_note(note)
+    if repo_uuid is None or not notes.exists(*repo_uuid):
+        return HTTP_NOT_FOUND(b"no note: " + note.encode())
+    base = notes.read(*repo_uuid)
+
+    # the delta only makes sense against the exact version the client took the signature of
+    current_hash = hash_content(base)
+    if headers.get('x-base-hash') != current_hash:
+        return HTTP_CONFLICT(b"base changed for " + note.encode(), extra_headers=b"x-hash: " + current_hash.encode() + b"\r\n")
+    try:
+        content = delta.apply_delta(base, body)
+    except delta.DeltaError as e:
+        return HTTP_BAD_REQUEST(b"bad delta: " + str(e).encode())
+    if 'x-hash' in headers and headers['x-hash'] != hash_content(content):
+        return HTTP_BAD_REQUEST(b"patched note does not match x-hash: " + note.encode())
+
+    with timed('disk'):
+        notes.write_many([(*repo_uuid, content)])
+    log(f"patched notes/{note} with {len(body)} byte delta")
+    return HTTP_OK(b"wrote notes/" + note.encode(), mimetype=b"text/plain")
+
+@api_route('PUT', '/put/<note:path>')
+def put_note(request, cors_header, note):
+    debug(note)
+
+    # the note is of format <repo>/<uuid>.note
+    repo_uuid = storage.split_note(note)
+    if repo_uuid is None:
+        return HTTP_NOT_FOUND(b"bad note: " + note.encode())
+
+    with timed('disk'):
+        notes.write_many([(*repo_uuid, request['body'])])
+    log("wrote notes/" + note)
+    return HTTP_OK(b"wrote notes/" + note.encode(), mimetype=b"text/plain")
+
+@api_route('PUT', '/put-batch')
+def put_batch(request, cors_header):
+    try:
+        files = json.loads(request['body'])
+    except ValueError as e:
+        return HTTP_BAD_REQUEST(b"bad batch: " + str(e).encode())
+
+    items = []
+    for note, content in files.items():
+        repo_uuid = storage.split_note(note)
+        if repo_uuid is None or not isinstance(content, str):
+            return HTTP_BAD_REQUEST(b"bad note: " + note.encode())
+        items.append((*repo_uuid, content.encode('utf-8')))
+
+    with timed('disk'):
+        notes.write_many(items)
+    log(f"wrote {len(items)} notes in a batch")
+    return HTTP_OK(f"wrote {len(items)} notes".encode(), mimetype=b"text/plain", extra_headers=cors_header)
+
+@admin_route('POST', '/profile')
+def start_profile(request, cors_header):
+    # samples every thread's stack for ?seconds=N in the background
+    params = query_params(request)
+    if not sampler.start(float(params.get('seconds', 10)), float(params.get('interval', SAMPLE_INTERVAL))):
+        return HTTP_CONFLICT(f"already profiling, {sampler.remaining():.1f}s left".encode())
+    return HTTP_OK(f"profiling for {sampler.seconds}s, GET /api/admin/profile after\n".encode(), mimetype=b"text/plain", extra_headers=cors_header)
+
+@admin_route('GET', '/profile')
+def get_profile(request, cors_header):
+    # the last run as collapsed stacks for a flamegraph, ?format=top for a summary
+    params = query_params(request)
+    if sampler.started is None:
+        return HTTP_NOT_FOUND(b"nothing profiled yet, POST /api/admin/profile?seconds=N first")
+    if sampler.running():
+        return HTTP_CONFLICT(f"still profiling, {sampler.remaining():.1f}s left".encode())
+    report = sampler.top(int(params.get('limit', 40))) if params.get('format') == 'top' else sampler.collapsed()
+    return HTTP_OK(report.encode(), mimetype=b"text/plain", extra_headers=cors_header)
+
+@admin_route('POST', '/tracemalloc/start')
+def start_tracemalloc(request, cors_header):
+    memory_tracer.start(int(query_params(request).get('frames', TRACE_FRAMES)))
+    return HTTP_OK(b"tracing allocations\n", mimetype=b"text/plain", extra_headers=cors_header)
+
+@admin_route('POST', '/tracemalloc/stop')
+def stop_tracemalloc(request, cors_header):
+    memory_tracer.stop()
+    return HTTP_OK(b"stopped tracing allocations\n", mimetype=b"text/plain", extra_headers=cors_header)
+
+@admin_route('GET', '/tracemalloc')
+def get_tracemalloc(request, cors_header):
+    # top allocation sites, and the diff against the previous one of these
+    report = memory_tracer.report(int(query_params(request).get('limit', 30)))
+    if report is None:
+        return HTTP_NOT_FOUND(b"not tracing, POST /api/admin/tracemalloc/start first")
+    return HTTP_OK(report.encode(), mimetype=b"text/plain", extra_headers=cors_header)
+
+@api_route('GET', '/metrics')
+def get_metrics(request, cors_header):
+    return HTTP_OK(metrics.render(), b"text/plain; version=0.0.4", extra_headers=cors_header)
+
+@api_route('GET', '/stats')
+def get_stats(request, cors_header):
+    stats = {'cache': cache.stats(), 'writer': {
+        'groups_committed': writer.groups_committed,
+        'notes_committed': writer.notes_committed,
+        'syncs': writer.syncs,
+    }}
+    if hash_index is not None:
+        stats['hash_index'] = hash_index.stats()
+    stats['response_cache'] = responses.stats()
+    stats['tls'] = tls_stats.stats()
+    stats['connections'] = connection_stats.stats()
+    stats['recv_buffers'] = recv_buffers.stats()
+    stats['admission'] = admission.stats()
+    if watcher is not None:
+        stats['watcher'] = watcher.stats()
+    if wal is not None:
+        stats['wal'] = {'appends': wal.appends, 'syncs': wal.syncs, 'checkpoints': wal.checkpoints}
+    return HTTP_OK_JSON(stats, extra_header=cors_header)
+
+@api_route('GET', '/ws')
+def get_websocket(request, cors_header):
+    if not is_websocket_upgrade(request['headers']):
+        return HTTP_BAD_REQUEST(b"expected a websocket upgrade")
+    return websocket_session(request['headers'], cors_header)
+
+@api_route('GET', '/events')
+def get_events(request, cors_header):
+    return event_stream(request['headers'], cors_header)
+
+@api_route('GET', '/changes/<cursor:int>')
+def get_changes(request, cors_header, cursor):
+    seq, changed = changes.since(cursor)
+    if changed is None:
+        # too far behind, the client has to compare a full /api/status
+        return HTTP_OK_JSON({'seq': seq, 'resync': True}, extra_header=cors_header)
+    changed = [{'seq': n, 'note': repo + '/' + uuid, 'sha': sha} for n, repo, uuid, sha in changed]
+    return HTTP_OK_JSON({'seq': seq, 'changes': changed}, extra_header=cors_header)
+
+@api_route('GET', '/blob/<sha>')
+def get_blob(request, cors_header, sha):
+    if 'blobs' not in notes.features:
+        return HTTP_NOT_FOUND(b"blobs need --storage blob")
+    try:
+        with timed('disk'):
+            stored = notes.read_blob_stored(sha)
+    except FileNotFoundError:
+        return HTTP_NOT_FOUND(b"no blob: " + sha.encode())
+    # a blob's content is its name, it can never change
+    cache_header = b"Cache-Control: public, max-age=31536000, immutable\r\n"
+    return stored_response(stored, request['headers'], cors_header + cache_header)
+
+@api_route('GET', '/snapshots/<repo>')
+def list_snapshots(request, cors_header, repo):
+    if 'snapshots' not in notes.features:
+        return HTTP_NOT_FOUND(b"snapshots need --storage blob")
+    return HTTP_OK_JSON(notes.snapshots(repo), extra_header=cors_header)
+
+@api_route('POST', '/snapshot/<repo>')
+def take_snapshot(request, cors_header, repo):
+    if 'snapshots' not in notes.features:
+        return HTTP_NOT_FOUND(b"snapshots need --storage blob")
+    try:
+        snapshot_id = notes.snapshot(repo)
+    except FileNotFoundError:
+        return HTTP_NOT_FOUND(b"no repo: " + repo.encode())
+    log(f"snapshot {repo}@{snapshot_id}")
+    return HTTP_OK_JSON({'id': snapshot_id}, extra_header=cors_header)
+
+@api_route('GET', '/snapshot/<repo>')
+def get_snapshot(request, cors_header, repo):
     headers = request['headers']
-    body = request['body']
-    path = request['path']
-
-    assert path.startswith('/api')
-    path = path.removeprefix('/api')
-
-    cors_header = allow_cors_for_localhost(headers)
-
-    if path.startswith('/list/') and method == 'GET':
-        log('listing notes')
-        repo = path.removeprefix('/list/')
-        repo_path = get_repo_path(repo)
-        return HTTP_OK_JSON(os.listdir(repo_path), extra_header=cors_header)
-    elif path.startswith('/get/') and method == 'GET':
-        note = path.removeprefix('/get/')
-
-        # consider making this a POST request and putting the uuids in the body as a json.
-        # - within the spirit of http, we're "getting" the notes.  we _should_ use a 'GET' request.
-        repo_notes = path.removeprefix('/get/')
-        # <repo>/<note>(,<note>)*
-        repo, notes = repo_notes.split('/', 1)
-        notes = notes.split(',')
-        repo_path = get_repo_path(repo)
-        def read_file(path):
-            with open(path) as f:
-                return f.read()
-        read_notes = {repo + '/' + note: read_file(os.path.join(repo_path, note)) for note in notes}
-        return HTTP_OK_JSON(read_notes, extra_header=cors_header)
-    elif path.startswith('/put/') and method == 'PUT':
-        note = path.removeprefix('/put/')
-        log(note)
-
-        # the note is of format <repo>/<uuid>.note
-        if '/' not in note:
-            return HTTP_NOT_FOUND(b"bad note: " + note.encode())
-
-        # make folder if repo doesn't exist
-        repo, uuid = note.split('/')
-        if not os.path.isdir(os.path.join(NOTES_ROOT, repo)):
-            os.mkdir(os.path.join(NOTES_ROOT, repo))
-
-        with open(os.path.join(NOTES_ROOT, note), 'wb+') as f:
-            f.write(body)
-        log("wrote notes/" + note)
-        return HTTP_OK(b"wrote notes/" + note.encode(), mimetype=b"text/plain")
-    
-    elif path.startswith('/status') and method == 'GET':
-        not_repos = ['.git', 'raw']
-        is_repo = lambda x: os.path.isdir(os.path.join(NOTES_ROOT, x)) and x not in not_repos
-        repos = [repo for repo in os.listdir(NOTES_ROOT) if is_repo(repo)]
-        return compute_status(repos, headers)
-
-    elif path.startswith('/status/') and method == 'GET':
-        repos = path.removeprefix('/status/').split(',')
-        return compute_status(repos, headers)
-    else:
-        return HTTP_NOT_FOUND(b"api not found: " + path.encode() + b" method: " + method.encode())
+    return cached(request['path'], headers, lambda: snapshot_response(repo, headers, cors_header))
 
-def handle_request(request):
-    method = request['method']
-    path = request['path']
+@api_route('GET', '/status')
+def get_status(request, cors_header):
     headers = request['headers']
-    body = request['body']
-    connection = request['connection']
-
-    # Handle API paths
-
-    if path.startswith('/api'):
-        response = handle_api_request(request)
-        response.keep_alive = (connection == 'keep-alive')
-        return response
-
-    if path.startswith('/bundle/'):
-        path = path.removeprefix('/bundle/')
-        assets = path.split("+")
-        bundle = {}
-        for asset in assets:
-            with open('assets/' + asset, 'r') as f:
-                bundle[asset] = {'content': f.read(), 'x-hash': hash('assets/' + asset)}
-        result = HTTP_OK_JSON(bundle)
-        log('bundle size', len(result.body))
-        return result
-
-    # Handle paths for frontend pages
-
-    mimetype_table = {
-        "manifest.json": b"application/manifest+json",
-        ".html": b"text/html",
-        ".css": b"text/css",
-        ".js": b"text/javascript",
-        ".png": b"image/png",
-        ".ico": b"image/x-icon"
-    }
-
-    cacheable_assets = [
-        "style.css",
-        "boolean-state.js",
-        "calendar.js",
-        "components.js",
-        "date-util.js",
-        "filedb.js",
-        "flatdb.js",
-        "global.js",
-        "indexed-fs.js",
-        "parse.js",
-        "ref.js",
-        "render.js",
-        "remote.js",
-        "rewrite.js",
-        "state.js",
-        "status.js",
-        "sync.js",
-        "manifest.json",
-    ]
-
-    non_cacheable_assets = [
-        "service-worker.js",
-    ]
-
-    assets = cacheable_assets + non_cacheable_assets
-
-    icons = [
-        "favicon.ico",
-        "icon512.png",
-        "icon192.png",
-        "maskable_icon.png",
-        "maskable_icon_x192.png",
-    ]
-
-    if path == '/sw-index.html':
-        path = 'assets/index.html'
-        mimetype = b"text/html"
-    elif path == "/pipeline-cert.pem":
-        path = "cert/cert.pem"
-        mimetype = b"application/x-x509-ca-cert"
-    elif path.removeprefix("/") in icons:
-        path = "icons/" + path.removeprefix("/")
-        mimetype = mimetype_table[os.path.splitext(path)[1]]
-    elif path.removeprefix("/") in assets:
-        path = "assets/" + path.removeprefix("/")
-        mimetype = next(mt for file_ending, mt in mimetype_table.items() if path.endswith(file_ending))
-        assert mimetype is not None
-    else:
-        path = 'assets/index.html'
-        mimetype = b"text/html"
+    return cached(request['path'], headers, lambda: compute_status(notes.repos(), headers))
 
-    # Handle Static paths
+@api_route('GET', '/status/<repos>')
+def get_repo_status(request, cors_header, repos):
+    headers = request['headers']
+    return cached(request['path'], headers, lambda: compute_status(repos.split(','), headers))
+
+@routes.route('GET', '/bundle/<assets:path>')
+def get_bundle(request, cors_header, assets):
+    # {"<asset>": {"content": ..., "x-hash": ...}, ...}, each asset encoded on its own and sent as a piece
+    body = [b"{"]
+    for i, asset in enumerate(assets.split("+")):
+        with open('assets/' + asset, 'r') as f:
+            entry = {'content': f.read(), 'x-hash': hash('assets/' + asset)}
+        if i:
+            body.append(b", ")
+        body.extend([json.dumps(asset).encode(), b": ", json.dumps(entry).encode()])
+    body.append(b"}")
+    result = HTTP_OK(body, mimetype=b"application/json")
+    debug('bundle size', result.content_length())
+    return result
+
+def match_route(request):
+    # (handler, pattern, params) or None, matched once when admission control ranks the request and kept for its handler
+    if 'route_match' not in request:
+        request['route_match'] = routes.match(request['method'], request['path'])
+    return request['route_match']
 
-    path = path.removeprefix('/')
+def handle_api_request(request) -> KazHttpResponse:
+    # /api requests from the websocket come straight here
+    found = match_route(request)
+    if found is None or not request['path'].startswith('/api'):
+        return HTTP_NOT_FOUND(b"api not found: " + request['path'].removeprefix('/api').encode() + b" method: " + request['method'].encode())
+    handler, pattern, params = found
+    request['route'] = pattern
+    return handler(request, allow_cors_for_localhost(request['headers']), **params)
+
+# whole repos and batches of notes, they wait behind everything else when the server is busy
+EXPENSIVE_ROUTES = {
+    '/api/get/<repo>/<uuids:path>',
+    '/api/snapshot/<repo>',
+    '/api/put-batch',
+    '/bundle/<assets:path>',
+}
+
+def request_priority(request) -> int:
+    found = match_route(request)
+    return PRIORITY_EXPENSIVE if found is not None and found[1] in EXPENSIVE_ROUTES else PRIORITY_CHEAP
+
+admission = AdmissionControl(request_priority, max_queued=args.max_queued, client_rate=args.client_rate, client_burst=args.client_burst)
+
+# static files, looked up in a table built once.  anything else gets the app's index.html, it routes itself
+
+MIMETYPES = {
+    ".json": b"application/manifest+json",  # manifest.json is the only json we serve
+    ".html": b"text/html",
+    ".css": b"text/css",
+    ".js": b"text/javascript",
+    ".png": b"image/png",
+    ".ico": b"image/x-icon",
+}
+
+CACHEABLE_ASSETS = [
+    "style.css",
+    "boolean-state.js",
+    "calendar.js",
+    "components.js",
+    "date-util.js",
+    "delta.js",
+    "filedb.js",
+    "flatdb.js",
+    "global.js",
+    "indexed-fs.js",
+    "parse.js",
+    "ref.js",
+    "render.js",
+    "remote.js",
+    "rewrite.js",
+    "socket.js",
+    "state.js",
+    "status.js",
+    "sync.js",
+    "manifest.json",
+]
+
+NON_CACHEABLE_ASSETS = [
+    "service-worker.js",
+]
+
+ICONS = [
+    "favicon.ico",
+    "icon512.png",
+    "icon192.png",
+    "maskable_icon.png",
+    "maskable_icon_x192.png",
+]
+
+INDEX = ('assets/index.html', b"text/html")
+STATIC_FILES = {
+    '/sw-index.html': INDEX,
+    '/pipeline-cert.pem': ('cert/cert.pem', b"application/x-x509-ca-cert"),
+    **{'/' + icon: ('icons/' + icon, MIMETYPES[os.path.splitext(icon)[1]]) for icon in ICONS},
+    **{'/' + asset: ('assets/' + asset, MIMETYPES[os.path.splitext(asset)[1]]) for asset in CACHEABLE_ASSETS + NON_CACHEABLE_ASSETS},
+}
+
+def static_response(path: str) -> KazHttpResponse:
+    path, mimetype = STATIC_FILES.get(path, INDEX)
     if not os.path.exists(path):
-        http_response = HTTP_NOT_FOUND(b"could not handle path: " + path.encode())
-        http_response.keep_alive = (connection == 'keep-alive')
-        return http_response
+        return HTTP_NOT_FOUND(b"could not handle path: " + path.encode())
 
     with open(path, 'rb') as f:
         content = f.read()
-        log(f"read {path} ({len(content)})")
+        debug(f"read {path} ({len(content)})")
 
     version_header = b""
-    if path == 'assets/index.html':
-        import json
-        asset_versions = {asset: hash('assets/' + asset) for asset in cacheable_assets}
-        icon_versions = {icon: hash('icons/' + icon) for icon in icons}
+    if path == INDEX[0]:
+        asset_versions = {asset: hash('assets/' + asset) for asset in CACHEABLE_ASSETS}
+        icon_versions = {icon: hash('icons/' + icon) for icon in ICONS}
         versions = {**asset_versions, **icon_versions}
         version_dump = "<!-- VERSIONS: " + json.dumps(versions) + " -->"
         content = content.replace(b"<!-- versions -->", version_dump.encode())
     else:
         version_header = b"x-hash: " + hash_content(content).encode() + b"\r\n"
-        log(f"{version_header=}")
-
-    http_response = HTTP_OK(content, mimetype, extra_headers=version_header)
-    http_response.keep_alive = (connection == 'keep-alive')
-    return http_response
+        debug(f"{version_header=}")
+    return HTTP_OK(content, mimetype, extra_headers=version_header)
 
+def handle_request(request):
+    path = request['path']
+    if path.startswith('/api'):
+        response = handle_api_request(request)
+    else:
+        found = match_route(request)
+        if found is not None:
+            handler, pattern, params = found
+            request['route'] = pattern
+            response = handler(request, b"", **params)
+        else:
+            response = static_response(path)
+    response.keep_alive = (request['connection'] == 'keep-alive')
+    return response
+
+
+def reindex():
+    if hash_index is None:
+        log(f"nothing to reindex, --storage {args.storage} keeps each note's hash with the note")
+        return
+    if not os.path.isdir(NOTES_ROOT):
+        log(f"no notes root at '{NOTES_ROOT}'")
+        return
+    start = time.perf_counter()
+    count, size = hash_index.rebuild()
+    elapsed = time.perf_counter() - start
+    hash_index.save()
+    mb = size / (1024 * 1024)
+    log(f"hashed {count} notes, {mb:.1f} MB in {elapsed:.2f}s: {mb / max(elapsed, 1e-9):.1f} MB/s with {hash_index.workers} workers")
 
 def main():
+    if args.reindex:
+        reindex()
+        return
     log(f"hosting pipeline server on host '{HOST}' and port '{PORT}'")
     if args.no_api:
         log(f"no notes root, because this is a non-api server")
     else:
         log(f"notes root '{NOTES_ROOT}' in home folder '{os.path.expanduser('~')}'")
-    run(host=HOST, port=PORT, handle_request=handle_request, cert_folder=args.cert_folder)
+        if os.path.isdir(NOTES_ROOT):
+            storage.remove_stale_temp_files(NOTES_ROOT)
+        if args.storage == "blob":
+            os.makedirs(NOTES_ROOT, exist_ok=True)
+            notes.load()
+            notes.start_gc(args.gc_interval)
+            log(f"blob storage in '{NOTES_ROOT}'")
+        elif args.storage == "pack":
+            os.makedirs(NOTES_ROOT, exist_ok=True)
+            notes.load()
+            notes.start_compaction(args.compact_interval)
+            log(f"pack storage in '{NOTES_ROOT}'")
+        else:
+            os.makedirs(NOTES_ROOT, exist_ok=True)
+            hash_index.load()
+            hash_index.start()
+            if watcher is not None:
+                watcher.start()
+        if args.wal:
+            wal.start()
+            log(f"write-ahead log at '{wal.path}'")
+        elif os.path.exists(os.path.join(NOTES_ROOT, WAL_NAME)):
+            # a log left over from a run with --wal still has to be replayed
+            WriteAheadLog(NOTES_ROOT, notes).recover()
+    run(host=HOST, port=PORT, handle_request=handle_request, cert_folder=args.cert_folder, session_tickets=args.session_tickets,
+        max_connections=args.max_connections, idle_timeout=args.idle_timeout, access_log=args.access_log, admission=admission)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,339 @@
+# durable note storage
+#
+# LooseStore keeps one file per note at <root>/<repo>/<uuid>, or with `fanout` at <root>/<repo>/<ab>/<uuid>
+# where <ab> is two hex chars from the uuid, so no directory grows past a few hundred entries.
+# a fanout store also finds notes that are still flat, so migrate_layout.py can move them while it serves.
+# the server talks to notes through its interface (repos, list, exists, read, read_stored, hashes, write_many),
+# so other layouts can stand in for it.
+# `features` names the optional extras a store has on top of that, e.g. 'snapshots' in blobstore.py.
+#
+# with `compress`, stores keep notes gzipped at rest.  read always returns the note itself, and read_stored
+# returns the bytes as stored, so a gzipped note can be sent to a client that accepts gzip as-is.
+# hashes are always of the note itself, so /api/status doesn't change with compression.
+#
+# a note is written to a temp file next to its destination and moved into place with os.replace,
+# so a reader (or a crash) only ever sees the old note or the new one, never a truncated one.
+#
+# fsyncs are group-committed: writers hand their temp files to a single committer thread, which makes
+# everything handed over since its last commit durable at once.  when a group already has more than one
+# writer it waits `window` seconds for more to show up first.  a lone writer (the event loop, usually)
+# is committed right away, since it is blocked waiting and nobody else is coming to share its fsyncs.
+# the parent directory of each rename is fsynced once per group instead of once per note, and a large
+# group is flushed with one syncfs instead of one fsync per file.
+
+import os
+import sys
+import hashlib
+import threading
+import time
+import ctypes
+import ctypes.util
+import gzip
+import mmap
+
+from kazhttp import log, error
+
+TEMP_SUFFIX = ".tmp"
+HEX_DIGITS = '0123456789abcdef'
+NOT_REPOS = ['.git', 'raw']
+GZIP_MAGIC = b"\x1f\x8b\x08"  # gzip with deflate, the only method there is
+COMPRESS_LEVEL = 6
+SYNCFS_GROUP_SIZE = 16  # groups at least this big are flushed with one syncfs, when it's available
+
+def is_note_file(name: str) -> bool:
+    # temp files and other dotfiles live alongside notes but are never notes themselves
+    return not name.startswith('.')
+
+def remove_stale_temp_files(root: str):
+    # temp files that were never renamed into place are left over from a crash, the old note is still intact.
+    removed = 0
+    for dirpath, _, filenames in os.walk(root):
+        for name in filenames:
+            if name.startswith('.') and name.endswith(TEMP_SUFFIX):
+                os.remove(os.path.join(dirpath, name))
+                removed += 1
+    if removed:
+        log(f"removed {removed} stale temp files from {root}")
+
+def _load_syncfs():
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        return libc.syncfs
+    except (OSError, AttributeError):
+        return None
+
+def fsync_dir(path: str):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+class _Group:
+    def __init__(self):
+        self.entries = []  # (temp_path, final_path)
+        self.writers = 0
+        self.done = threading.Event()
+        self.error = None
+
+class DurableWriter:
+    def __init__(self, window: float = 0.01, fsync: bool = True):
+        self.window = window
+        self.fsync = fsync
+        self.lock = threading.Lock()
+        self.wakeup = threading.Condition(self.lock)
+        self.pending = _Group()
+        self.thread = None
+        self.syncfs = _load_syncfs()
+        self.counter = 0
+
+        # stats
+        self.groups_committed = 0
+        self.notes_committed = 0
+        self.syncs = 0
+
+    def _temp_path(self, path: str) -> str:
+        with self.lock:
+            self.counter += 1
+            counter = self.counter
+        dirname, basename = os.path.split(path)
+        return os.path.join(dirname, f".{basename}.{os.getpid()}.{counter}{TEMP_SUFFIX}")
+
+    def _write_temp(self, path: str, content: bytes) -> str:
+        temp_path = self._temp_path(path)
+        with open(temp_path, 'wb') as f:
+            f.write(content)
+        return temp_path
+
+    def write(self, path: str, content: bytes):
+        self.write_many([(path, content)])
+
+    def write_many(self, items):
+        # returns once every item is durable and visible at its path
+        entries = [(self._write_temp(path, content), path) for path, content in items]
+        if not entries:
+            return
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="group-commit", daemon=True)
+                self.thread.start()
+            group = self.pending
+            group.entries.extend(entries)
+            group.writers += 1
+            self.wakeup.notify()
+        group.done.wait()
+        if group.error is not None:
+            raise group.error
+
+    def _run(self):
+        while True:
+            with self.lock:
+                while not self.pending.entries:
+                    self.wakeup.wait()
+                concurrent = self.pending.writers > 1
+            # let other writers join this group before we pay for the syncs
+            if self.window > 0 and concurrent:
+                time.sleep(self.window)
+            with self.lock:
+                group = self.pending
+                self.pending = _Group()
+            try:
+                self._commit(group.entries)
+            except Exception as e:
+                error(f"group commit of {len(group.entries)} notes failed: {e}")
+                self._discard(group.entries)
+                group.error = e
+            group.done.set()
+
+    def _commit(self, entries):
+        if self.fsync:
+            if self.syncfs is not None and len(entries) >= SYNCFS_GROUP_SIZE:
+                fd = os.open(os.path.dirname(entries[0][0]), os.O_RDONLY)
+                try:
+                    if self.syncfs(fd) != 0:
+                        raise OSError(ctypes.get_errno(), "syncfs failed")
+                finally:
+                    os.close(fd)
+                self.syncs += 1
+            else:
+                for temp_path, _ in entries:
+                    fd = os.open(temp_path, os.O_RDONLY)
+                    try:
+                        os.fsync(fd)
+                    finally:
+                        os.close(fd)
+                    self.syncs += 1
+
+        for temp_path, final_path in entries:
+            os.replace(temp_path, final_path)
+
+        if self.fsync:
+            for dirname in {os.path.dirname(final_path) for _, final_path in entries}:
+                fsync_dir(dirname)
+                self.syncs += 1
+
+        self.groups_committed += 1
+        self.notes_committed += len(entries)
+
+    def _discard(self, entries):
+        # a failed group leaves the old notes in place, drop the temp files that didn't get renamed over them
+        for temp_path, _ in entries:
+            try:
+                os.remove(temp_path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                error(f"couldn't remove temp file {temp_path}: {e}")
+
+
+def hash_content(content) -> str:
+    return hashlib.sha256(content).hexdigest()
+
+def is_compressed(stored) -> bool:
+    # notes are utf-8 text, which can't start with 0x1f 0x8b, so stored bytes tell for themselves if they're gzipped.
+    # that way notes written before and after turning compression on or off can be read alike.
+    return stored[:3] == GZIP_MAGIC
+
+def compress(content: bytes) -> bytes:
+    return gzip.compress(content, compresslevel=COMPRESS_LEVEL, mtime=0)
+
+def decompress(stored: bytes) -> bytes:
+    return gzip.decompress(stored) if is_compressed(stored) else bytes(stored)
+
+def hash_file(path: str) -> str:
+    # hashes the note at `path` straight out of the page cache, sha256 releases the GIL while it runs
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return hash_content(b"")
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as stored:
+            view = memoryview(stored)
+            try:
+                return hash_content(gzip.decompress(view) if is_compressed(view) else view)
+            finally:
+                view.release()
+
+def is_repo_name(name: str) -> bool:
+    # the same names LooseStore.repos() would list, so a note can't be written into .git or raw
+    return bool(name) and name not in NOT_REPOS and is_note_file(name)
+
+def split_note(note: str):
+    # <repo>/<uuid> -> (repo, uuid), or None if it could escape the notes root
+    if note.count('/') != 1 or '..' in note:
+        return None
+    repo, uuid = note.split('/')
+    if not is_repo_name(repo) or not uuid or not is_note_file(uuid):
+        return None
+    return repo, uuid
+
+def shard(uuid: str) -> str:
+    # notes are named by uuid, so the first two chars are already uniformly spread hex
+    prefix = uuid[:2].lower()
+    if len(prefix) == 2 and all(c in HEX_DIGITS for c in prefix):
+        return prefix
+    return hashlib.sha256(uuid.encode()).hexdigest()[:2]
+
+def is_shard_dir(name: str) -> bool:
+    return len(name) == 2 and all(c in HEX_DIGITS for c in name)
+
+class LooseStore:
+    features = set()
+
+    def __init__(self, root: str, writer: DurableWriter, fanout: bool = False, compress: bool = False):
+        self.root = root
+        self.writer = writer
+        self.fanout = fanout
+        self.compress = compress
+
+    def repo_path(self, repo: str) -> str:
+        return os.path.join(self.root, repo)
+
+    def flat_path(self, repo: str, uuid: str) -> str:
+        return os.path.join(self.root, repo, uuid)
+
+    def shard_path(self, repo: str, uuid: str) -> str:
+        return os.path.join(self.root, repo, shard(uuid), uuid)
+
+    def note_path(self, repo: str, uuid: str) -> str:
+        return self.shard_path(repo, uuid) if self.fanout else self.flat_path(repo, uuid)
+
+    def repos(self):
+        is_repo = lambda x: is_repo_name(x) and os.path.isdir(os.path.join(self.root, x))
+        return [repo for repo in os.listdir(self.root) if is_repo(repo)]
+
+    def list(self, repo: str):
+        if not self.fanout:
+            return [uuid for uuid in os.listdir(self.repo_path(repo)) if is_note_file(uuid)]
+        uuids = []
+        with os.scandir(self.repo_path(repo)) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    if is_shard_dir(entry.name):
+                        uuids.extend(uuid for uuid in os.listdir(entry.path) if is_note_file(uuid))
+                elif is_note_file(entry.name):
+                    uuids.append(entry.name)
+        # a note caught mid-migration can show up in both places
+        return list(dict.fromkeys(uuids))
+
+    def exists(self, repo: str, uuid: str) -> bool:
+        if self.fanout and os.path.isfile(self.shard_path(repo, uuid)):
+            return True
+        return os.path.isfile(self.flat_path(repo, uuid))
+
+    def read(self, repo: str, uuid: str) -> bytes:
+        return decompress(self.read_stored(repo, uuid))
+
+    def read_stored(self, repo: str, uuid: str) -> bytes:
+        if not self.fanout:
+            return self._read(self.flat_path(repo, uuid))
+        # the migration renames flat -> shard, so a note missing from both was moved between our two looks
+        for path in [self.shard_path(repo, uuid), self.flat_path(repo, uuid), self.shard_path(repo, uuid)]:
+            try:
+                return self._read(path)
+            except FileNotFoundError:
+                continue
+        raise FileNotFoundError(self.shard_path(repo, uuid))
+
+    def stat(self, repo: str, uuid: str) -> os.stat_result:
+        return self.locate(repo, uuid)[1]
+
+    def locate(self, repo: str, uuid: str):
+        # (path, stat) of wherever the note is right now
+        if not self.fanout:
+            path = self.flat_path(repo, uuid)
+            return path, os.stat(path)
+        for path in [self.shard_path(repo, uuid), self.flat_path(repo, uuid), self.shard_path(repo, uuid)]:
+            try:
+                return path, os.stat(path)
+            except FileNotFoundError:
+                continue
+        raise FileNotFoundError(self.shard_path(repo, uuid))
+
+    def _read(self, path: str) -> bytes:
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def hashes(self, repo: str):
+        if not os.path.isdir(self.repo_path(repo)):
+            return {}
+        return {uuid: hash_content(self.read(repo, uuid)) for uuid in self.list(repo)}
+
+    def write_many(self, items):
+        # items are (repo, uuid, content)
+        for repo in {repo for repo, _, _ in items}:
+            os.makedirs(self.repo_path(repo), exist_ok=True)
+        if self.fanout:
+            for repo, shard_dir in {(repo, shard(uuid)) for repo, uuid, _ in items}:
+                path = os.path.join(self.repo_path(repo), shard_dir)
+                if not os.path.isdir(path):
+                    os.makedirs(path, exist_ok=True)
+                    fsync_dir(self.repo_path(repo))
+        self.writer.write_many([(self.note_path(repo, uuid), compress(content) if self.compress else content) for repo, uuid, content in items])
+        if self.fanout:
+            # the sharded copy is the newest, a flat one left from before the migration is stale
+            for repo, uuid, _ in items:
+                try:
+                    os.remove(self.flat_path(repo, uuid))
+                except FileNotFoundError:
+                    pass
@@ -1,4 +1,7 @@
 import subprocess
+import os
+import ssl
+import urllib.request
 from flask import Flask, request, redirect, jsonify, make_response
 import threading
 import time
@@ -203,11 +206,85 @@ def liveness_check():
 
 def tail(f, n):
     return subprocess.check_output(['tail', '-n', str(n), f], text=True)
+
+def scrape_metrics():
+    # {(name, ((label, value), ...)): number} from the server's /api/metrics, which serves https when it has certs
+    port = args.proxy_port if is_proxied_mode else args.application_port
+    context = ssl.create_default_context()
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    for scheme in ['https', 'http']:
+        try:
+            with urllib.request.urlopen(f"{scheme}://localhost:{port}/api/metrics", timeout=2, context=context if scheme == 'https' else None) as response:
+                text = response.read().decode()
+            break
+        except (OSError, ssl.SSLError) as e:
+            error = e
+    else:
+        raise error
+    samples = {}
+    for line in text.splitlines():
+        if not line or line.startswith('#'):
+            continue
+        series, value = line.rsplit(' ', 1)
+        name, _, labels = series.partition('{')
+        labels = tuple(tuple(pair.split('=', 1)) for pair in re.findall(r'(\w+="[^"]*")', labels))
+        samples[(name, tuple((key, value.strip('"')) for key, value in labels))] = float(value)
+    return samples
+
+def metric_sum(samples, name, **match):
+    return sum(value for (sample_name, labels), value in samples.items()
+               if sample_name == name and all(dict(labels).get(key) == wanted for key, wanted in match.items()))
+
+def histogram_quantile(samples, name, q, **match):
+    # upper bound of the bucket the q-th observation falls in, summed over every other label
+    buckets = {}
+    for (sample_name, labels), value in samples.items():
+        labels = dict(labels)
+        if sample_name == name + '_bucket' and all(labels.get(key) == wanted for key, wanted in match.items()):
+            buckets[labels['le']] = buckets.get(labels['le'], 0) + value
+    total = buckets.get('+Inf', 0)
+    if total == 0:
+        return None
+    for le, count in sorted(buckets.items(), key=lambda item: float(item[0])):
+        if count >= q * total:
+            return float(le)
+
+def ratio(part, whole):
+    return f"{100 * part / whole:.1f}%" if whole else "-"
+
+def metrics_html():
+    try:
+        samples = scrape_metrics()
+    except Exception as e:
+        return f"<p>metrics unavailable: {escape(str(e))}</p>"
+    def ms(seconds):
+        return "-" if seconds is None else ("> 5000ms" if seconds == float('inf') else f"&le; {seconds * 1000:g}ms")
+    requests = metric_sum(samples, 'kaz_requests_total')
+    errors = sum(value for (name, labels), value in samples.items() if name == 'kaz_requests_total' and dict(labels)['status'].startswith('5'))
+    html = f"<p>{requests:.0f} requests, {errors:.0f} errors.  latency p50 {ms(histogram_quantile(samples, 'kaz_request_duration_seconds', 0.5))}, "
+    html += f"p95 {ms(histogram_quantile(samples, 'kaz_request_duration_seconds', 0.95))}, p99 {ms(histogram_quantile(samples, 'kaz_request_duration_seconds', 0.99))}</p>"
+    routes = {}
+    for (name, labels), value in samples.items():
+        if name == 'kaz_requests_total':
+            routes[dict(labels)['route']] = routes.get(dict(labels)['route'], 0) + value
+    html += "<table><tr><th>route</th><th>requests</th><th>p50</th><th>p95</th><th>p99</th></tr>"
+    for route, count in sorted(routes.items(), key=lambda item: -item[1])[:10]:
+        quantiles = "".join(f"<td>{ms(histogram_quantile(samples, 'kaz_request_duration_seconds', q, route=route))}</td>" for q in [0.5, 0.95, 0.99])
+        html += f"<tr><td>{escape(route)}</td><td>{count:.0f}</td>{quantiles}</tr>"
+    html += "</table>"
+    handshakes = metric_sum(samples, 'kaz_tls_handshake_duration_seconds_count')
+    resumed = metric_sum(samples, 'kaz_tls_handshake_duration_seconds_count', resumed='true')
+    html += f"<p>connections open {metric_sum(samples, 'kaz_connections_open'):.0f}, streams open {metric_sum(samples, 'kaz_streams_open'):.0f}, "
+    html += f"keep-alive reuse {ratio(metric_sum(samples, 'kaz_keepalive_reused_total'), requests)}, tls resumed {ratio(resumed, handshakes)} of {handshakes:.0f} handshakes</p>"
+    html += f"<p>hash index hits {ratio(metric_sum(samples, 'kaz_hash_index_lookups_total', result='hit'), metric_sum(samples, 'kaz_hash_index_lookups_total'))}, "
+    html += f"note cache hits {ratio(metric_sum(samples, 'kaz_cache_requests_total', result='hit'), metric_sum(samples, 'kaz_cache_requests_total'))}, "
+    html += f"{metric_sum(samples, 'kaz_disk_read_bytes_total') / 1e6:.1f} MB read from disk</p>"
+    return html
     
 @app.route('/')
 def index():
-    with open('logs/server', 'rb') as f:
-        server_log_bytecount = len(f.read())
+    server_log_bytecount = os.path.getsize('logs/server')
     simple_server_logs = f"{server_log_bytecount / 1024:.4} kilobytes in logs/server\n\n" + tail('logs/server', 1000)
 
     pipeline_proxy_logs = None
@@ -240,6 +317,8 @@ def index():
     {status_html}
     {subprocess.run(['fuser', args.application_port + '/tcp'], capture_output=True, text=True)}
     {subprocess.run(['fuser', args.proxy_port + '/tcp'], capture_output=True, text=True)}
+    <h1>Metrics</h1>
+    {metrics_html()}
     <form action="/restart" method="post">
         <input type="submit" value="Restart All Subprocesses">
     </form>
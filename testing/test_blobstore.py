@@ -0,0 +1,59 @@
+"""
+Unit tests for blobstore.py: batch writes, shared blobs and snapshots.
+
+python -m pytest -q testing/test_blobstore.py
+"""
+
+import json
+import os
+
+import pytest
+
+import blobstore
+import storage
+
+def make_store(tmp_path, compress=False):
+    store = blobstore.BlobStore(str(tmp_path), storage.DurableWriter(window=0), compress=compress)
+    store.load()
+    return store
+
+def test_batch_write_one_ref_table_per_repo(tmp_path):
+    store = make_store(tmp_path)
+    items = [("core", f"n{i}", f"note {i % 10}".encode()) for i in range(200)] + [("journal", "j", b"note 0")]
+    store.write_many(items)
+    assert store.writer.notes_committed == 10 + 2  # distinct blobs, then one table per repo
+    assert sorted(store.repos()) == ["core", "journal"]
+    assert len(store.list("core")) == 200
+    assert store.read("core", "n13") == b"note 3"
+    with open(store.ref_path("core")) as f:
+        assert json.load(f) == store.hashes("core")
+
+def test_identical_notes_share_a_blob(tmp_path):
+    store = make_store(tmp_path, compress=True)
+    store.write_many([("core", "a", b"same"), ("journal", "b", b"same")])
+    assert store.hashes("core")["a"] == store.hashes("journal")["b"] == storage.hash_content(b"same")
+    assert len(os.listdir(os.path.join(store.blob_root, store.hashes("core")["a"][:2]))) == 1
+    assert store.read("journal", "b") == b"same"
+
+def test_refs_survive_reload(tmp_path):
+    store = make_store(tmp_path)
+    store.write_many([("core", "a", b"one")])
+    snapshot_id = store.snapshot("core")
+    store.write_many([("core", "a", b"two")])
+    reloaded = make_store(tmp_path)
+    assert reloaded.read("core", "a") == b"two"
+    assert reloaded.read_snapshot("core", snapshot_id) == {"a": storage.hash_content(b"one")}
+
+def test_failed_ref_write_leaves_refs_alone(tmp_path):
+    store = make_store(tmp_path)
+    store.write_many([("core", "a", b"one")])
+    write_many = store.writer.write_many
+    def fail_on_refs(items):
+        if any(path.startswith(store.ref_root) for path, _ in items):
+            raise OSError("disk full")
+        write_many(items)
+    store.writer.write_many = fail_on_refs
+    with pytest.raises(OSError):
+        store.write_many([("core", "a", b"two"), ("journal", "b", b"two")])
+    assert store.repos() == ["core"]
+    assert store.read("core", "a") == b"one"
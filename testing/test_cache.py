@@ -0,0 +1,123 @@
+"""
+Unit tests for cache.py: stamp validation, writes racing reads, the byte budget and
+gzip bodies spliced from the cached deflate members.
+
+python -m pytest -q testing/test_cache.py
+"""
+
+import gzip
+import json
+from types import SimpleNamespace
+
+from cache import NoteCache, json_key
+from kazhttp import deflate_piece, gzip_pieces
+
+class DictStore:
+    # a store whose notes carry a (size, mtime) stamp that tests can bump, like an out-of-band edit
+    def __init__(self, notes):
+        self.notes = dict(notes)
+        self.mtimes = {key: 1 for key in self.notes}
+        self.reads = 0
+        self.on_read = None
+
+    def stat(self, repo, uuid):
+        content = self.notes[(repo, uuid)]
+        return SimpleNamespace(st_size=len(content), st_mtime_ns=self.mtimes[(repo, uuid)])
+
+    def read(self, repo, uuid):
+        self.reads += 1
+        content = self.notes[(repo, uuid)]
+        if self.on_read is not None:
+            self.on_read()
+        return content
+
+    def write_many(self, items):
+        for repo, uuid, content in items:
+            self.notes[(repo, uuid)] = content
+            self.mtimes[(repo, uuid)] = self.mtimes.get((repo, uuid), 0) + 1
+
+def test_hit_until_the_stamp_changes():
+    store = DictStore({("core", "a"): b"one"})
+    cache = NoteCache(store, max_bytes=1 << 20)
+    assert cache.read("core", "a") == b"one"
+    assert cache.read_json("core", "a") == b'"one"'
+    assert store.reads == 1 and cache.hits == 1
+
+    # edited behind the cache's back: same size, new mtime
+    store.notes[("core", "a")] = b"two"
+    store.mtimes[("core", "a")] += 1
+    assert cache.read("core", "a") == b"two"
+    assert store.reads == 2 and cache.misses == 2
+
+def test_write_drops_the_entry():
+    store = DictStore({("core", "a"): b"one"})
+    cache = NoteCache(store, max_bytes=1 << 20)
+    cache.read("core", "a")
+    cache.write_many([("core", "a", b"two")])
+    assert cache.stats()['entries'] == 0
+    assert cache.read("core", "a") == b"two"
+
+def test_read_racing_a_write_is_not_cached():
+    store = DictStore({("core", "a"): b"one"})
+    cache = NoteCache(store, max_bytes=1 << 20)
+    # the write lands between the read's stat and the read returning, so what it read is stale
+    def write_during_read():
+        store.on_read = None
+        cache.write_many([("core", "a", b"two")])
+    store.on_read = write_during_read
+    assert cache.read("core", "a") == b"one"
+    assert cache.stats()['entries'] == 0
+    assert cache.read("core", "a") == b"two"
+
+def test_evicts_least_recently_used_past_the_budget():
+    notes = {("core", name): name.encode() * 10 for name in "abcd"}
+    store = DictStore(notes)
+    # content plus its json string is 10 + 12 bytes, room for three entries
+    cache = NoteCache(store, max_bytes=70)
+    for name in "abc":
+        cache.read("core", name)
+    cache.read("core", "a")  # now b is the oldest
+    cache.read("core", "d")
+    assert cache.bytes <= cache.max_bytes
+    assert cache.evictions == 1
+    assert set(cache.entries) == {("core", "a"), ("core", "c"), ("core", "d")}
+
+def test_note_larger_than_the_budget_is_not_cached():
+    store = DictStore({("core", "big"): b"x" * 100})
+    cache = NoteCache(store, max_bytes=50)
+    assert cache.read("core", "big") == b"x" * 100
+    assert cache.stats()['entries'] == 0 and cache.bytes == 0
+
+def notes_json(cache, repo, uuids):
+    # both bodies the way simple_server.notes_json_response builds them for /api/get
+    plain = [b"{"]
+    pieces = [deflate_piece(b"{")]
+    data = [b"{"]
+    for i, uuid in enumerate(uuids):
+        fragment, deflated = cache.read_json_deflated(repo, uuid)
+        if i:
+            plain.append(b", ")
+            pieces.append(deflate_piece(b", "))
+            data.append(b", ")
+        plain.extend([json_key(repo, uuid), b": ", cache.read_json(repo, uuid)])
+        pieces.append(deflated)
+        data.extend([json_key(repo, uuid), b": ", fragment])
+    plain.append(b"}")
+    pieces.append(deflate_piece(b"}"))
+    data.append(b"}")
+    return b"".join(plain), b"".join(gzip_pieces(pieces, data))
+
+def test_spliced_gzip_matches_the_plain_body():
+    notes = {
+        ("core", "a"): b"plain note",
+        ("core", "b"): "quotes \" and \\ and \u00e9\u4e2d\n\ttabs".encode(),
+        ("core", "c"): b"x" * 100000,
+        ("core", "d"): b"",
+    }
+    cache = NoteCache(DictStore(notes), max_bytes=1 << 20)
+    uuids = ["a", "b", "c", "d"]
+    for _ in range(2):  # deflated on the first round, spliced from the cache on the second
+        plain, gzipped = notes_json(cache, "core", uuids)
+        assert gzip.decompress(gzipped) == plain
+        assert json.loads(plain) == {"core/" + uuid: notes[("core", uuid)].decode() for uuid in uuids}
+    assert cache.hits > 0
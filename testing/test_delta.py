@@ -0,0 +1,83 @@
+"""
+Unit tests for delta.py: signatures and deltas round-trip, and malformed input is rejected with DeltaError.
+
+python -m pytest -q testing/test_delta.py
+"""
+
+import os
+import random
+
+import pytest
+
+import delta
+
+def roundtrip(base: bytes, content: bytes, block_size: int = None) -> bytes:
+    sig = delta.signature(base, block_size)
+    return delta.apply_delta(base, delta.make_delta(sig, content))
+
+@pytest.mark.parametrize("base,content", [
+    (b"", b""),
+    (b"", b"hello"),
+    (b"hello", b""),
+    (b"same", b"same"),
+    (b"a" * 5000, b"a" * 5000),
+])
+def test_roundtrip_small(base, content):
+    assert roundtrip(base, content) == content
+
+def test_roundtrip_edits():
+    rng = random.Random(1)
+    base = bytes(rng.randrange(256) for _ in range(20000))
+    edited = base[:3000] + b"inserted" + base[3000:9000] + base[9512:] + b"tail"
+    assert roundtrip(base, edited, 512) == edited
+    assert roundtrip(base, edited) == edited
+
+def test_unchanged_content_is_all_copies():
+    base = os.urandom(10000)
+    sig = delta.signature(base, 512)
+    out = delta.make_delta(sig, base)
+    # header plus one copy op for the full blocks and one for the short tail
+    assert len(out) <= delta.DELTA_HEADER.size + 2 * delta.OP_HEADER.size
+    assert delta.apply_delta(base, out) == base
+
+def test_signature_truncated():
+    sig = delta.signature(os.urandom(3000), 512)
+    for length in (0, 4, delta.SIGNATURE_HEADER.size - 1, delta.SIGNATURE_HEADER.size, len(sig) - 1):
+        with pytest.raises(delta.DeltaError):
+            delta.parse_signature(sig[:length])
+
+def test_signature_bad_header():
+    with pytest.raises(delta.DeltaError):
+        delta.parse_signature(b"XXXX" + bytes(8))
+    with pytest.raises(delta.DeltaError):
+        delta.parse_signature(delta.SIGNATURE_HEADER.pack(delta.SIGNATURE_MAGIC, 0, 10))
+
+def test_delta_truncated():
+    base = os.urandom(4000)
+    content = base[:1000] + b"changed" + base[1000:]
+    out = delta.make_delta(delta.signature(base, 512), content)
+    for length in range(len(out)):
+        # cutting exactly between ops leaves a valid delta for shorter content, anything else must raise
+        try:
+            assert delta.apply_delta(base, out[:length]) != content
+        except delta.DeltaError:
+            pass
+
+def test_delta_truncated_ops():
+    header = delta.DELTA_HEADER.pack(delta.DELTA_MAGIC, 512)
+    # a 12 byte delta: header and the start of a copy op
+    with pytest.raises(delta.DeltaError):
+        delta.apply_delta(b"x" * 1024, header + bytes([delta.OP_COPY, 0, 0, 0]))
+    with pytest.raises(delta.DeltaError):
+        delta.apply_delta(b"", header + bytes([delta.OP_DATA, 0, 0]))
+    with pytest.raises(delta.DeltaError):
+        delta.apply_delta(b"", header + delta.OP_DATA_HEADER.pack(delta.OP_DATA, 10) + b"short")
+
+def test_delta_bad_ops():
+    header = delta.DELTA_HEADER.pack(delta.DELTA_MAGIC, 512)
+    with pytest.raises(delta.DeltaError):
+        delta.apply_delta(b"", b"XXXX" + bytes(4))
+    with pytest.raises(delta.DeltaError):
+        delta.apply_delta(b"", header + bytes([99]))
+    with pytest.raises(delta.DeltaError):
+        delta.apply_delta(b"x" * 100, header + delta.OP_HEADER.pack(delta.OP_COPY, 5, 1))
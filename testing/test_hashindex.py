@@ -0,0 +1,79 @@
+"""
+Unit tests for hashindex.py: stat validation, racy mtimes, removed notes and the saved index.
+
+python -m pytest -q testing/test_hashindex.py
+"""
+
+import os
+import time
+
+import hashindex
+import storage
+
+OLD = time.time() - 3600
+
+def make_index(tmp_path):
+    store = storage.LooseStore(str(tmp_path), storage.DurableWriter(window=0))
+    index = hashindex.HashIndex(str(tmp_path), store, workers=2)
+    index.load()
+    return index
+
+def write_old(index, repo, notes):
+    # notes written an hour ago, so they're past the racy window
+    index.write_many([(repo, uuid, content) for uuid, content in notes.items()])
+    for uuid in notes:
+        path, _ = index.store.locate(repo, uuid)
+        os.utime(path, (OLD, OLD))
+
+def test_unchanged_notes_are_not_rehashed(tmp_path):
+    index = make_index(tmp_path)
+    write_old(index, "core", {"a": b"one", "b": b"two"})
+    assert index.hashes("core") == {"a": storage.hash_content(b"one"), "b": storage.hash_content(b"two")}
+    assert index.hashed == 2
+    index.hashes("core")
+    assert index.hashed == 2 and index.hits == 2
+
+def test_racy_mtime_is_rehashed(tmp_path):
+    index = make_index(tmp_path)
+    index.write_many([("core", "a", b"one")])
+    path, st = index.store.locate("core", "a")
+    assert index.hashes("core") == {"a": storage.hash_content(b"one")}
+    assert "a" not in index.entries.get("core", {})
+
+    # rewritten within the same mtime tick: same size, same mtime, different content
+    with open(path, 'wb') as f:
+        f.write(b"two")
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns))
+    assert index.hashes("core") == {"a": storage.hash_content(b"two")}
+    assert index.hashed == 2
+
+def test_removed_notes_drop_out(tmp_path):
+    index = make_index(tmp_path)
+    write_old(index, "core", {"a": b"one", "b": b"two"})
+    index.hashes("core")
+    index.dirty = False
+    path, _ = index.store.locate("core", "b")
+    os.remove(path)
+    assert index.hashes("core") == {"a": storage.hash_content(b"one")}
+    assert set(index.entries["core"]) == {"a"}
+    assert index.dirty
+
+def test_reload_starts_warm(tmp_path):
+    index = make_index(tmp_path)
+    notes = {f"n{i}": f"note {i}".encode() for i in range(300)}  # more than one batch
+    write_old(index, "core", notes)
+    expected = {uuid: storage.hash_content(content) for uuid, content in notes.items()}
+    assert index.hashes("core") == expected
+    index.save()
+
+    reloaded = make_index(tmp_path)
+    assert reloaded.hashes("core") == expected
+    assert reloaded.hashed == 0 and reloaded.hits == len(notes)
+
+def test_unreadable_index_is_ignored(tmp_path):
+    with open(os.path.join(tmp_path, hashindex.INDEX_NAME), 'w') as f:
+        f.write("{not json")
+    index = make_index(tmp_path)
+    write_old(index, "core", {"a": b"one"})
+    assert index.hashes("core") == {"a": storage.hash_content(b"one")}
+    assert index.hashed == 1
@@ -0,0 +1,495 @@
+"""
+Unit tests for kazhttp.py pieces that don't need a running server.
+
+python -m pytest -q testing/test_kazhttp.py
+"""
+
+import io
+import socket
+import struct
+import threading
+import time
+
+import pytest
+
+import kazhttp
+
+# logging
+
+def test_error_level_keeps_only_errors(monkeypatch):
+    out = io.StringIO()
+    monkeypatch.setattr(kazhttp, 'log_writer', kazhttp.LogWriter(out=out))
+    kazhttp.set_log_level('error')
+    kazhttp.debug("per request")
+    kazhttp.log("started")
+    kazhttp.error("group commit failed")
+    kazhttp.log_writer.flush()
+    lines = out.getvalue().splitlines()
+    assert len(lines) == 1 and lines[0].endswith(" ERROR: group commit failed")
+
+# reading requests
+
+@pytest.fixture
+def pair():
+    server, client = socket.socketpair()
+    server.setblocking(False)
+    yield server, client
+    server.close()
+    client.close()
+
+def read_all(reader, server, client, chunks):
+    # feeds `chunks` one at a time, the reader must not block or finish before the last one
+    for chunk in chunks[:-1]:
+        client.sendall(chunk)
+        assert reader.receive(server) is None
+    client.sendall(chunks[-1])
+    return reader.receive(server)
+
+def test_request_in_one_piece(pair):
+    server, client = pair
+    reader = kazhttp.RequestReader(time.monotonic() + 10)
+    request = read_all(reader, server, client, [b"GET /api/status HTTP/1.1\r\nConnection: keep-alive\r\nX-Thing: a:b\r\nOrigin: http://localhost:8000\r\n\r\n"])
+    assert (request['method'], request['path'], request['httpver']) == ('GET', '/api/status', 'HTTP/1.1')
+    # headers nothing reads are skipped
+    assert request['headers'] == {'connection': 'keep-alive', 'origin': 'http://localhost:8000'}
+    assert request['connection'] == 'keep-alive'
+    assert request['body'] == b""
+    assert reader.buffer is None  # back in the pool
+
+def test_request_trickles_in(pair):
+    server, client = pair
+    reader = kazhttp.RequestReader(time.monotonic() + 10)
+    raw = b"PUT /api/put/core/abc HTTP/1.1\r\nContent-Length: 11\r\n\r\nhello world"
+    request = read_all(reader, server, client, [raw[i:i + 1] for i in range(len(raw))])
+    assert request['path'] == '/api/put/core/abc'
+    assert request['body'] == b"hello world"
+    assert request['bytes_in'] == len(raw)
+
+def test_body_split_from_head(pair):
+    server, client = pair
+    reader = kazhttp.RequestReader(time.monotonic() + 10)
+    body = bytes(range(256)) * 1000
+    head = b"PUT /api/put-batch HTTP/1.1\r\nContent-Length: %d\r\n\r\n" % len(body)
+    chunks = [head + body[:100]] + [body[i:i + 16384] for i in range(100, len(body), 16384)]
+    request = read_all(reader, server, client, chunks)
+    assert request['body'] == body
+    assert request['body'] is reader.body  # not copied again once it's all in
+
+def test_long_head_grows_buffer(pair):
+    server, client = pair
+    reader = kazhttp.RequestReader(time.monotonic() + 10, kazhttp.BufferPool(size=64))
+    path = '/api/get/core/' + ','.join(f'n{i}.note' for i in range(100))
+    request = read_all(reader, server, client, [f"GET {path} HTTP/1.1\n\n".encode()])
+    assert request['path'] == path
+
+def test_closed_mid_request(pair):
+    server, client = pair
+    reader = kazhttp.RequestReader(time.monotonic() + 10)
+    client.sendall(b"GET /api/sta")
+    assert reader.receive(server) is None
+    client.close()
+    with pytest.raises(kazhttp.RequestError):
+        reader.receive(server)
+
+@pytest.mark.parametrize("raw", [
+    b"GARBAGE\r\n\r\n",
+    b"PUT /api/put/core/a HTTP/1.1\r\nContent-Length: lots\r\n\r\n",
+    b"PUT /api/put/core/a HTTP/1.1\r\nContent-Length: -5\r\n\r\n",
+])
+def test_bad_request_gets_400(pair, raw):
+    server, client = pair
+    reader = kazhttp.RequestReader(time.monotonic() + 10)
+    client.sendall(raw)
+    with pytest.raises(kazhttp.RequestError):
+        reader.receive(server)
+    assert client.recv(4096).startswith(b"HTTP/1.1 400")
+
+def test_head_too_large(pair, monkeypatch):
+    server, client = pair
+    monkeypatch.setattr(kazhttp, 'MAX_REQUEST_HEAD', 256)
+    reader = kazhttp.RequestReader(time.monotonic() + 10, kazhttp.BufferPool(size=64))
+    client.sendall(b"GET /" + b"a" * 300)
+    with pytest.raises(kazhttp.RequestError):
+        while reader.receive(server) is None:
+            pass
+    assert client.recv(4096).startswith(b"HTTP/1.1 400")
+
+# writing responses
+
+class TrickleSocket:
+    # takes at most `limit` bytes per sendmsg, wherever that falls in the buffers
+    def __init__(self, limit):
+        self.limit = limit
+        self.received = bytearray()
+        self.calls = []
+
+    def sendmsg(self, buffers):
+        assert all(isinstance(buffer, memoryview) for buffer in buffers)
+        self.calls.append(len(buffers))
+        data = b"".join(buffers)[:self.limit]
+        self.received += data
+        return len(data)
+
+class ChunkSocket:
+    # no sendmsg, like an ssl socket
+    def __init__(self):
+        self.chunks = []
+
+    def sendall(self, chunk):
+        self.chunks.append(chunk)
+
+def large_buffers():
+    return [b"header\r\n" * 2000, bytearray(b"a" * 30000), memoryview(b"b" * 25000), b"", b"c" * 7]
+
+def test_partial_sendmsg_resumes_mid_buffer():
+    buffers = large_buffers()
+    connection = TrickleSocket(limit=7001)
+    assert kazhttp.send_buffers(connection, buffers) == sum(len(buffer) for buffer in buffers)
+    assert connection.received == b"".join(buffers)
+    assert len(connection.calls) > len(buffers)
+
+def test_sendmsg_takes_at_most_iov_max_buffers(monkeypatch):
+    monkeypatch.setattr(kazhttp, 'IOV_MAX', 2)
+    buffers = [bytes([i]) * 5000 for i in range(7)]
+    connection = TrickleSocket(limit=1 << 20)
+    kazhttp.send_buffers(connection, buffers)
+    assert connection.received == b"".join(buffers)
+    assert connection.calls == [2, 2, 2, 1]
+
+def test_tls_path_writes_memoryview_chunks(monkeypatch):
+    monkeypatch.setattr(kazhttp, 'SEND_CHUNK_BYTES', 4096)
+    buffers = large_buffers()
+    connection = ChunkSocket()
+    assert kazhttp.send_buffers(connection, buffers) == sum(len(buffer) for buffer in buffers)
+    assert b"".join(connection.chunks) == b"".join(buffers)
+    assert all(isinstance(chunk, memoryview) and 0 < len(chunk) <= 4096 for chunk in connection.chunks)
+
+def test_small_response_is_joined():
+    connection = ChunkSocket()
+    kazhttp.send_buffers(connection, [b"HTTP/1.1 200 OK\r\n\r\n", b"body"])
+    assert connection.chunks == [b"HTTP/1.1 200 OK\r\n\r\nbody"]
+
+def test_write_to_a_real_socket(pair):
+    server, client = pair
+    server.setblocking(True)
+    response = kazhttp.KazHttpResponse(b"200 OK", [b"x" * 100000, b"y" * 100000])
+    sent = []
+    writer = threading.Thread(target=lambda: sent.append(response.write_to(server)))
+    writer.start()
+    received = bytearray()
+    while len(received) < len(response.header_bytes()) + 200000:
+        received += client.recv(65536)
+    writer.join()
+    assert sent == [len(received)]
+    assert received.endswith(b"x" * 100000 + b"y" * 100000)
+
+def test_write_gives_up_at_the_deadline(pair):
+    server, client = pair
+    # the client never reads, so the socket buffers fill and the write has to wait
+    started = time.monotonic()
+    with pytest.raises(socket.timeout):
+        kazhttp.send_buffers(server, [b"x" * (1 << 20)] * 16, started + 0.2)
+    assert time.monotonic() - started < 2
+
+# admission control
+
+def priority_by_path(request):
+    return kazhttp.PRIORITY_EXPENSIVE if request['path'].startswith('/slow') else kazhttp.PRIORITY_CHEAP
+
+def make_request(path='/fast', client='10.0.0.1'):
+    return {'path': path, 'client': client}
+
+def test_cheap_requests_go_first():
+    admission = kazhttp.AdmissionControl(priority_by_path, client_rate=0)
+    for i, path in enumerate(['/slow', '/fast', '/slow', '/fast']):
+        assert admission.admit(i, make_request(path), 0.0) == []
+    order = []
+    while (entry := admission.next(0.01)) is not None:
+        sock, request, waited, reason = entry
+        assert reason is None
+        order.append(sock)
+    assert order == [1, 3, 0, 2]
+
+def test_full_queue_sheds_newest_expensive():
+    admission = kazhttp.AdmissionControl(priority_by_path, max_queued=3, client_rate=0)
+    admission.admit('slow1', make_request('/slow'), 0.0)
+    admission.admit('slow2', make_request('/slow'), 0.0)
+    admission.admit('fast1', make_request('/fast'), 0.0)
+    # a cheap one pushes out the newest expensive one
+    shed = admission.admit('fast2', make_request('/fast'), 0.0)
+    assert [(sock, reason) for sock, _, reason, _ in shed] == [('slow2', 'full')]
+    # an expensive one has nothing less important to push out
+    shed = admission.admit('slow3', make_request('/slow'), 0.0)
+    assert [(sock, reason) for sock, _, reason, _ in shed] == [('slow3', 'full')]
+    assert len(admission) == 3
+    assert admission.shed['full'] == 2
+
+def test_sheds_after_delay_stays_above_target():
+    admission = kazhttp.AdmissionControl(client_rate=0, target=0.05, interval=0.5, max_delay=2)
+    for i in range(10):
+        admission.admit(i, make_request(), 0.0)
+    # waited above target, but not for a whole interval yet
+    assert admission.next(0.1)[3] is None
+    assert admission.next(0.3)[3] is None
+    assert not admission.dropping
+    # above target for longer than the interval: shed what waited past the target
+    assert admission.next(0.7)[3] == 'delay'
+    assert admission.dropping
+    assert admission.next(0.8)[3] == 'delay'
+    # something that got through within the target ends it
+    admission.admit('fresh', make_request(), 0.79)
+    while (entry := admission.next(0.8)) is not None and entry[0] != 'fresh':
+        pass
+    assert entry[3] is None
+    assert not admission.dropping
+
+def test_sheds_past_max_delay():
+    admission = kazhttp.AdmissionControl(client_rate=0, max_delay=2)
+    admission.admit('old', make_request(), 0.0)
+    assert admission.next(2.5)[3] == 'delay'
+
+def test_client_rate_limit():
+    admission = kazhttp.AdmissionControl(priority_by_path, client_rate=10, client_burst=20)
+    # an expensive request takes 5 tokens: 4 fit in the burst
+    results = [admission.admit(i, make_request('/slow'), 0.0) for i in range(5)]
+    assert results[:4] == [[], [], [], []]
+    [(sock, _, reason, retry_after)] = results[4]
+    assert (sock, reason) == (4, 'client')
+    assert retry_after == pytest.approx(0.5)
+    # another client has its own bucket
+    assert admission.admit('other', make_request('/slow', client='10.0.0.2'), 0.0) == []
+    # and the first refills
+    assert admission.admit(5, make_request('/slow'), 0.5) == []
+    assert admission.shed['client'] == 1
+
+def test_forget_clients():
+    admission = kazhttp.AdmissionControl(client_rate=10, client_burst=20)
+    admission.admit(1, make_request(), 0.0)
+    admission.forget_clients(0.05)
+    assert len(admission.buckets) == 1
+    admission.forget_clients(1.0)
+    assert admission.buckets == {}
+
+def test_client_rate_off():
+    admission = kazhttp.AdmissionControl(client_rate=0, client_burst=1)
+    assert all(admission.admit(i, make_request(), 0.0) == [] for i in range(50))
+
+def test_shed_response():
+    response = kazhttp.shed_response('client', 0.2)
+    assert response.status.startswith(b"429")
+    assert b"Retry-After: 1\r\n" in response.extra_headers
+    response = kazhttp.shed_response('delay', 1000)
+    assert response.status.startswith(b"503")
+    assert b"Retry-After: %d\r\n" % kazhttp.MAX_RETRY_AFTER_SECONDS in response.extra_headers
+
+def test_stream_request_outside_run_is_answered_at_once():
+    answered = []
+    kazhttp.KazStream().queue_request({'path': '/api/status'}, lambda request, shed: answered.append((request['path'], shed)))
+    assert answered == [('/api/status', None)]
+
+# websockets
+
+def client_frame(opcode, payload, fin=True, masked=True, length=None):
+    # a frame as a browser sends it, `length` overrides the one in the header
+    length = len(payload) if length is None else length
+    first = (0x80 if fin else 0) | opcode
+    mask_bit = 0x80 if masked else 0
+    if length < 126:
+        header = struct.pack(">BB", first, mask_bit | length)
+    elif length < 65536:
+        header = struct.pack(">BBH", first, mask_bit | 126, length)
+    else:
+        header = struct.pack(">BBQ", first, mask_bit | 127, length)
+    if not masked:
+        return header + payload
+    mask = b"\x12\x34\x56\x78"
+    return header + mask + bytes(byte ^ mask[i % 4] for i, byte in enumerate(payload))
+
+def server_frames(websocket):
+    # [(opcode, payload)] written back to the client
+    data, frames = bytes(websocket.buffer), []
+    while data:
+        opcode, length, offset = data[0] & 0x0F, data[1] & 0x7F, 2
+        if length == 126:
+            length, = struct.unpack_from(">H", data, 2)
+            offset = 4
+        elif length == 127:
+            length, = struct.unpack_from(">Q", data, 2)
+            offset = 10
+        frames.append((opcode, data[offset:offset + length]))
+        data = data[offset + length:]
+    return frames
+
+def make_websocket():
+    messages = []
+    websocket = kazhttp.KazWebSocket("dGhlIHNhbXBsZSBub25jZQ==", lambda websocket, opcode, payload: messages.append((opcode, payload)))
+    return websocket, messages
+
+def test_websocket_accept():
+    assert kazhttp.websocket_accept("dGhlIHNhbXBsZSBub25jZQ==") == b"s3pPLMBiTxaQ9kYGzzhZRbK+xOo="
+
+@pytest.mark.parametrize("size", [0, 5, 125, 126, 1000, 65535, 65536, 200000])
+def test_websocket_unmasks_every_length(size):
+    websocket, messages = make_websocket()
+    payload = bytes(i % 251 for i in range(size))
+    frame = client_frame(kazhttp.WS_BINARY, payload)
+    # the header arrives a byte at a time, then the rest
+    for i in range(min(len(frame) - 1, 14)):
+        websocket.received(frame[i:i + 1])
+        assert messages == []
+    websocket.received(frame[min(len(frame) - 1, 14):])
+    assert messages == [(kazhttp.WS_BINARY, payload)]
+    assert not websocket.incoming and not websocket.closed
+
+def test_websocket_two_frames_in_one_read():
+    websocket, messages = make_websocket()
+    websocket.received(client_frame(kazhttp.WS_TEXT, b"one") + client_frame(kazhttp.WS_TEXT, b"two"))
+    assert messages == [(kazhttp.WS_TEXT, b"one"), (kazhttp.WS_TEXT, b"two")]
+
+def test_websocket_fragments_with_control_frames_between():
+    websocket, messages = make_websocket()
+    websocket.received(client_frame(kazhttp.WS_TEXT, b"hel", fin=False))
+    websocket.received(client_frame(kazhttp.WS_PING, b"are you there"))
+    websocket.received(client_frame(kazhttp.WS_CONTINUATION, b"lo ", fin=False))
+    websocket.received(client_frame(kazhttp.WS_PONG, b""))
+    assert messages == []
+    websocket.received(client_frame(kazhttp.WS_CONTINUATION, b"world"))
+    assert messages == [(kazhttp.WS_TEXT, b"hello world")]
+    assert server_frames(websocket) == [(kazhttp.WS_PONG, b"are you there")]
+
+def test_websocket_continuation_without_a_message():
+    websocket, messages = make_websocket()
+    websocket.received(client_frame(kazhttp.WS_CONTINUATION, b"stray"))
+    assert websocket.closed
+    assert server_frames(websocket)[-1][1][:2] == struct.pack(">H", kazhttp.WS_CLOSE_PROTOCOL_ERROR)
+
+def test_websocket_unmasked_frame_closes_1002():
+    websocket, messages = make_websocket()
+    websocket.received(client_frame(kazhttp.WS_TEXT, b"hello", masked=False))
+    assert messages == [] and websocket.closed
+    (opcode, payload), = server_frames(websocket)
+    assert opcode == kazhttp.WS_CLOSE
+    assert payload[:2] == struct.pack(">H", kazhttp.WS_CLOSE_PROTOCOL_ERROR)
+
+def test_websocket_oversized_frame_closes_1009():
+    websocket, messages = make_websocket()
+    # refused from the header alone, before the payload is buffered
+    websocket.received(client_frame(kazhttp.WS_BINARY, b"", length=kazhttp.WEBSOCKET_MAX_MESSAGE + 1)[:14])
+    assert messages == [] and websocket.closed
+    (opcode, payload), = server_frames(websocket)
+    assert (opcode, payload[:2]) == (kazhttp.WS_CLOSE, struct.pack(">H", kazhttp.WS_CLOSE_TOO_BIG))
+
+def test_websocket_oversized_message_closes_1009(monkeypatch):
+    monkeypatch.setattr(kazhttp, 'WEBSOCKET_MAX_MESSAGE', 100)
+    websocket, messages = make_websocket()
+    websocket.received(client_frame(kazhttp.WS_TEXT, b"x" * 60, fin=False))
+    websocket.received(client_frame(kazhttp.WS_CONTINUATION, b"x" * 60))
+    assert messages == [] and websocket.closed
+    assert server_frames(websocket)[-1][1][:2] == struct.pack(">H", kazhttp.WS_CLOSE_TOO_BIG)
+
+def test_websocket_close_is_echoed():
+    websocket, messages = make_websocket()
+    websocket.received(client_frame(kazhttp.WS_CLOSE, struct.pack(">H", 1001)))
+    assert websocket.closed
+    assert server_frames(websocket) == [(kazhttp.WS_CLOSE, struct.pack(">H", 1001))]
+
+# routing
+
+def make_router():
+    router = kazhttp.Router()
+    for method, pattern in [
+        ('GET', '/api/list/<repo>'),
+        ('GET', '/api/get/<repo>/<uuids:path>'),
+        ('PUT', '/api/put/<note:path>'),
+        ('PUT', '/api/put-batch'),
+        ('GET', '/api/changes/<cursor:int>'),
+        ('GET', '/api/status'),
+        ('GET', '/api/status/<repos>'),
+        ('GET', '/api/snapshot/<repo>'),
+        ('POST', '/api/snapshot/<repo>'),
+        ('GET', '/api/snapshot/latest'),
+        ('GET', '/files/<rest:path>'),
+        ('GET', '/files/special/<name>'),
+    ]:
+        router.add(method, pattern, (method, pattern))
+    return router
+
+@pytest.mark.parametrize("method,path,pattern,params", [
+    ('GET', '/api/status', '/api/status', {}),
+    ('GET', '/api/status/', '/api/status', {}),
+    ('GET', '/api/status?x=1', '/api/status', {}),
+    ('GET', '/api/status/core,journal', '/api/status/<repos>', {'repos': 'core,journal'}),
+    ('GET', '/api/list/core', '/api/list/<repo>', {'repo': 'core'}),
+    ('GET', '/api/get/core/a.note,b.note', '/api/get/<repo>/<uuids:path>', {'repo': 'core', 'uuids': 'a.note,b.note'}),
+    ('PUT', '/api/put/core/a.note', '/api/put/<note:path>', {'note': 'core/a.note'}),
+    ('PUT', '/api/put-batch', '/api/put-batch', {}),
+    ('GET', '/api/changes/42', '/api/changes/<cursor:int>', {'cursor': 42}),
+    ('GET', '/api/snapshot/latest', '/api/snapshot/latest', {}),
+    ('GET', '/api/snapshot/core', '/api/snapshot/<repo>', {'repo': 'core'}),
+    ('POST', '/api/snapshot/latest', '/api/snapshot/<repo>', {'repo': 'latest'}),
+    # a literal that leads nowhere backs up to the <rest:path> beside it
+    ('GET', '/files/special/a/b', '/files/<rest:path>', {'rest': 'special/a/b'}),
+    ('GET', '/files/special/a', '/files/special/<name>', {'name': 'a'}),
+])
+def test_router_matches(method, path, pattern, params):
+    handler, found_pattern, found_params = make_router().match(method, path)
+    assert handler == (method, pattern)
+    assert found_pattern == pattern
+    assert found_params == params
+
+def test_router_prefix_table():
+    router = make_router()
+    # GET /api/snapshot/<repo> and /files/<rest:path> share their prefix with a literal route, they walk the trie
+    assert set(router.prefixed['GET']) == {'/api/list/', '/api/get/', '/api/changes/', '/api/status/', '/files/special/'}
+    assert set(router.prefixed['PUT']) == {'/api/put/'}
+    assert set(router.prefixed['POST']) == {'/api/snapshot/'}
+
+@pytest.mark.parametrize("method,path", [
+    ('GET', '/api/get/core/a.note,b.note'),
+    ('GET', '/api/get/core/a/b'),
+    ('GET', '/api/get/core'),
+    ('GET', '/api/get/core/'),
+    ('GET', '/api/get//a.note'),
+    ('GET', '/api/get/core//a.note'),
+    ('GET', '/api/get/core/a.note?x=1'),
+    ('GET', '//api/get/core/a.note'),
+    ('GET', '/api/list/core'),
+    ('GET', '/api/list/core/'),
+    ('GET', '/api/list/core/extra'),
+    ('GET', '/api/changes/42'),
+    ('GET', '/api/changes/-1'),
+    ('GET', '/api/changes/soon'),
+    ('PUT', '/api/put/core/a.note'),
+    ('PUT', '/api/put/core/a//b/'),
+    ('PUT', '/api/put/'),
+    ('POST', '/api/snapshot/core'),
+    ('GET', '/files/a/b'),
+    ('GET', '/files/special/a'),
+    ('GET', '/files/special/a/b'),
+    ('GET', '/api'),
+    ('GET', '/'),
+    ('GET', ''),
+])
+def test_router_prefix_table_agrees_with_the_trie(method, path):
+    router = make_router()
+    found = router.match(method, path)
+    router.prefixed = {}
+    assert router.match(method, path) == found
+
+@pytest.mark.parametrize("method,path", [
+    ('GET', '/api/nope'),
+    ('POST', '/api/status'),
+    ('GET', '/api/changes/soon'),
+    ('GET', '/api/list'),
+    ('GET', '/api/list/core/extra'),
+    ('DELETE', '/api/put/core/a'),
+])
+def test_router_misses(method, path):
+    assert make_router().match(method, path) is None
+
+def test_router_rejects_conflicting_params():
+    router = make_router()
+    with pytest.raises(AssertionError):
+        router.add('GET', '/api/list/<other>/x', None)
+    with pytest.raises(AssertionError):
+        router.add('GET', '/api/<rest:path>/x', None)
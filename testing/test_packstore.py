@@ -0,0 +1,79 @@
+"""
+Unit tests for packstore.py: the sorted index, reopening from the index or a scan, and compaction.
+
+python -m pytest -q testing/test_packstore.py
+"""
+
+import os
+
+import pytest
+
+import packstore
+import storage
+
+def make_store(tmp_path, compress=False):
+    store = packstore.PackStore(str(tmp_path), compress=compress)
+    store.load()
+    return store
+
+def notes(count, prefix='n'):
+    return {f"{prefix}{i:04d}": f"note {i}".encode() for i in range(count)}
+
+@pytest.mark.parametrize("compress", [False, True])
+def test_roundtrip(tmp_path, compress):
+    store = make_store(tmp_path, compress)
+    written = notes(50)
+    store.write_many([("core", uuid, content) for uuid, content in written.items()])
+    assert store.repos() == ["core"]
+    assert sorted(store.list("core")) == sorted(written)
+    assert all(store.read("core", uuid) == content for uuid, content in written.items())
+    assert store.hashes("core") == {uuid: storage.hash_content(content) for uuid, content in written.items()}
+    assert not store.exists("core", "missing")
+    assert not store.exists("nope", "n0000")
+    with pytest.raises(FileNotFoundError):
+        store.list("nope")
+
+def test_lookup_from_index_and_tail(tmp_path):
+    store = make_store(tmp_path)
+    store.write_many([("core", uuid, content) for uuid, content in notes(100).items()])
+    store.packs["core"].write_index()
+    # rewrites and new notes after the index was written are found past `covered`
+    store.write_many([("core", "n0007", b"rewritten"), ("core", "zzz", b"new"), ("core", "aaa", b"first")])
+    for reopened in (store, make_store(tmp_path)):
+        assert reopened.read("core", "n0007") == b"rewritten"
+        assert reopened.read("core", "zzz") == b"new"
+        assert reopened.read("core", "aaa") == b"first"
+        assert reopened.read("core", "n0099") == b"note 99"
+        assert len(reopened.list("core")) == 102
+        with pytest.raises(FileNotFoundError):
+            reopened.read("core", "n0100")
+
+def test_stale_index_is_rebuilt(tmp_path):
+    store = make_store(tmp_path)
+    store.write_many([("core", uuid, content) for uuid, content in notes(20).items()])
+    store.packs["core"].write_index()
+    index_path = os.path.join(store.pack_root, "core.idx")
+    with open(index_path, 'r+b') as f:
+        f.write(b"XXXX")  # not an index anymore
+    reopened = make_store(tmp_path)
+    assert reopened.read("core", "n0013") == b"note 13"
+    assert len(reopened.list("core")) == 20
+
+def test_compaction_keeps_live_notes(tmp_path):
+    store = make_store(tmp_path)
+    for round in range(4):
+        store.write_many([("core", uuid, content + b" v%d" % round) for uuid, content in notes(30).items()])
+    pack = store.packs["core"]
+    assert pack.dead_ratio() > 0.5
+    store.compact()
+    assert pack.dead_ratio() == 0
+    for reopened in (store, make_store(tmp_path)):
+        assert reopened.read("core", "n0005") == b"note 5 v3"
+        assert len(reopened.list("core")) == 30
+
+def test_imports_loose_repos(tmp_path):
+    loose = storage.LooseStore(str(tmp_path), storage.DurableWriter(window=0), fanout=True)
+    loose.write_many([("core", "a", b"one"), ("core", "b", b"two")])
+    store = make_store(tmp_path)
+    assert sorted(store.list("core")) == ["a", "b"]
+    assert store.read("core", "b") == b"two"
@@ -0,0 +1,54 @@
+"""
+Unit tests for responsecache.py.
+
+python -m pytest -q testing/test_responsecache.py
+"""
+
+import time
+
+import pytest
+
+from kazhttp import KazHttpResponse
+from responsecache import ResponseCache
+
+def counter():
+    calls = []
+    def compute():
+        calls.append(1)
+        return KazHttpResponse(b"200 OK", b"body %d" % len(calls))
+    return calls, compute
+
+def test_hit_within_ttl():
+    cache = ResponseCache(ttl=60)
+    calls, compute = counter()
+    first = cache.get('status', 1, compute)
+    second = cache.get('status', 1, compute)
+    assert len(calls) == 1
+    assert first is not second
+    assert first.body == second.body == b"body 1"
+    assert cache.stats() == {'computed': 1, 'hits': 1, 'entries': 1}
+
+def test_new_cursor_recomputes():
+    cache = ResponseCache(ttl=60)
+    calls, compute = counter()
+    cache.get('status', 1, compute)
+    assert cache.get('status', 2, compute).body == b"body 2"
+    assert cache.get('other', 2, compute).body == b"body 3"
+    assert len(calls) == 3
+
+def test_expires_after_ttl():
+    cache = ResponseCache(ttl=0.01)
+    calls, compute = counter()
+    cache.get('status', 1, compute)
+    time.sleep(0.02)
+    cache.get('status', 1, compute)
+    assert len(calls) == 2
+    assert cache.stats()['entries'] == 1
+
+def test_errors_are_not_cached():
+    cache = ResponseCache(ttl=60)
+    def fail():
+        raise OSError("boom")
+    with pytest.raises(OSError):
+        cache.get('status', 1, fail)
+    assert cache.stats()['entries'] == 0
@@ -0,0 +1,64 @@
+"""
+Unit tests for storage.py: note names, the group-committing writer and LooseStore.
+
+python -m pytest -q testing/test_storage.py
+"""
+
+import os
+import threading
+import time
+
+import pytest
+
+import storage
+
+@pytest.mark.parametrize("note", [
+    "core/abc", "journal/0b6f3a.note",
+])
+def test_split_note(note):
+    assert storage.split_note(note) == tuple(note.split('/'))
+
+@pytest.mark.parametrize("note", [
+    "", "core", "core/", "/abc", "core/a/b", "../abc", "core/..", "core/.hidden",
+    ".git/config", "raw/abc", ".hidden/abc",
+])
+def test_split_note_rejects(note):
+    assert storage.split_note(note) is None
+
+def test_lone_writer_skips_window(tmp_path):
+    writer = storage.DurableWriter(window=1.0)
+    start = time.monotonic()
+    writer.write(str(tmp_path / "a"), b"one")
+    assert time.monotonic() - start < 0.5
+    assert (tmp_path / "a").read_bytes() == b"one"
+    assert writer.groups_committed == 1
+
+def test_concurrent_writers(tmp_path):
+    writer = storage.DurableWriter(window=0.01)
+    threads = [threading.Thread(target=writer.write, args=(str(tmp_path / str(i)), str(i).encode())) for i in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert writer.notes_committed == 20
+    assert sorted(os.listdir(tmp_path), key=int) == [str(i) for i in range(20)]
+
+def test_failed_group_removes_temp_files(tmp_path):
+    writer = storage.DurableWriter(window=0)
+    (tmp_path / "note").write_bytes(b"old")
+    # a directory can't be replaced by a file, so the group fails at the rename
+    (tmp_path / "blocked").mkdir()
+    with pytest.raises(OSError):
+        writer.write_many([(str(tmp_path / "blocked"), b"x"), (str(tmp_path / "note"), b"new")])
+    assert sorted(os.listdir(tmp_path)) == ["blocked", "note"]
+    assert (tmp_path / "note").read_bytes() == b"old"
+
+@pytest.mark.parametrize("fanout,compress", [(False, False), (True, False), (True, True)])
+def test_loose_store_roundtrip(tmp_path, fanout, compress):
+    store = storage.LooseStore(str(tmp_path), storage.DurableWriter(window=0), fanout=fanout, compress=compress)
+    for repo in ("core", ".git", "raw"):
+        (tmp_path / repo).mkdir()
+    store.write_many([("core", "0b6f3a", b"hello"), ("core", "9c2e71", b"world")])
+    assert store.repos() == ["core"]
+    assert sorted(store.list("core")) == ["0b6f3a", "9c2e71"]
+    assert store.read("core", "0b6f3a") == b"hello"
@@ -0,0 +1,245 @@
+# write-ahead log for note writes
+#
+# a PUT is acknowledged once its note is appended to <notes root>/.wal and the log is fsynced, which is
+# one sequential append instead of a temp file, rename and directory sync in the repo directory.
+# a background thread materializes logged notes into the underlying store and then checkpoints the log:
+# if nothing new arrived meanwhile it truncates it, otherwise it rewrites it with only the notes still
+# pending, so under a steady stream of PUTs the log stays about as big as one checkpoint interval of writes.
+# until then, reads are answered from the notes that are still pending in memory.
+#
+# on startup, `recover` replays whatever is left in the log into the store before serving.
+#
+# record: b"KWAL" u32:note_length u32:content_length u32:crc32(note + content), note, content
+
+import os
+import struct
+import threading
+import time
+import zlib
+
+from kazhttp import log, error
+from storage import hash_content, fsync_dir, TEMP_SUFFIX
+
+WAL_NAME = ".wal"
+RECORD_MAGIC = b"KWAL"
+RECORD_HEADER = struct.Struct(">4sIII")
+
+def encode_record(repo: str, uuid: str, content: bytes) -> bytes:
+    note = (repo + '/' + uuid).encode()
+    crc = zlib.crc32(content, zlib.crc32(note))
+    return RECORD_HEADER.pack(RECORD_MAGIC, len(note), len(content), crc) + note + content
+
+def read_records(path: str):
+    # yields (repo, uuid, content) up to the first torn or corrupt record, which is where a crash stopped us
+    with open(path, 'rb') as f:
+        data = f.read()
+    offset = 0
+    while offset + RECORD_HEADER.size <= len(data):
+        magic, note_length, content_length, crc = RECORD_HEADER.unpack_from(data, offset)
+        start = offset + RECORD_HEADER.size
+        end = start + note_length + content_length
+        if magic != RECORD_MAGIC or end > len(data):
+            break
+        note = data[start:start + note_length]
+        content = data[start + note_length:end]
+        if zlib.crc32(content, zlib.crc32(note)) != crc:
+            break
+        repo, uuid = note.decode().split('/', 1)
+        yield repo, uuid, content
+        offset = end
+    if offset != len(data):
+        log(f"WAL: ignoring {len(data) - offset} bytes of torn record at the end of {path}")
+
+class WriteAheadLog:
+    # stands in front of a store with the same interface (repos, list, exists, read, hashes, write_many)
+    def __init__(self, root: str, store, checkpoint_interval: float = 0.5):
+        self.path = os.path.join(root, WAL_NAME)
+        self.store = store
+        self.checkpoint_interval = checkpoint_interval
+        self.lock = threading.Lock()
+        self.has_work = threading.Condition(self.lock)
+        self.sync_lock = threading.Lock()
+        self.pending = {}  # (repo, uuid) -> content not yet materialized
+        self.file = None
+        self.thread = None
+
+        # the log is truncated or replaced at every checkpoint, `generation` tells appenders their offsets are stale.
+        self.generation = 0
+        self.appended = 0
+        self.synced = 0
+
+        # stats
+        self.appends = 0
+        self.syncs = 0
+        self.checkpoints = 0
+
+    def recover(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        # a rewrite that crashed before its rename, the log it was replacing is still complete
+        if os.path.exists(self.path + TEMP_SUFFIX):
+            os.remove(self.path + TEMP_SUFFIX)
+        if os.path.exists(self.path):
+            latest = {}
+            for repo, uuid, content in read_records(self.path):
+                latest[(repo, uuid)] = content
+            if latest:
+                log(f"WAL: replaying {len(latest)} notes from {self.path}")
+                self.store.write_many([(repo, uuid, content) for (repo, uuid), content in latest.items()])
+        # append mode, so writes after a checkpoint's truncate start at the beginning again
+        self.file = open(self.path, 'ab', buffering=0)
+        self.file.truncate(0)
+        os.fsync(self.file.fileno())
+
+    def start(self):
+        if self.file is None:
+            self.recover()
+        self.thread = threading.Thread(target=self._run, name="wal-materialize", daemon=True)
+        self.thread.start()
+
+    # writes
+
+    def write_many(self, items):
+        # returns once every item is durable in the log
+        record = b"".join(encode_record(repo, uuid, content) for repo, uuid, content in items)
+        with self.lock:
+            self.file.write(record)
+            for repo, uuid, content in items:
+                self.pending[(repo, uuid)] = content
+            self.appended += len(record)
+            self.appends += 1
+            generation, end = self.generation, self.appended
+            self.has_work.notify()
+        self._sync(generation, end)
+
+    def _sync(self, generation: int, end: int):
+        # whoever gets here first fsyncs for everyone that appended before it, the rest find their bytes synced
+        with self.sync_lock:
+            with self.lock:
+                if generation != self.generation or self.synced >= end:
+                    return
+                generation, target = self.generation, self.appended
+            os.fsync(self.file.fileno())
+            with self.lock:
+                self.syncs += 1
+                if generation == self.generation:
+                    self.synced = max(self.synced, target)
+
+    # reads
+
+    def repos(self):
+        repos = self.store.repos()
+        with self.lock:
+            pending_repos = {repo for repo, _ in self.pending}
+        return repos + [repo for repo in pending_repos if repo not in repos]
+
+    def list(self, repo: str):
+        with self.lock:
+            pending = [uuid for r, uuid in self.pending if r == repo]
+        try:
+            uuids = self.store.list(repo)
+        except FileNotFoundError:
+            if not pending:
+                raise
+            uuids = []
+        known = set(uuids)
+        return uuids + [uuid for uuid in pending if uuid not in known]
+
+    def exists(self, repo: str, uuid: str) -> bool:
+        with self.lock:
+            if (repo, uuid) in self.pending:
+                return True
+        return self.store.exists(repo, uuid)
+
+    def read(self, repo: str, uuid: str) -> bytes:
+        with self.lock:
+            content = self.pending.get((repo, uuid))
+        if content is not None:
+            return content
+        return self.store.read(repo, uuid)
+
+    def read_stored(self, repo: str, uuid: str) -> bytes:
+        with self.lock:
+            content = self.pending.get((repo, uuid))
+        if content is not None:
+            return content
+        return self.store.read_stored(repo, uuid)
+
+    def hashes(self, repo: str):
+        with self.lock:
+            pending = {uuid: content for (r, uuid), content in self.pending.items() if r == repo}
+        hashes = self.store.hashes(repo)
+        hashes.update({uuid: hash_content(content) for uuid, content in pending.items()})
+        return hashes
+
+    # everything past the note interface (features, blobs, snapshots, ...) is the store's
+
+    def __getattr__(self, name):
+        if name == 'store':
+            raise AttributeError(name)
+        return getattr(self.store, name)
+
+    def snapshot(self, repo: str):
+        # notes still pending in the log have to be in the store for its snapshot to see them
+        with self.lock:
+            pending = [(r, uuid, content) for (r, uuid), content in self.pending.items() if r == repo]
+        if pending:
+            self.store.write_many(pending)
+        return self.store.snapshot(repo)
+
+    # materialization
+
+    def _run(self):
+        while True:
+            with self.lock:
+                while not self.pending:
+                    self.has_work.wait()
+            # let a burst finish appending so it's materialized in one group
+            time.sleep(self.checkpoint_interval)
+            with self.lock:
+                snapshot = dict(self.pending)
+            try:
+                self.store.write_many([(repo, uuid, content) for (repo, uuid), content in snapshot.items()])
+            except Exception as e:
+                error(f"WAL: materializing {len(snapshot)} notes failed, will retry: {e}")
+                continue
+            self._checkpoint(snapshot)
+
+    def _checkpoint(self, snapshot):
+        # sync_lock first, so no appender is fsyncing the file we're about to replace
+        with self.sync_lock, self.lock:
+            for key, content in snapshot.items():
+                if self.pending.get(key) is content:
+                    del self.pending[key]
+            if not self.pending:
+                self.file.truncate(0)
+                self.appended = 0
+            else:
+                # anything appended since the snapshot is still pending, and the log is the only durable copy of it.
+                # keep just those records, they're at most one checkpoint interval's worth of writes.
+                try:
+                    self._rewrite()
+                except OSError as e:
+                    # the old log still has everything, keep appending to it and try again next checkpoint
+                    error(f"WAL: rewriting {self.path} failed: {e}")
+                    return
+            self.synced = self.appended
+            self.generation += 1
+            self.checkpoints += 1
+
+    def _rewrite(self):
+        temp_path = self.path + TEMP_SUFFIX
+        record = b"".join(encode_record(repo, uuid, content) for (repo, uuid), content in self.pending.items())
+        try:
+            with open(temp_path, 'wb') as f:
+                f.write(record)
+                os.fsync(f.fileno())
+            os.replace(temp_path, self.path)
+        except OSError:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        # appends go to the new log from here on, even if syncing its directory entry fails below
+        self.file.close()
+        self.file = open(self.path, 'ab', buffering=0)
+        self.appended = len(record)
+        fsync_dir(os.path.dirname(self.path))
@@ -0,0 +1,247 @@
+# keeps the hash index and change log current when the notes root is edited out-of-band (git pulls,
+# editor scripts, restores)
+#
+# on linux, inotify watches on the notes root, each repo and each shard directory report notes as they're
+# closed after writing, renamed into place or removed, and each one is rehashed once (see hashindex.py).
+# our own writes show up too, as renames of their temp files, and are dropped by the change log as no-ops.
+# if the kernel's event queue overflows, or a repo or shard directory goes away, we can't know what we
+# missed, so the index goes back to stat validation and the change log tells clients to resync.
+#
+# without inotify, or if reading events keeps failing, a thread re-validates every repo against the hash
+# index every `interval` seconds and logs what changed.  /api/status is correct either way, it just costs a
+# stat per note.
+
+import os
+import sys
+import select
+import struct
+import threading
+import time
+import ctypes
+import ctypes.util
+
+from kazhttp import log, error
+from storage import is_note_file, is_shard_dir, NOT_REPOS
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+EVENT_HEADER = struct.Struct("iIII")  # wd, mask, cookie, name length
+READ_SIZE = 65536
+SETTLE_SECONDS = 0.05  # editors and git touch a file several times in a row, rehash it once
+RETRY_SECONDS = 0.1  # after a failed round of events, doubled for each failure in a row up to `interval`
+MAX_FAILURES = 5  # failed rounds in a row before we give up on inotify and poll
+
+def _load_inotify():
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        libc.inotify_init1.argtypes = [ctypes.c_int]
+        return libc
+    except (OSError, AttributeError):
+        return None
+
+def is_repo(name: str) -> bool:
+    return name not in NOT_REPOS and is_note_file(name)
+
+class Watcher:
+    def __init__(self, root: str, index, changes, interval: float = 5):
+        self.root = root
+        self.index = index
+        self.changes = changes
+        self.interval = interval
+        self.libc = None
+        self.fd = -1
+        self.places = {}  # watch descriptor -> None for the root, (repo, None) or (repo, shard) for directories in it
+
+        # stats
+        self.events = 0
+        self.refreshes = 0
+        self.resyncs = 0
+
+    def start(self):
+        self.libc = _load_inotify()
+        if self.libc is not None:
+            self.fd = self.libc.inotify_init1(IN_CLOEXEC)
+            if self.fd < 0:
+                log(f"inotify isn't available ({os.strerror(ctypes.get_errno())}), polling '{self.root}' every {self.interval}s instead")
+        if self.fd < 0:
+            threading.Thread(target=self._poll, name="watch-poll", daemon=True).start()
+            return
+        try:
+            self._watch_tree()
+        except OSError as e:
+            log(f"watching '{self.root}' failed ({e}), polling every {self.interval}s instead")
+            os.close(self.fd)
+            self.fd = -1
+            threading.Thread(target=self._poll, name="watch-poll", daemon=True).start()
+            return
+        self.index.watch()
+        threading.Thread(target=self._run, name="watch-inotify", daemon=True).start()
+        log(f"watching {len(self.places)} directories under '{self.root}' with inotify")
+
+    def stats(self):
+        return {'inotify': self.fd >= 0, 'watches': len(self.places), 'events': self.events, 'refreshes': self.refreshes, 'resyncs': self.resyncs}
+
+    # inotify
+
+    def _add_watch(self, path: str, place):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, f"inotify_add_watch {path}: {os.strerror(errno)}")
+        self.places[wd] = place
+
+    def _watch_tree(self):
+        self._add_watch(self.root, None)
+        for repo in os.listdir(self.root):
+            if is_repo(repo) and os.path.isdir(os.path.join(self.root, repo)):
+                self._watch_repo(repo)
+
+    def _watch_repo(self, repo: str):
+        # returns the notes already in it, which may have been written before the watch was in place
+        repo_path = os.path.join(self.root, repo)
+        self._add_watch(repo_path, (repo, None))
+        notes = []
+        with os.scandir(repo_path) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    if is_shard_dir(entry.name):
+                        notes.extend(self._watch_shard(repo, entry.name))
+                elif is_note_file(entry.name):
+                    notes.append((repo, entry.name))
+        return notes
+
+    def _watch_shard(self, repo: str, shard: str):
+        shard_path = os.path.join(self.root, repo, shard)
+        self._add_watch(shard_path, (repo, shard))
+        return [(repo, uuid) for uuid in os.listdir(shard_path) if is_note_file(uuid)]
+
+    def _read_events(self, data: bytes):
+        # yields (wd, mask, name)
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b"\0")
+            offset += length
+            yield wd, mask, os.fsdecode(name)
+
+    def _run(self):
+        failures = 0
+        while True:
+            try:
+                dirty = set()
+                resync = False
+                data = os.read(self.fd, READ_SIZE)
+                while True:
+                    for wd, mask, name in self._read_events(data):
+                        self.events += 1
+                        resync |= self._handle(wd, mask, name, dirty)
+                    # keep collecting until things quiet down
+                    ready, _, _ = select.select([self.fd], [], [], SETTLE_SECONDS)
+                    if not ready:
+                        break
+                    data = os.read(self.fd, READ_SIZE)
+                if resync:
+                    self._resync()
+                for repo, uuid in dirty:
+                    sha, fresh = self.index.refresh(repo, uuid)
+                    self.refreshes += 1
+                    if fresh:
+                        self.changes.record(repo, uuid, sha)
+                failures = 0
+            except Exception as e:
+                failures += 1
+                error(f"watcher: {e}")
+                if failures >= MAX_FAILURES:
+                    log(f"watcher: {failures} failures in a row, polling '{self.root}' every {self.interval}s instead of inotify")
+                    self._stop_watching()
+                    self._poll()
+                    return
+                self._resync()
+                time.sleep(min(RETRY_SECONDS * 2 ** (failures - 1), self.interval))
+
+    def _handle(self, wd: int, mask: int, name: str, dirty) -> bool:
+        # adds notes that changed to `dirty`, returns True if we can no longer know what changed
+        if mask & IN_Q_OVERFLOW:
+            log("watcher: inotify queue overflowed")
+            return True
+        if mask & IN_IGNORED:
+            self.places.pop(wd, None)
+            return False
+        if wd not in self.places:
+            return False
+        place = self.places[wd]
+        if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+            # the root or a repo or shard directory went away with its notes
+            return True
+        if not is_note_file(name):
+            return False  # temp files, the hash index, the write-ahead log
+
+        appeared = mask & (IN_CREATE | IN_MOVED_TO)
+        if place is None:
+            if mask & IN_ISDIR and is_repo(name):
+                if appeared:
+                    dirty.update(self._watch_repo(name))
+                else:
+                    return True
+            return False
+        repo, shard = place
+        if mask & IN_ISDIR:
+            if shard is None and is_shard_dir(name):
+                if appeared:
+                    dirty.update(self._watch_shard(repo, name))
+                else:
+                    return True
+            return False
+        if mask & IN_CREATE:
+            return False  # an empty file, wait for it to be written and closed
+        dirty.add((repo, name))
+        return False
+
+    def _resync(self):
+        self.resyncs += 1
+        self.index.unwatch()
+        self.changes.reset()
+        self.index.watch()
+
+    def _stop_watching(self):
+        self.resyncs += 1
+        self.index.unwatch()
+        self.changes.reset()
+        os.close(self.fd)
+        self.fd = -1
+        self.places = {}
+
+    # polling
+
+    def _poll(self):
+        previous = None
+        while True:
+            try:
+                current = {}
+                for repo in self.index.repos():
+                    for uuid, sha in self.index.hashes(repo).items():
+                        current[(repo, uuid)] = sha
+                if previous is not None:
+                    for (repo, uuid), sha in current.items():
+                        if previous.get((repo, uuid)) != sha:
+                            self.changes.record(repo, uuid, sha)
+                    for repo, uuid in previous.keys() - current.keys():
+                        self.changes.record(repo, uuid, None)
+                previous = current
+            except Exception as e:
+                error(f"watcher: polling '{self.root}' failed: {e}")
+            time.sleep(self.interval)